@@ -2,13 +2,21 @@
 import os
 import sqlite3
 import hashlib
+import hmac
 import secrets
 import threading
 import time
 import json
+import math
 import re
 import base64
-from datetime import datetime, timedelta, timezone, date, time
+import copy
+import io
+import urllib.parse
+from functools import lru_cache
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone, date
 
 import streamlit as st
 import streamlit.components.v1 as components
@@ -17,6 +25,25 @@ import numpy as np
 import calendar
 import altair as alt
 
+try:
+    import orjson  # 任意：入っていればDB保存/読込のJSON処理を高速化
+except Exception:
+    orjson = None
+try:
+    import pybase64  # 任意：入っていれば画像のbase64エンコードを高速化
+except Exception:
+    pybase64 = None
+try:
+    from PIL import Image, ImageOps  # 任意：写真を縮小してからAIへ送る
+except Exception:
+    Image = ImageOps = None
+else:
+    try:
+        import pillow_heif  # iPhoneのHEIC/HEIFを開けるようにする
+        pillow_heif.register_heif_opener()
+    except Exception:
+        pass
+
 from core import init_db, Labs, Ctx, register_case, add_followup, resolve_case_id, simulate_predictions_for_case
 
 # =========================
@@ -38,7 +65,6 @@ AI_PERSIST_KEYS = [
     "tr_menu_text",      # 筋トレメニュー
     "sl_ai_text",        # 睡眠AIアドバイス
     "inj_ai_text",       # 怪我AIコメント
-    "l_ai_comment_text", # 食事（昼）のAIコメント（給食/非給食共通で使う想定）
 ]
 
 def _ai_cache_load(code_hash: str) -> dict:
@@ -52,14 +78,24 @@ def _ai_cache_save(code_hash: str, cache: dict) -> None:
         return
     save_snapshot(code_hash, "ai_cache", cache)
 
+@st.cache_data(ttl=60, show_spinner=False)
+def _cached_ai_cache(code_hash: str) -> dict:
+    return _ai_cache_load(code_hash)
+
 def restore_ai_cache_to_session(code_hash: str) -> None:
-    cache = _ai_cache_load(code_hash)
+    cache = _cached_ai_cache(code_hash)
     for k in AI_PERSIST_KEYS:
         v = cache.get(k)
         if v:
             st.session_state.setdefault(k, v)
 
-def persist_ai_cache_from_session(code_hash: str) -> None:
+def persist_ai_cache_from_session(code_hash: str, *, force: bool = False) -> None:
+    # このセッションで最後に保存した内容から変わっていなければ、DBの読み書きをしない
+    # （rerunごとの呼び出しはほぼここで終わる。状態はセッション単位なので間引きで取りこぼすこともない）
+    ss = st.session_state
+    sig = (code_hash, _dumps({k: ss.get(k) for k in AI_PERSIST_KEYS if ss.get(k)}))
+    if not force and ss.get("_ai_persist_sig") == sig:
+        return
     cache = _ai_cache_load(code_hash)
     changed = False
     for k in AI_PERSIST_KEYS:
@@ -69,6 +105,8 @@ def persist_ai_cache_from_session(code_hash: str) -> None:
             changed = True
     if changed:
         _ai_cache_save(code_hash, cache)
+        _cached_ai_cache.clear()
+    ss["_ai_persist_sig"] = sig
 
 def download_text_button(label: str, text: str, filename: str, key: str):
     if not text:
@@ -81,6 +119,9 @@ def download_text_button(label: str, text: str, filename: str, key: str):
         key=key
     )
 SPORTS = ["サッカー", "ラグビー", "野球", "テニス", "水泳"]
+SPORT_INDEX = {s: i for i, s in enumerate(SPORTS)}  # selectboxの初期index用（未知の値は先頭）
+SEX_OPTS = ("未選択", "男", "女")
+SEX_INDEX = {s: i for i, s in enumerate(SEX_OPTS)}
 RESERVE_URL = "https://qr.digikar-smart.jp/6bcfb249-1c73-4789-af01-2cb02fec9f42/reserve"
 
 USERS_DB_PATH = "users.db"
@@ -179,223 +220,17 @@ def jams_logo_footer():
         st.image(p, width=180)
 
 
-def apply_css():
-    st.markdown("""
-    <style>
-      /* === Mobile-first readability (40代でも迷わず押せる) === */
-      html, body, [class*="css"] { font-size: 17px; }
-      @media (max-width: 640px){
-        html, body, [class*="css"] { font-size: 19px; }
-        .block-container { padding-left: 0.85rem; padding-right: 0.85rem; }
-      }
-
-      /* Buttons */
-      .stButton > button {
-        font-size: 18px !important;
-        font-weight: 800 !important;
-        padding: 0.85rem 0.9rem !important;
-        border-radius: 14px !important;
-        min-height: 56px !important;
-      }
-      @media (max-width: 640px){
-        .stButton > button{
-          font-size: 20px !important;
-          min-height: 64px !important;
-          padding: 1.0rem 1.0rem !important;
-          border-radius: 16px !important;
-        }
-      }
-
-      /* Inputs */
-      .stTextInput input, .stNumberInput input, .stDateInput input, .stTimeInput input, .stTextArea textarea, .stSelectbox div[data-baseweb="select"] > div{
-        font-size: 18px !important;
-        min-height: 52px !important;
-      }
-      @media (max-width: 640px){
-        .stTextInput input, .stNumberInput input, .stDateInput input, .stTimeInput input, .stTextArea textarea, .stSelectbox div[data-baseweb="select"] > div{
-          font-size: 20px !important;
-          min-height: 56px !important;
-        }
-      }
-
-      /* Section headings */
-      h1, h2, h3 { letter-spacing: -0.01em; }
-      h2 { font-size: 1.45rem !important; }
-      @media (max-width: 640px){
-        h2 { font-size: 1.55rem !important; }
-      }
-
-      /* Make radio/checkbox labels easier to tap */
-      label[data-baseweb="checkbox"], label[data-baseweb="radio"] { padding-top: 10px; padding-bottom: 10px; }
-
-      /* Menu: keep 2 buttons per row, big and tappable */
-      .km-menu-title{ font-size: 22px; font-weight: 900; margin: 6px 0 8px 0; }
-      @media (max-width: 640px){ .km-menu-title{ font-size: 24px; } }
-      .km-menu-sub{ color: rgba(0,0,0,0.65); font-size: 15px; margin-bottom: 10px; }
-      @media (max-width: 640px){ .km-menu-sub{ font-size: 16px; } }
-
-      .km-bigbtn .stButton > button{
-        min-height: 78px !important;
-        font-size: 20px !important;
-      }
-      @media (max-width: 640px){
-        .km-bigbtn .stButton > button{
-          min-height: 92px !important;
-          font-size: 22px !important;
-        }
-      }
-
-      /* Back-to-menu button should also be large */
-      .km-navbtn .stButton > button{
-        min-height: 60px !important;
-        font-size: 18px !important;
-      }
-      @media (max-width: 640px){
-        .km-navbtn .stButton > button{
-          min-height: 68px !important;
-          font-size: 20px !important;
-        }
-      }
-    
-      .block-container { padding-top: 2.2rem; }
-      div[data-testid="stHorizontalBlock"] { gap: 6px !important; padding: 0 4px; }
-div[data-testid="stHorizontalBlock"]::after{ content:""; display:block; height:1px; background: rgba(0,0,0,0.10); margin-top:-1px; }
-div[data-testid="stHorizontalBlock"] label[data-baseweb="radio"]{
-  border: 1px solid rgba(0,0,0,0.10);
-  border-bottom: 0;
-  border-radius: 12px 12px 0 0;
-  padding: 8px 14px !important;
-  background: rgba(255,255,255,0.85);
-  box-shadow: 0 6px 14px rgba(0,0,0,0.06);
-}
-div[data-testid="stHorizontalBlock"] label[data-baseweb="radio"]:has(input:checked){
-  background: #ffffff;
-  box-shadow: 0 10px 22px rgba(0,0,0,0.08);
-  transform: translateY(1px);
-}
-div[data-testid="stHorizontalBlock"] label[data-baseweb="radio"] p{ margin:0; font-weight:700; }
-
-      div[data-testid="column"] button{ width: 100%; }
-      .stExpander{
-        border-radius: 16px;
-        border: 1px solid rgba(0,0,0,0.07);
-        box-shadow: 0 10px 24px rgba(0,0,0,0.04);
-        background: rgba(255,255,255,0.92);
-      }
-    
-div[data-testid="stHorizontalBlock"] label[data-baseweb="radio"]:nth-child(1){
-  border-left: 4px solid rgba(59,130,246,0.8) !important;
-}
-div[data-testid="stHorizontalBlock"] label[data-baseweb="radio"]:nth-child(2){
-  border-left: 4px solid rgba(239,68,68,0.8) !important;
-}
-div[data-testid="stHorizontalBlock"] label[data-baseweb="radio"]:nth-child(3){
-  border-left: 4px solid rgba(16,185,129,0.8) !important;
-}
-div[data-testid="stHorizontalBlock"] label[data-baseweb="radio"]:nth-child(4){
-  border-left: 4px solid rgba(245,158,11,0.85) !important;
-}
-
-/* ===== Premium mobile nav ===== */
-@media (max-width: 640px){
-  .block-container { padding-left: 0.75rem; padding-right: 0.75rem; }
-  div[data-testid="stHorizontalBlock"] { gap: 8px !important; }
-  div[data-testid="stHorizontalBlock"] label[data-baseweb="radio"]{
-    padding: 10px 14px !important;
-    border-radius: 14px !important;
-    font-size: 16px !important;
-  }
-}
-/* Make nav look like premium segmented tabs */
-div[data-testid="stHorizontalBlock"]{
-  background: rgba(255,255,255,0.75);
-  border: 1px solid rgba(0,0,0,0.08);
-  border-radius: 16px;
-  padding: 8px;
-  box-shadow: 0 14px 30px rgba(0,0,0,0.06);
-  position: sticky;
-  top: 0;
-  z-index: 999;
-  backdrop-filter: blur(10px);
-}
-div[data-testid="stHorizontalBlock"]::after{ display:none !important; }
-
-div[data-testid="stHorizontalBlock"] label[data-baseweb="radio"]{
-  border: 0 !important;
-  border-radius: 14px !important;
-  padding: 9px 14px !important;
-  background: rgba(0,0,0,0.04) !important;
-  box-shadow: none !important;
-  transition: all 120ms ease;
-}
-div[data-testid="stHorizontalBlock"] label[data-baseweb="radio"]:has(input:checked){
-  background: #111827 !important;
-  color: #fff !important;
-  box-shadow: 0 10px 20px rgba(0,0,0,0.12) !important;
-  transform: none !important;
-}
-div[data-testid="stHorizontalBlock"] label[data-baseweb="radio"] p{ font-weight: 800; }
-
-/* Color accents per tab label (unselected) */
-div[data-testid="stHorizontalBlock"] label[data-baseweb="radio"] p:contains("身長"){ }
-
-
-/* ===== Main nav (radio) premium ===== */
-div[data-testid="stRadio"] div[role="radiogroup"]{
-  background: rgba(255,255,255,0.75);
-  border: 1px solid rgba(0,0,0,0.10);
-  border-radius: 16px;
-  padding: 8px;
-  box-shadow: 0 14px 30px rgba(0,0,0,0.06);
-}
-div[data-testid="stRadio"] label[data-baseweb="radio"]{
-  border-radius: 14px !important;
-  padding: 10px 14px !important;
-  background: rgba(0,0,0,0.04) !important;
-  border-left: 4px solid rgba(0,0,0,0.0) !important;
-}
-div[data-testid="stRadio"] label[data-baseweb="radio"]:has(input:checked){
-  background: rgba(255,255,255,0.98) !important;
-  color: #111827 !important;
-  box-shadow: 0 12px 26px rgba(0,0,0,0.12) !important;
-  outline: 2px solid rgba(17,24,39,0.20);
-}
-
-div[data-testid="stRadio"] label[data-baseweb="radio"] p{ margin:0; font-weight:800; }
-@media (max-width: 640px){
-  div[data-testid="stRadio"] label[data-baseweb="radio"]{ font-size: 16px !important; }
-}
-
-
-div[data-testid="stRadio"] label[data-baseweb="radio"]:nth-child(1){ border-left:4px solid rgba(59,130,246,0.85) !important; }
-div[data-testid="stRadio"] label[data-baseweb="radio"]:nth-child(2){ border-left:4px solid rgba(239,68,68,0.85) !important; }
-div[data-testid="stRadio"] label[data-baseweb="radio"]:nth-child(3){ border-left:4px solid rgba(16,185,129,0.85) !important; }
-div[data-testid="stRadio"] label[data-baseweb="radio"]:nth-child(4){ border-left:4px solid rgba(245,158,11,0.90) !important; }
-
-div[data-testid="stRadio"] label[data-baseweb="radio"]:nth-child(1):has(input:checked){ background: rgba(59,130,246,0.10) !important; outline-color: rgba(59,130,246,0.35) !important; }
-div[data-testid="stRadio"] label[data-baseweb="radio"]:nth-child(2):has(input:checked){ background: rgba(239,68,68,0.10) !important; outline-color: rgba(239,68,68,0.35) !important; }
-div[data-testid="stRadio"] label[data-baseweb="radio"]:nth-child(3):has(input:checked){ background: rgba(16,185,129,0.10) !important; outline-color: rgba(16,185,129,0.35) !important; }
-div[data-testid="stRadio"] label[data-baseweb="radio"]:nth-child(4):has(input:checked){ background: rgba(245,158,11,0.12) !important; outline-color: rgba(245,158,11,0.40) !important; }
-
-
-/* === Mobile menu (Calomil-ish) === */
-.km-wrap{max-width:760px;margin:0 auto;}
-.km-card{border:1px solid rgba(0,0,0,0.08); border-radius:16px; padding:12px 14px; background:rgba(255,255,255,0.92); box-shadow:0 1px 6px rgba(0,0,0,0.04);}
-.km-muted{color:rgba(0,0,0,0.55); font-size:0.85rem;}
-.km-title{font-weight:700; font-size:1.05rem; margin:0 0 6px 0;}
-.km-grid button[kind="secondary"], .km-grid button[kind="primary"]{width:100%;}
-.km-bigbtn button{height:68px !important; border-radius:16px !important; font-weight:800 !important; font-size:18px !important;}
-.km-bigbtn .stButton>button{width:100%;}
-@media (max-width: 640px){
-  .km-bigbtn button{height:76px !important; font-size:20px !important;}
-}
-.km-topbar{display:flex; gap:8px; align-items:center; justify-content:space-between; margin:8px 0 14px;}
-.km-navbtn .stButton>button{border-radius:14px; padding:10px 12px; width:100%;}
-.km-bottom{position:sticky; bottom:0; z-index:10; padding:10px 0 8px 0; background:linear-gradient(to top, rgba(255,255,255,0.98), rgba(255,255,255,0.65), rgba(255,255,255,0));}
-.km-thumb img{border-radius:12px !important;}
+@st.cache_data(show_spinner=False)
+def _asset_css(name: str) -> str:
+    """assets/ のCSSを1回だけ読む（毎rerunで長い文字列を組み立て直さない）"""
+    try:
+        with open(os.path.join("assets", name), encoding="utf-8") as f:
+            return f.read()
+    except OSError:
+        return ""
 
-</style>
-    """, unsafe_allow_html=True)
+def apply_css():
+    st.markdown(f"<style>{_asset_css('style.css')}</style>", unsafe_allow_html=True)
 
 # =========================
 # Utils
@@ -455,18 +290,22 @@ def calc_daily_targets(weight_kg: float, goal: str) -> dict:
     except Exception:
         age = 16.0
 
-    # BMR (Mifflin-St Jeor)
-    s_const = 5 if sex.upper().startswith("M") else -161
-    bmr = 10.0*w + 6.25*h - 5.0*age + s_const
-
     # 活動係数（アスリート寄りのざっくり）
     try:
         activity = float(st.session_state.get("activity_factor") or 1.6)
     except Exception:
         activity = 1.6
+    return dict(_daily_targets_cached(w, str(goal or ""), sex, h, age, activity))
+
+@lru_cache(maxsize=256)
+def _daily_targets_cached(w: float, goal: str, sex: str, h: float, age: float, activity: float) -> dict:
+    # 入力（体重/目的/性別/身長/年齢/活動係数）が同じなら結果も同じなので、rerunごとの再計算を省く
+    # BMR (Mifflin-St Jeor)
+    s_const = 5 if sex.upper().startswith("M") else -161
+    bmr = 10.0*w + 6.25*h - 5.0*age + s_const
     tdee = bmr * activity
 
-    g = str(goal or "").lower()
+    g = goal.lower()
     if ("diet" in g) or ("ダイエット" in g) or ("減量" in g):
         kcal = tdee - 500.0
         p_g = 1.8 * w
@@ -525,7 +364,7 @@ def update_streak_on_save(code_hash: str):
         streak = int(load_snapshot(code_hash, "streak_count") or 0)
 
         if last == today:
-            pass
+            save_snapshot(code_hash, "streak_medal", calc_medal(streak))
         else:
             if last:
                 try:
@@ -540,10 +379,11 @@ def update_streak_on_save(code_hash: str):
             else:
                 streak = 1
 
-            save_snapshot(code_hash, "streak_last_date", today)
-            save_snapshot(code_hash, "streak_count", streak)
-
-        save_snapshot(code_hash, "streak_medal", calc_medal(streak))
+            save_snapshots_many(code_hash, {
+                "streak_last_date": today,
+                "streak_count": streak,
+                "streak_medal": calc_medal(streak),
+            })
     except Exception:
         # streak should never break core features
         return
@@ -609,52 +449,7 @@ def jams_logo_header():
 
 def premium_css():
     """Lightweight premium-ish UI (kids-friendly, readable)."""
-    st.markdown(
-        """
-<style>
-/* Larger base font for kids */
-html, body, [class*="css"]  { font-size: 16px !important; }
-
-/* Make tab labels bigger & easier to tap */
-div[data-baseweb="tab"] button {
-  font-size: 16px !important;
-  padding: 12px 14px !important;
-  border-radius: 14px !important;
-}
-
-/* AI highlight card */
-.ai-card {
-  border: 1px solid rgba(0,0,0,0.08);
-  border-radius: 16px;
-  padding: 14px 16px;
-  background: rgba(255, 250, 235, 0.9);
-  box-shadow: 0 6px 16px rgba(0,0,0,0.06);
-}
-.ai-title {
-  font-weight: 700;
-  font-size: 16px;
-  margin-bottom: 8px;
-}
-.ai-text { font-size: 15px; line-height: 1.7; white-space: pre-wrap; }
-
-/* Section header card */
-.section-card {
-  border: 1px solid rgba(0,0,0,0.06);
-  border-radius: 18px;
-  padding: 14px 16px;
-  background: #ffffff;
-  box-shadow: 0 8px 18px rgba(0,0,0,0.05);
-  margin: 10px 0 14px 0;
-}
-.section-card h2 { margin: 0; font-size: 18px; }
-.section-card p { margin: 6px 0 0 0; color: rgba(0,0,0,0.6); }
-
-/* Buttons: slightly rounded */
-button[kind="secondary"], button[kind="primary"] { border-radius: 12px !important; }
-</style>
-        """,
-        unsafe_allow_html=True,
-    )
+    st.markdown(f"<style>{_asset_css('premium.css')}</style>", unsafe_allow_html=True)
 
 def ai_highlight_box(title: str, text: str):
     if not text:
@@ -668,6 +463,18 @@ def ai_highlight_box(title: str, text: str):
     )
 
 
+TRAINING_HEAD_KEYWORDS = (
+    "上半身",
+    "下半身",
+    "体幹",
+    "4週間の進め方",
+    "４週間の進め方",
+    "4週間",
+    "４週間",
+)
+# 見出しの前後から落とす文字（空白・Markdownの#・括弧/記号）
+_HEAD_STRIP_CHARS = " \t\u3000#【】[]()（）:：・-"
+
 def normalize_training_headings(text: str) -> str:
     """
     筋トレメニュー内の見出しをすべて同一フォント・同一サイズに統一する
@@ -677,29 +484,14 @@ def normalize_training_headings(text: str) -> str:
     if not text:
         return text
 
-    head_keywords = [
-        "上半身",
-        "下半身",
-        "体幹",
-        "4週間の進め方",
-        "４週間の進め方",
-        "4週間",
-        "４週間",
-    ]
-
     lines = text.splitlines()
     out = []
 
     for line in lines:
-        raw = line.strip()
-        raw = raw.lstrip("#").strip()
-        raw_clean = raw.strip("【】[]()（）:：・- ")
-
+        # キーワードを含まない行（大半）は整形せずにそのまま
         matched = None
-        for kw in head_keywords:
-            if kw in raw_clean:
-                matched = raw_clean
-                break
+        if any(kw in line for kw in TRAINING_HEAD_KEYWORDS):
+            matched = line.strip(_HEAD_STRIP_CHARS)
 
         if matched:
             out.append(
@@ -746,25 +538,25 @@ def saved_ai_footer(items):
     """Footer area where saved comments are shown + copy buttons."""
     st.markdown("---")
     st.subheader("📌 保存したAIコメント")
-    shown = False
-    for item in items:
-        key = item.get("key")
+    present = [(item, st.session_state.get(item["key"], "")) for item in items if item.get("key")]
+    present = [(item, text) for item, text in present if text]
+    if not present:
+        st.info("保存済みのAIコメントはまだありません。AIでコメントを作るとここに残ります。")
+        return
+    for item, text in present:
+        key = item["key"]
         title = item.get("title", key)
-        text = st.session_state.get(key, "") if key else ""
-        if not text:
-            continue
-        shown = True
         with st.expander(title, expanded=False):
             copy_button("このコメントをコピー", text, key=f"copy_{key}")
             download_text_button("TXTで保存", text, filename=f"{title}.txt", key=f"dl_{key}")
             st.caption("コピーしたら、スマホのメモやLINEの『自分だけのトーク』に保存しておくのがおすすめです。")
             st.text_area("内容", value=text, height=180, key=f"ta_{key}")
-    if not shown:
-        st.info("保存済みのAIコメントはまだありません。AIでコメントを作るとここに残ります。")
 
 
 
+@lru_cache(maxsize=256)
 def sha256_hex(s: str) -> str:
+    # ユーザーIDのcode_hashは毎rerun求めるので、入力ごとに1回だけ計算する
     return hashlib.sha256(s.encode("utf-8")).hexdigest()
 
 def years_between(d1, d2) -> float:
@@ -778,12 +570,22 @@ def nz(x):
         return None
 
 
+def ss_float(key: str, default: float = 0.0) -> float:
+    """session_stateの数値を float で取り出す（未設定/None/""/0 は default）"""
+    v = st.session_state.get(key)
+    return float(v) if v else float(default)
+
+
 def _parse_date_maybe(v):
     if v is None:
         return None
     if isinstance(v, date):
         return v
     if isinstance(v, str):
+        try:
+            return date.fromisoformat(v)
+        except ValueError:
+            pass
         for fmt in ("%Y-%m-%d", "%Y/%m/%d"):
             try:
                 return datetime.strptime(v, fmt).date()
@@ -797,53 +599,74 @@ def clamp(x, lo, hi):
 # =========================
 # Login (test)
 # =========================
+# users DB もデータDBと同じく共有コネクション＋ロック（rerunのたびに接続・PRAGMAしない）
+USERS_DB_LOCK = threading.RLock()
+
+@st.cache_resource(show_spinner=False)
 def users_db():
-    conn = sqlite3.connect(USERS_DB_PATH, check_same_thread=False)
+    """Process-wide connection to the users DB (reused across reruns; use under USERS_DB_LOCK)."""
+    conn = sqlite3.connect(USERS_DB_PATH, check_same_thread=False, timeout=30)
     conn.execute("PRAGMA journal_mode=WAL;")
     conn.execute("PRAGMA synchronous=NORMAL;")
+    conn.execute("PRAGMA busy_timeout=5000;")
     return conn
 
 def init_users_db():
-    conn = users_db()
-    conn.execute("""
-        CREATE TABLE IF NOT EXISTS users(
-            username TEXT PRIMARY KEY,
-            pw_salt TEXT NOT NULL,
-            pw_hash TEXT NOT NULL,
-            created_at TEXT NOT NULL
-        );
-    """)
-    conn.commit()
-    conn.close()
+    with USERS_DB_LOCK:
+        conn = users_db()
+        with conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS users(
+                    username TEXT PRIMARY KEY,
+                    pw_salt TEXT NOT NULL,
+                    pw_hash TEXT NOT NULL,
+                    created_at TEXT NOT NULL
+                );
+            """)
+
+PW_HASH_PREFIX = "pbkdf2_sha256$"  # これが付いていない pw_hash は旧形式（salt+passwordのSHA-256 1回）
+PW_HASH_ITERATIONS = 100_000
 
 def _hash_pw(password: str, salt: str) -> str:
+    dk = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), bytes.fromhex(salt), PW_HASH_ITERATIONS)
+    return PW_HASH_PREFIX + dk.hex()
+
+def _hash_pw_legacy(password: str, salt: str) -> str:
     return hashlib.sha256((salt + password).encode("utf-8")).hexdigest()
 
 def verify_user(username: str, password: str) -> bool:
     u = (username or "").strip()
-    conn = users_db()
-    row = conn.execute("SELECT pw_salt, pw_hash FROM users WHERE username=?", (u,)).fetchone()
-    conn.close()
+    with USERS_DB_LOCK:
+        row = users_db().execute("SELECT pw_salt, pw_hash FROM users WHERE username=?", (u,)).fetchone()
     if not row:
         return False
     salt, pw_hash = row
-    return _hash_pw(password, salt) == pw_hash
+    if pw_hash.startswith(PW_HASH_PREFIX):
+        return hmac.compare_digest(_hash_pw(password, salt), pw_hash)
+    if not hmac.compare_digest(_hash_pw_legacy(password, salt), pw_hash):
+        return False
+    # 旧形式で一致したら、その場でPBKDF2に置き換える
+    with USERS_DB_LOCK:
+        conn = users_db()
+        with conn:
+            conn.execute("UPDATE users SET pw_hash=? WHERE username=?", (_hash_pw(password, salt), u))
+    return True
 
 def create_user(username: str, password: str) -> str | None:
     u = (username or "").strip()
     if not u or not password:
         return "IDとパスワードは必須です。"
-    conn = users_db()
-    exists = conn.execute("SELECT 1 FROM users WHERE username=?", (u,)).fetchone()
-    if exists:
-        conn.close()
-        return "そのIDはすでに使われています。"
     salt = secrets.token_hex(16)
     pw_hash = _hash_pw(password, salt)
-    conn.execute("INSERT INTO users(username, pw_salt, pw_hash, created_at) VALUES(?,?,?,?)",
-                 (u, salt, pw_hash, iso(now_jst())))
-    conn.commit()
-    conn.close()
+    # 存在確認と登録を同じロック内で行う（同時登録で同じIDが2回通らないように）
+    with USERS_DB_LOCK:
+        conn = users_db()
+        exists = conn.execute("SELECT 1 FROM users WHERE username=?", (u,)).fetchone()
+        if exists:
+            return "そのIDはすでに使われています。"
+        with conn:
+            conn.execute("INSERT INTO users(username, pw_salt, pw_hash, created_at) VALUES(?,?,?,?)",
+                         (u, salt, pw_hash, iso(now_jst())))
     return None
 
 def login_panel() -> str | None:
@@ -874,21 +697,34 @@ def login_panel() -> str | None:
     return st.session_state.get("user")
 
 
-DB_LOCK = threading.Lock()
+# 共有コネクションを複数スレッド（セッション）で使うため、全アクセスをこのロックで直列化する
+DB_LOCK = threading.RLock()
 
 def _connect_db():
     # Streamlit Cloud: concurrent reruns can hit sqlite locks. Use timeout + busy_timeout + WAL.
-    conn = sqlite3.connect(DATA_DB_PATH, check_same_thread=False, timeout=30)
+    conn = sqlite3.connect(DATA_DB_PATH, check_same_thread=False, timeout=30, cached_statements=256)
     conn.execute("PRAGMA journal_mode=WAL;")
     conn.execute("PRAGMA synchronous=NORMAL;")
     conn.execute("PRAGMA busy_timeout=5000;")
+    conn.execute("PRAGMA temp_store=MEMORY;")
+    conn.execute("PRAGMA mmap_size=268435456;")  # 256MB
+    conn.execute("PRAGMA cache_size=-8000;")     # ~8MB page cache
     return conn
 
 # =========================
 # Data DB
 # =========================
+@st.cache_resource(show_spinner=False)
 def data_db():
+    """Process-wide connection to the data DB (reused across reruns; use under DB_LOCK)."""
     return _connect_db()
+
+@st.cache_resource(show_spinner=False)
+def riona_db_ready() -> bool:
+    """core（リオナ予測DB）のスキーマ作成/移行をプロセスで1回だけ行う"""
+    init_db()
+    return True
+
 def _with_db_retry(fn, *, attempts: int = 3, sleep_s: float = 0.15):
     last = None
     for i in range(attempts):
@@ -908,8 +744,8 @@ def _with_db_retry(fn, *, attempts: int = 3, sleep_s: float = 0.15):
 
 
 def init_data_db():
-    conn = data_db()
-    conn.executescript("""
+    with DB_LOCK:
+        data_db().executescript("""
         CREATE TABLE IF NOT EXISTS snapshots(
             code_hash TEXT NOT NULL,
             kind TEXT NOT NULL,
@@ -926,35 +762,148 @@ def init_data_db():
             result_json TEXT NOT NULL
         );
         CREATE INDEX IF NOT EXISTS idx_records_codehash ON records(code_hash);
+        CREATE INDEX IF NOT EXISTS idx_records_code_kind_id ON records(code_hash, kind, id DESC);
     """)
-    conn.commit()
-    conn.close()
+
+SQL_UPSERT_SNAPSHOT = (
+    "INSERT INTO snapshots(code_hash, kind, updated_at, payload_json) VALUES(?,?,?,?) "
+    "ON CONFLICT(code_hash, kind) DO UPDATE SET updated_at=excluded.updated_at, payload_json=excluded.payload_json"
+)
+SQL_SELECT_SNAPSHOT = "SELECT payload_json FROM snapshots WHERE code_hash=? AND kind=?"
+# 接頭辞は範囲条件で絞る（LIKEは大文字小文字を無視するため主キー(code_hash, kind)の範囲検索にならない）
+SQL_LIST_SNAPSHOT_KINDS = "SELECT kind FROM snapshots WHERE code_hash=? AND kind >= ? AND kind < ? ORDER BY updated_at DESC LIMIT ?"
+SQL_DELETE_SNAPSHOT = "DELETE FROM snapshots WHERE code_hash=? AND kind=?"
+SQL_SET_PROFILE_WEIGHT = (
+    "UPDATE snapshots SET payload_json=json_set(payload_json, '$.weight_kg', ?), updated_at=? "
+    "WHERE code_hash=? AND kind='profile' AND json_valid(payload_json) AND json_type(payload_json)='object'"
+)
+SQL_INSERT_RECORD = "INSERT INTO records(created_at, code_hash, kind, payload_json, result_json) VALUES(?,?,?,?,?)"
+SQL_RECORDS_VERSION = "SELECT MAX(id), COUNT(*) FROM records WHERE code_hash=?"
+SQL_SELECT_RECORDS = "SELECT id, created_at, kind, payload_json, result_json FROM records WHERE code_hash=? ORDER BY id DESC LIMIT ?"
+SQL_RECORDS_VERSION_KIND = "SELECT MAX(id), COUNT(*) FROM records WHERE code_hash=? AND kind=?"
+SQL_SELECT_RECORDS_KIND = (
+    "SELECT id, created_at, kind, payload_json, result_json FROM records "
+    "WHERE code_hash=? AND kind=? ORDER BY id DESC LIMIT ?"
+)
+SQL_DELETE_LATEST_RECORD = (
+    "DELETE FROM records WHERE id = "
+    "(SELECT id FROM records WHERE code_hash=? AND kind=? ORDER BY id DESC LIMIT 1)"
+)
+SQL_DELETE_RECORD = "DELETE FROM records WHERE id=?"
+
+def _orjson_default(o):
+    # numpyのfloat等はfloatのサブクラスだがorjsonは直接扱わないので数値に戻す。それ以外はstr（json版と同じ）
+    if isinstance(o, float):
+        return float(o)
+    return str(o)
+
+def _has_nonfinite(obj) -> bool:
+    """NaN/Inf を含むか（orjson は null にしてしまうので json.dumps 側で NaN のまま書く）"""
+    if isinstance(obj, float):
+        return not math.isfinite(obj)
+    if isinstance(obj, dict):
+        return any(_has_nonfinite(v) for v in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return any(_has_nonfinite(v) for v in obj)
+    if isinstance(obj, np.ndarray) and obj.dtype.kind in "fc":
+        return not bool(np.isfinite(obj).all())
+    if isinstance(obj, np.floating):
+        return not bool(np.isfinite(obj))
+    return False
+
+def _dumps(obj) -> str:
+    if orjson is not None and not _has_nonfinite(obj):
+        try:
+            return orjson.dumps(
+                obj,
+                default=_orjson_default,
+                option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_PASSTHROUGH_DATETIME,
+            ).decode("utf-8")
+        except Exception:
+            pass
+    return json.dumps(obj, ensure_ascii=False, default=str)
+
+def _loads(s):
+    if orjson is not None:
+        try:
+            return orjson.loads(s)
+        except Exception:
+            pass
+    return json.loads(s)
+
+@lru_cache(maxsize=128)
+def _canon_json(items: tuple) -> str:
+    """プロンプト埋め込み用のJSON（キー順固定・空白なし）。同じ入力は同じ文字列になり、AI結果キャッシュが効く"""
+    return json.dumps(dict(items), ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+
+# (code_hash, kind) -> (有効期限, デコード済みスナップショット)。毎rerun読まれるkindだけを対象にする
+# （profile: 体重同期/auto-fill、plan: is_premium、streak_*: バッジ表示）
+# このプロセスからの書き込みは save_snapshot 系で無効化し、他プロセス/外部からの変更は TTL で拾う。
+# 読込→格納と無効化はどちらも DB_LOCK の中で行う（別端末の保存と競合して古い値が残らないように）
+SNAPSHOT_CACHED_KINDS = frozenset({"profile", "plan", "streak_count", "streak_medal", "streak_last_date"})
+SNAPSHOT_CACHE_TTL_S = 60.0
+_SNAPSHOT_CACHE: dict[tuple[str, str], tuple[float, object]] = {}
+
+def _snapshot_cache_drop(code_hash: str, kinds):
+    with DB_LOCK:
+        for kind in kinds:
+            if kind in SNAPSHOT_CACHED_KINDS:
+                _SNAPSHOT_CACHE.pop((code_hash, kind), None)
+            elif kind.startswith("meal_day_"):
+                for key in [k for k in _MEAL_DATES_CACHE if k[0] == code_hash]:
+                    _MEAL_DATES_CACHE.pop(key, None)
 
 def save_snapshot(code_hash: str, kind: str, payload: dict):
+    params = (code_hash, kind, iso(now_jst()), _dumps(payload))
     def _op():
         conn = data_db()
-        try:
-            conn.execute(
-                "INSERT INTO snapshots(code_hash, kind, updated_at, payload_json) VALUES(?,?,?,?) "
-                "ON CONFLICT(code_hash, kind) DO UPDATE SET updated_at=excluded.updated_at, payload_json=excluded.payload_json",
-                (code_hash, kind, iso(now_jst()), json.dumps(payload, ensure_ascii=False, default=str))
-            )
-            conn.commit()
-        finally:
-            conn.close()
-    return _with_db_retry(_op)
+        with conn:
+            conn.execute(SQL_UPSERT_SNAPSHOT, params)
+    try:
+        return _with_db_retry(_op)
+    finally:
+        _snapshot_cache_drop(code_hash, (kind,))
+
+def save_snapshots_many(code_hash: str, items: dict):
+    """Upsert several snapshots {kind: payload} in one transaction (one commit)."""
+    ts = iso(now_jst())
+    params = [(code_hash, kind, ts, _dumps(payload)) for kind, payload in items.items()]
+    if not params:
+        return
+    def _op():
+        conn = data_db()
+        with conn:
+            conn.executemany(SQL_UPSERT_SNAPSHOT, params)
+    try:
+        return _with_db_retry(_op)
+    finally:
+        _snapshot_cache_drop(code_hash, items)
 
-def load_snapshot(code_hash: str, kind: str):
-    conn = data_db()
-    row = conn.execute("SELECT payload_json FROM snapshots WHERE code_hash=? AND kind=?", (code_hash, kind)).fetchone()
-    conn.close()
+def _load_snapshot_db(code_hash: str, kind: str):
+    with DB_LOCK:
+        row = data_db().execute(SQL_SELECT_SNAPSHOT, (code_hash, kind)).fetchone()
     if not row:
         return None
     try:
-        return json.loads(row[0])
+        return _loads(row[0])
     except Exception:
         return None
 
+def load_snapshot(code_hash: str, kind: str):
+    if kind not in SNAPSHOT_CACHED_KINDS:
+        return _load_snapshot_db(code_hash, kind)
+    key = (code_hash, kind)
+    now = time.monotonic()
+    with DB_LOCK:
+        hit = _SNAPSHOT_CACHE.get(key)
+        if hit is not None and hit[0] > now:
+            v = hit[1]
+        else:
+            v = _load_snapshot_db(code_hash, kind)
+            _SNAPSHOT_CACHE[key] = (now + SNAPSHOT_CACHE_TTL_S, v)
+    # 呼び出し側で書き換えてもキャッシュが汚れないようコピーを返す（plan/streak は入れ子の list/dict を持つので深いコピー）
+    return copy.deepcopy(v)
+
 
 
 # =====================
@@ -973,10 +922,6 @@ def _meal_date_key(d) -> str:
 def meal_snapshot_kind(d) -> str:
     return f"meal_day_{_meal_date_key(d)}"
 
-def save_meal_day_snapshot(code_hash: str, d, payload: dict):
-    # payload should include "date" (YYYY-MM-DD)
-    save_snapshot(code_hash, meal_snapshot_kind(d), payload)
-
 def load_meal_day_snapshot(code_hash: str, d):
     return load_snapshot(code_hash, meal_snapshot_kind(d))
 
@@ -997,28 +942,40 @@ def load_meal_day_draft(code_hash: str, d):
 # =====================
 # Log navigation helpers (meal / training)
 # =====================
+def _prefix_upper_bound(prefix: str) -> str:
+    """prefix で始まる文字列がすべて収まる排他的上限（最後の1文字を1つ進める）"""
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
 def list_snapshot_kinds(code_hash: str, kind_prefix: str, limit: int = 500):
     """Return list of snapshot kind strings for a user filtered by prefix."""
-    conn = data_db()
-    rows = conn.execute(
-        "SELECT kind FROM snapshots WHERE code_hash=? AND kind LIKE ? ORDER BY updated_at DESC LIMIT ?",
-        (code_hash, f"{kind_prefix}%", limit)
-    ).fetchall()
-    conn.close()
+    with DB_LOCK:
+        rows = data_db().execute(SQL_LIST_SNAPSHOT_KINDS, (code_hash, kind_prefix, _prefix_upper_bound(kind_prefix), limit)).fetchall()
     return [r[0] for r in rows] if rows else []
 
+# (code_hash, limit) -> (有効期限, 食事ログのある日付)。meal_day_* のスナップショットを書いたら無効化する
+# _SNAPSHOT_CACHE と同じく、読込→格納/無効化は DB_LOCK の中、他プロセスからの変更は TTL で拾う
+_MEAL_DATES_CACHE: dict[tuple[str, int], tuple[float, list]] = {}
+
 def list_meal_saved_dates(code_hash: str, limit: int = 400):
-    # kinds are meal_day_YYYY-MM-DD
-    kinds = list_snapshot_kinds(code_hash, "meal_day_", limit=limit)
-    out = []
-    for k in kinds:
-        try:
-            d = k.replace("meal_day_", "")
-            date.fromisoformat(d)
-            out.append(d)
-        except Exception:
-            pass
-    return sorted(set(out))
+    key = (code_hash, limit)
+    now = time.monotonic()
+    with DB_LOCK:
+        hit = _MEAL_DATES_CACHE.get(key)
+        if hit is not None and hit[0] > now:
+            return list(hit[1])
+        # kinds are meal_day_YYYY-MM-DD
+        kinds = list_snapshot_kinds(code_hash, "meal_day_", limit=limit)
+        out = []
+        for k in kinds:
+            try:
+                d = k.replace("meal_day_", "")
+                date.fromisoformat(d)
+                out.append(d)
+            except Exception:
+                pass
+        out = sorted(set(out))
+        _MEAL_DATES_CACHE[key] = (now + SNAPSHOT_CACHE_TTL_S, out)
+    return list(out)
 
 def render_month_calendar(title: str, month_anchor: date, marked_dates: set[str], key_prefix: str = "cal") -> str | None:
     """Clickable month calendar. Returns clicked date (YYYY-MM-DD) or None."""
@@ -1054,11 +1011,9 @@ def render_month_calendar(title: str, month_anchor: date, marked_dates: set[str]
 
 def list_training_dates(code_hash: str, limit: int = 500):
     """Return sorted unique training dates (YYYY-MM-DD) from records(kind='training_log')."""
-    rows = load_records(code_hash, limit=limit)
+    rows = load_records(code_hash, limit=limit, kind="training_log")
     out = []
     for r in rows:
-        if r.get("kind") != "training_log":
-            continue
         pl = r.get("payload") or {}
         d = pl.get("tr_date")
         if isinstance(d, str) and len(d) >= 10:
@@ -1074,10 +1029,8 @@ def list_training_dates(code_hash: str, limit: int = 500):
 def load_training_by_date(code_hash: str, target_date: date):
     """Load a training_log record for a given date into session_state. Returns True if found."""
     target = target_date.isoformat()
-    rows = load_records(code_hash, limit=800)
+    rows = load_records(code_hash, limit=800, kind="training_log")
     for r in rows:
-        if r.get("kind") != "training_log":
-            continue
         pl = r.get("payload") or {}
         d = pl.get("tr_date")
         if isinstance(d, str) and len(d) >= 10:
@@ -1099,28 +1052,48 @@ def load_training_by_date(code_hash: str, target_date: date):
 WEIGHT_KEYS = ["pf_weight", "meal_weight", "tr_weight", "h_w3"]
 
 def _get_profile_snapshot(code_hash: str) -> dict:
-    return load_snapshot(code_hash, "profile") or {}
+    prof = load_snapshot(code_hash, "profile")  # プロセス内キャッシュ（コピー）から返る
+    return prof if isinstance(prof, dict) else {}
 
 def _get_profile_weight_kg_from_snapshot(prof: dict) -> float:
     for k in ("weight_kg", "weight", "wt"):
         v = prof.get(k)
-        if v is None:
-            continue
-        try:
+        # 保存値はほぼ数値なので例外を使わずに変換（boolは除外）
+        if isinstance(v, (int, float)) and not isinstance(v, bool):
             w = float(v)
-            if 10.0 <= w <= 200.0:
-                return w
-        except Exception:
-            pass
+        elif isinstance(v, str):
+            try:
+                w = float(v.strip().replace(",", "."))
+            except ValueError:
+                continue
+        else:
+            continue
+        if 10.0 <= w <= 200.0:
+            return w
     return 0.0
 
 def _set_profile_weight_kg_in_snapshot(code_hash: str, w: float):
-    prof = _get_profile_snapshot(code_hash)
-    prof["weight_kg"] = float(w)
-    save_snapshot(code_hash, "profile", prof)
-
-def _is_manual(key: str) -> bool:
-    return bool(st.session_state.get(f"{key}__manual", False))
+    # SQLite側(json_set)で weight_kg だけを書き換える（Pythonでの読み出し→デコード→再エンコード不要）
+    w = float(w)
+    ts = iso(now_jst())
+    def _op():
+        conn = data_db()
+        with conn:
+            if conn.execute(SQL_SET_PROFILE_WEIGHT, (w, ts, code_hash)).rowcount == 0:
+                # 未保存・壊れたJSON・NaN入り（SQLiteのjsonでは読めない）・dict以外は、Python側でデコードして書き直す
+                row = conn.execute(SQL_SELECT_SNAPSHOT, (code_hash, "profile")).fetchone()
+                try:
+                    prof = _loads(row[0]) if row else {}
+                except Exception:
+                    prof = {}
+                if not isinstance(prof, dict):
+                    prof = {}
+                prof["weight_kg"] = w
+                conn.execute(SQL_UPSERT_SNAPSHOT, (code_hash, "profile", ts, _dumps(prof)))
+    try:
+        _with_db_retry(_op)
+    finally:
+        _snapshot_cache_drop(code_hash, ("profile",))
 
 def _mark_manual(key: str):
     st.session_state[f"{key}__manual"] = True
@@ -1155,17 +1128,23 @@ def _sync_weight_defaults_before_render(code_hash: str, *, fallback: float = 45.
         w_prof = float(st.session_state.get("profile_weight_kg") or 0) or fallback
 
     # set global weight if not already set
-    if float(st.session_state.get("profile_weight_kg") or 0) <= 0:
-        st.session_state["profile_weight_kg"] = w_prof
-    st.session_state["latest_weight_kg"] = float(st.session_state["profile_weight_kg"])
+    ss = st.session_state
+    w = float(ss.get("profile_weight_kg") or 0)
+    if w <= 0:
+        w = float(w_prof)
+        ss["profile_weight_kg"] = w
+    ss["latest_weight_kg"] = w
 
     # seed widget keys BEFORE they are created (safe). If a key was manually edited, keep it.
     for k in WEIGHT_KEYS:
-        if k not in st.session_state or float(st.session_state.get(k) or 0) <= 0:
-            st.session_state[k] = float(st.session_state["profile_weight_kg"])
-        elif (not _is_manual(k)) and k != "pf_weight":
+        cur = ss.get(k)
+        if cur == w:
+            continue
+        if float(cur or 0) <= 0:
+            ss[k] = w
+        elif (not ss.get(f"{k}__manual", False)) and k != "pf_weight":
             # keep in sync for auto-derived keys
-            st.session_state[k] = float(st.session_state["profile_weight_kg"])
+            ss[k] = w
 
 def _weight_on_change(code_hash: str, key: str, *, write_back_profile: bool = True):
     """on_change callback for weight inputs."""
@@ -1175,27 +1154,62 @@ def _weight_on_change(code_hash: str, key: str, *, write_back_profile: bool = Tr
 
 
 def save_record(code_hash: str, kind: str, payload: dict, result: dict):
+    return save_records_many([(code_hash, kind, payload, result)])
+
+def save_records_many(rows):
+    """Insert several records [(code_hash, kind, payload, result), ...] in one transaction (one commit)."""
+    created_at = iso(now_jst())
+    params = [(created_at, code_hash, kind, _dumps(payload), _dumps(result))
+              for code_hash, kind, payload, result in rows]
+    if not params:
+        return
     def _op():
         conn = data_db()
-        try:
-            conn.execute(
-                "INSERT INTO records(created_at, code_hash, kind, payload_json, result_json) VALUES(?,?,?,?,?)",
-                (iso(now_jst()), code_hash, kind,
-                 json.dumps(payload, ensure_ascii=False, default=str),
-                 json.dumps(result, ensure_ascii=False, default=str))
-            )
-            conn.commit()
-        finally:
-            conn.close()
+        with conn:
+            conn.executemany(SQL_INSERT_RECORD, params)
     return _with_db_retry(_op)
 
-def load_records(code_hash: str, limit: int = 200):
-    conn = data_db()
-    rows = conn.execute(
-        "SELECT id, created_at, kind, payload_json, result_json FROM records WHERE code_hash=? ORDER BY id DESC LIMIT ?",
-        (code_hash, limit)
-    ).fetchall()
-    conn.close()
+def save_batch(code_hash: str, *, records=(), snapshots: dict | None = None, delete_kinds=()):
+    """Write records [(kind, payload, result), ...], upsert snapshots {kind: payload} and delete
+    snapshot kinds for one user in a single transaction (one commit)."""
+    ts = iso(now_jst())
+    rec_params = [(ts, code_hash, kind, _dumps(payload), _dumps(result)) for kind, payload, result in records]
+    snap_params = [(code_hash, kind, ts, _dumps(payload)) for kind, payload in (snapshots or {}).items()]
+    del_params = [(code_hash, kind) for kind in delete_kinds]
+    def _op():
+        conn = data_db()
+        with conn:
+            if rec_params:
+                conn.executemany(SQL_INSERT_RECORD, rec_params)
+            if snap_params:
+                conn.executemany(SQL_UPSERT_SNAPSHOT, snap_params)
+            if del_params:
+                conn.executemany(SQL_DELETE_SNAPSHOT, del_params)
+    try:
+        return _with_db_retry(_op)
+    finally:
+        _snapshot_cache_drop(code_hash, [*(snapshots or {}), *delete_kinds])
+
+def load_records(code_hash: str, limit: int = 200, kind: str | None = None):
+    """Newest-first records for a user. With kind=, filters in SQL (uses idx_records_code_kind_id)."""
+    # (最大id, 件数) が変わらなければ中身も同じ（idは単調増加・レコードは更新しない）ので、
+    # JSONデコード済みの結果をキャッシュから返す
+    with DB_LOCK:
+        if kind is None:
+            max_id, n = data_db().execute(SQL_RECORDS_VERSION, (code_hash,)).fetchone()
+        else:
+            max_id, n = data_db().execute(SQL_RECORDS_VERSION_KIND, (code_hash, kind)).fetchone()
+    if not n:
+        return []
+    return _load_records_cached(code_hash, int(max_id), int(n), int(limit), kind)
+
+@st.cache_data(show_spinner=False, max_entries=256)
+def _load_records_cached(code_hash: str, max_id: int, n_records: int, limit: int, kind: str | None = None):
+    with DB_LOCK:
+        if kind is None:
+            rows = data_db().execute(SQL_SELECT_RECORDS, (code_hash, limit)).fetchall()
+        else:
+            rows = data_db().execute(SQL_SELECT_RECORDS_KIND, (code_hash, kind, limit)).fetchall()
     out = []
     for rid, created_at, kind, p, r in rows:
         try:
@@ -1203,82 +1217,120 @@ def load_records(code_hash: str, limit: int = 200):
                 "id": rid,
                 "created_at": created_at,
                 "kind": kind,
-                "payload": json.loads(p),
-                "result": json.loads(r),
+                "payload": _loads(p),
+                "result": _loads(r),
             })
         except Exception:
             pass
     return out
 
+def load_snapshots_multi(code_hash: str, kinds) -> dict:
+    """Load several snapshots in one query. Returns {kind: payload} (missing/broken kinds are omitted)."""
+    kinds = list(kinds)
+    if not kinds:
+        return {}
+    with DB_LOCK:
+        rows = data_db().execute(
+            f"SELECT kind, payload_json FROM snapshots WHERE code_hash=? AND kind IN ({','.join('?' * len(kinds))})",
+            (code_hash, *kinds)
+        ).fetchall()
+    out = {}
+    for kind, p in rows:
+        try:
+            out[kind] = _loads(p)
+        except Exception:
+            pass
+    return out
+
+def load_latest_records_by_kind(code_hash: str, kinds) -> dict:
+    """Latest record per kind in one query. Returns {kind: record} in the same shape as load_records()."""
+    kinds = list(kinds)
+    if not kinds:
+        return {}
+    with DB_LOCK:
+        rows = data_db().execute(
+            "SELECT id, created_at, kind, payload_json, result_json FROM records r "
+            f"WHERE code_hash=? AND kind IN ({','.join('?' * len(kinds))}) "
+            "AND id = (SELECT MAX(id) FROM records WHERE code_hash=r.code_hash AND kind=r.kind)",
+            (code_hash, *kinds)
+        ).fetchall()
+    out = {}
+    for rid, created_at, kind, p, r in rows:
+        try:
+            out[kind] = {
+                "id": rid,
+                "created_at": created_at,
+                "kind": kind,
+                "payload": _loads(p),
+                "result": _loads(r),
+            }
+        except Exception:
+            pass
+    return out
+
 
 def delete_snapshot(code_hash: str, kind: str) -> None:
     def _op():
         conn = data_db()
-        try:
-            cur = conn.cursor()
-            cur.execute("DELETE FROM snapshots WHERE code_hash=? AND kind=?", (code_hash, kind))
-            conn.commit()
-        finally:
-            conn.close()
-    _with_db_retry(_op)
+        with conn:
+            conn.execute(SQL_DELETE_SNAPSHOT, (code_hash, kind))
+    try:
+        _with_db_retry(_op)
+    finally:
+        _snapshot_cache_drop(code_hash, (kind,))
 
 def delete_record_by_id(record_id: int) -> None:
-    conn = sqlite3.connect(DATA_DB_PATH)
-    cur = conn.cursor()
-    cur.execute("DELETE FROM records WHERE id=?", (int(record_id),))
-    conn.commit()
-    conn.close()
+    def _op():
+        conn = data_db()
+        with conn:
+            conn.execute(SQL_DELETE_RECORD, (int(record_id),))
+    _with_db_retry(_op)
 
 def delete_latest_record(code_hash: str, kind: str) -> bool:
-    conn = sqlite3.connect(DATA_DB_PATH)
-    cur = conn.cursor()
-    cur.execute("SELECT id FROM records WHERE code_hash=? AND kind=? ORDER BY id DESC LIMIT 1", (code_hash, kind))
-    row = cur.fetchone()
-    if not row:
-        conn.close()
-        return False
-    rid = int(row[0])
-    cur.execute("DELETE FROM records WHERE id=?", (rid,))
-    conn.commit()
-    conn.close()
-    return True
+    def _op():
+        conn = data_db()
+        with conn:
+            return conn.execute(SQL_DELETE_LATEST_RECORD, (code_hash, kind)).rowcount > 0
+    return _with_db_retry(_op)
+
+# 保存記録のpayloadキー → 入力欄(session_state)キー
+HEIGHT_UI_TO_PAYLOAD = (
+    ("h_desired","desired_cm"),
+    ("h_alp","alp"), ("h_ba","ba"), ("h_igf1","igf1"),
+    ("h_t","testosterone"), ("h_e2","estradiol"),
+    ("h_y1","h_y1"), ("h_y2","h_y2"), ("h_y3","h_y3"),
+    ("h_w1","w_y1"), ("h_w2","w_y2"), ("h_w3","w_y3"),
+    ("h_date_y1","date_y1"), ("h_date_y2","date_y2"), ("h_date_y3","date_y3"),
+)
+ANEMIA_UI_TO_PAYLOAD = (("sa_hb","hb"), ("sa_ferr","ferritin"), ("sa_fe","fe"), ("sa_tibc","tibc"), ("sa_tsat","tsat"))
+
 def auto_fill_from_latest_records(code_hash: str):
     """基本情報入力後に、最新の保存記録をフォームに自動反映（初回のみ）"""
     if st.session_state.get("_auto_filled", False):
         return
-    rows = load_records(code_hash, limit=200)
-    if not rows:
-        st.session_state["_auto_filled"] = True
-        return
+    # 入力補助なので1セッション1回だけ。DBエラーで失敗しても毎rerun再試行しないよう先にフラグを立てる
+    st.session_state["_auto_filled"] = True
+    # 種類ごとの最新1件だけを取得（全レコードの走査・JSONデコードはしない）
+    latest = load_latest_records_by_kind(code_hash, ["height_result", "sports_anemia", "anemia_baseline"])
 
     # 最新の身長結果
-    for r in rows:
-        if r.get("kind") == "height_result":
-            pl = r.get("payload") or {}
-            # date fields may be string; keep as-is, date_input側でparse
-            for k_map in [
-                ("h_desired","desired_cm"),
-                ("h_alp","alp"), ("h_ba","ba"), ("h_igf1","igf1"),
-                ("h_t","testosterone"), ("h_e2","estradiol"),
-                ("h_y1","h_y1"), ("h_y2","h_y2"), ("h_y3","h_y3"),
-                ("h_w1","w_y1"), ("h_w2","w_y2"), ("h_w3","w_y3"),
-                ("h_date_y1","date_y1"), ("h_date_y2","date_y2"), ("h_date_y3","date_y3"),
-            ]:
-                ui, pk = k_map
-                if pk in pl and pl[pk] not in (None, "") and ui not in st.session_state:
-                    st.session_state[ui] = pl[pk]
-            break
+    r = latest.get("height_result")
+    if r:
+        pl = r.get("payload") or {}
+        # date fields may be string; keep as-is, date_input側でparse
+        for ui, pk in HEIGHT_UI_TO_PAYLOAD:
+            v = pl.get(pk)
+            if v is not None and v != "" and ui not in st.session_state:
+                st.session_state[ui] = v
 
     # 最新の貧血結果（未服用保存）
-    for r in rows:
-        if r.get("kind") in ("sports_anemia","anemia_baseline"):
-            pl = r.get("payload") or {}
-            for ui, pk in [("sa_hb","hb"), ("sa_ferr","ferritin"), ("sa_fe","fe"), ("sa_tibc","tibc"), ("sa_tsat","tsat")]:
-                if pk in pl and pl[pk] not in (None, "") and ui not in st.session_state:
-                    st.session_state[ui] = pl[pk]
-            break
-
-    st.session_state["_auto_filled"] = True
+    anemia = [x for x in (latest.get("sports_anemia"), latest.get("anemia_baseline")) if x]
+    if anemia:
+        pl = max(anemia, key=lambda x: x["id"]).get("payload") or {}
+        for ui, pk in ANEMIA_UI_TO_PAYLOAD:
+            v = pl.get(pk)
+            if v is not None and v != "" and ui not in st.session_state:
+                st.session_state[ui] = v
 
 
 
@@ -1318,8 +1370,15 @@ def save_training_latest(code_hash: str):
     payload = {k: st.session_state.get(k) for k in TRAINING_KEYS}
     if isinstance(payload.get("tr_date"), date):
         payload["tr_date"] = payload["tr_date"].isoformat()
-    save_snapshot(code_hash, "training_latest", payload)
-    save_record(code_hash, "training_log", payload, {"summary":"training_log"})
+    # スナップショット更新とログ追加を1トランザクション（1コミット）で行う
+    ts = iso(now_jst())
+    payload_json = _dumps(payload)
+    def _op():
+        conn = data_db()
+        with conn:
+            conn.execute(SQL_UPSERT_SNAPSHOT, (code_hash, "training_latest", ts, payload_json))
+            conn.execute(SQL_INSERT_RECORD, (ts, code_hash, "training_log", payload_json, _dumps({"summary":"training_log"})))
+    _with_db_retry(_op)
 
 def load_training_latest(code_hash: str) -> bool:
     pl = load_snapshot(code_hash, "training_latest")
@@ -1340,11 +1399,20 @@ def load_training_latest(code_hash: str) -> bool:
 # Shared demographics
 # =========================
 
-def _set_if_empty(k, v):
+# 自動反映する下書き（snapshot kind -> セッションキー）
+AUTO_FILL_DRAFT_KEYS = {
+    "height_draft": ("h_desired","h_date_y1","h_date_y2","h_date_y3","h_y1","h_y2","h_y3","h_w1","h_w2","h_w3","h_alp","h_ba","h_igf1","h_t","h_e2"),
+    "anemia_draft": ("sa_hb","sa_ferr","sa_fe","sa_tibc","sa_tsat","sa_riona","end_current","end_test_type"),
+    "meal_draft": ("meal_goal","meal_intensity","meal_weight","b_c","b_p","b_v","l_c","l_p","l_v","d_c","d_p","d_v"),
+}
+_EMPTY_VALUES = (None, "", 0, 0.0)  # 未入力とみなす値（この値なら自動反映で上書きしてよい）
+
+def _seed_if_empty(seed: dict, k, v):
+    """セッションに入れる値を seed に集める（空の値は入れない・先に入った値を優先）"""
     if v is None or v == "":
         return
-    if k not in st.session_state or st.session_state.get(k) in (None, "", 0, 0.0):
-        st.session_state[k] = v
+    if seed.get(k) in _EMPTY_VALUES:
+        seed[k] = v
 
 def auto_fill_latest_all_tabs(code_hash: str):
     """基本情報入力後に、保存済み最新データを各タブの入力欄へ自動反映（初回のみ）"""
@@ -1354,53 +1422,45 @@ def auto_fill_latest_all_tabs(code_hash: str):
     if not st.session_state.get("dob"):
         return
 
+    seed = {}
     # まず snapshots（下書き）を優先
-    for kind, keys in [
-        ("height_draft", ["h_desired","h_date_y1","h_date_y2","h_date_y3","h_y1","h_y2","h_y3","h_w1","h_w2","h_w3","h_alp","h_ba","h_igf1","h_t","h_e2"]),
-        ("anemia_draft", ["sa_hb","sa_ferr","sa_fe","sa_tibc","sa_tsat","sa_riona","end_current","end_test_type"]),
-        ("meal_draft", ["meal_goal","meal_intensity","meal_weight","b_c","b_p","b_v","l_c","l_p","l_v","d_c","d_p","d_v"]),
-    ]:
-        try:
-            pl = load_snapshot(code_hash, kind)
-        except Exception:
-            pl = None
+    try:
+        drafts = load_snapshots_multi(code_hash, AUTO_FILL_DRAFT_KEYS)
+    except Exception:
+        drafts = {}
+    for kind, keys in AUTO_FILL_DRAFT_KEYS.items():
+        pl = drafts.get(kind)
         if pl:
             for k in keys:
-                _set_if_empty(k, pl.get(k))
+                _seed_if_empty(seed, k, pl.get(k))
 
-    # 次に records（結果）から
-    rows = load_records(code_hash, limit=300)
+    # 次に records（結果）から：種類ごとの最新1件だけを取得
+    latest = load_latest_records_by_kind(code_hash, ["height_result", "sports_anemia", "anemia_baseline", "meal_day"])
     # Height
-    for r in rows:
-        if r.get("kind") == "height_result":
-            pl = r.get("payload") or {}
-            for ui, pk in [
-                ("h_desired","desired_cm"),
-                ("h_alp","alp"), ("h_ba","ba"), ("h_igf1","igf1"),
-                ("h_t","testosterone"), ("h_e2","estradiol"),
-                ("h_y1","h_y1"), ("h_y2","h_y2"), ("h_y3","h_y3"),
-                ("h_w1","w_y1"), ("h_w2","w_y2"), ("h_w3","w_y3"),
-                ("h_date_y1","date_y1"), ("h_date_y2","date_y2"), ("h_date_y3","date_y3"),
-            ]:
-                _set_if_empty(ui, pl.get(pk))
-            break
-    # Anemia
-    for r in rows:
-        if r.get("kind") in ("sports_anemia","anemia_baseline"):
-            pl = r.get("payload") or {}
-            for ui, pk in [("sa_hb","hb"),("sa_ferr","ferritin"),("sa_fe","fe"),("sa_tibc","tibc"),("sa_tsat","tsat")]:
-                _set_if_empty(ui, pl.get(pk))
-            break
+    r = latest.get("height_result")
+    if r:
+        pl = r.get("payload") or {}
+        for ui, pk in HEIGHT_UI_TO_PAYLOAD:
+            _seed_if_empty(seed, ui, pl.get(pk))
+    # Anemia（未服用保存/ベースラインのうち新しい方）
+    anemia = [x for x in (latest.get("sports_anemia"), latest.get("anemia_baseline")) if x]
+    if anemia:
+        pl = max(anemia, key=lambda x: x["id"]).get("payload") or {}
+        for ui, pk in ANEMIA_UI_TO_PAYLOAD:
+            _seed_if_empty(seed, ui, pl.get(pk))
     # Meal latest
-    for r in rows:
-        if r.get("kind") == "meal_day":
-            pl = r.get("payload") or {}
-            _set_if_empty("meal_goal", pl.get("goal"))
-            _set_if_empty("meal_intensity", pl.get("intensity"))
-            _set_if_empty("meal_weight", pl.get("weight"))
-            break
+    r = latest.get("meal_day")
+    if r:
+        pl = r.get("payload") or {}
+        _seed_if_empty(seed, "meal_goal", pl.get("goal"))
+        _seed_if_empty(seed, "meal_intensity", pl.get("intensity"))
+        _seed_if_empty(seed, "meal_weight", pl.get("weight"))
 
-    st.session_state["_auto_filled_all"] = True
+    # 入力済み（空でない）キーは上書きしない。最後に1回だけまとめて反映
+    ss = st.session_state
+    seed = {k: v for k, v in seed.items() if ss.get(k) in _EMPTY_VALUES}
+    seed["_auto_filled_all"] = True
+    ss.update(seed)
 
 def shared_demographics():
     jams_logo_header()
@@ -1429,7 +1489,7 @@ def shared_demographics():
 
     with c3:
         sport = st.selectbox("競技", SPORTS,
-                             index=SPORTS.index(st.session_state.get("sport", SPORTS[0])),
+                             index=SPORT_INDEX.get(st.session_state.get("sport"), 0),
                              key="base_sport")
 
     st.session_state["sex_code"] = "M" if sex_ui.startswith("M") else "F"
@@ -1462,62 +1522,102 @@ def shared_demographics():
 # =========================
 # Curve helpers
 # =========================
-@st.cache_data
-
+@st.cache_resource(show_spinner=False)
 def load_curve():
-    df = pd.read_csv("boys_height_curve.csv")
-    df = df.dropna(subset=["age"]).sort_values("age")
+    # 列はすべて数値なので型推定を省く。CSVは年齢順で保存済みなので、崩れている時だけソートする
+    df = pd.read_csv("boys_height_curve.csv", dtype=float)
+    if df["age"].isna().any():
+        df = df.dropna(subset=["age"])
+    if not df["age"].is_monotonic_increasing:
+        df = df.sort_values("age")
     return df
 
-def interp_curve(df, col: str, age: np.ndarray):
-    ages = df["age"].to_numpy(dtype=float)
-    ys = df[col].to_numpy(dtype=float)
-    aa = np.clip(age, ages.min(), ages.max())
+@lru_cache(maxsize=8)
+def _curve_arrays(col: str):
+    """(ages, values) of the growth curve as float arrays (materialized once per column)."""
+    df = load_curve()
+    # np.interp に連続配列を渡す（DataFrameの列ビューのままにしない）。共有するので読み取り専用
+    ages = np.ascontiguousarray(df["age"].to_numpy(dtype=float))
+    ys = np.ascontiguousarray(df[col].to_numpy(dtype=float))
+    ages.setflags(write=False)
+    ys.setflags(write=False)
+    return ages, ys
+
+def curve_adult_age() -> float:
+    """成長曲線の最終年齢（最終身長を読む年齢）"""
+    return float(_curve_arrays("age")[0][-1])
+
+def interp_curve(col: str, age: np.ndarray):
+    ages, ys = _curve_arrays(col)
+    aa = np.clip(age, ages[0], ages[-1])
     return np.interp(aa, ages, ys)
 
-def fit_shift_offset(df, base_col: str, pts_age, pts_h, delta_shift: float):
+def curve_at(col: str, age: float) -> float:
+    """1点だけの補間（配列を作らずスカラーで返す）"""
+    ages, ys = _curve_arrays(col)
+    return float(np.interp(min(max(age, ages[0]), ages[-1]), ages, ys))
+
+@lru_cache(maxsize=64)
+def _curve_shifted(col: str, s: float) -> np.ndarray:
+    """曲線の各年齢での col の値を s 年ずらして読んだもの（グラフ用）。同じ (col, s) は再計算しない。
+    共有するので読み取り専用で返す（足し算などは新しい配列になる）"""
+    ages, _ = _curve_arrays(col)
+    y = interp_curve(col, ages + s)
+    y.setflags(write=False)
+    return y
+
+def fit_shift_offset(base_col: str, pts_age, pts_h, delta_shift: float):
     s = float(clamp(delta_shift, -2.0, 2.0))
-    res = []
-    for a, h in zip(pts_age, pts_h):
-        y = interp_curve(df, base_col, np.array([a + s]))[0]
-        res.append(h - y)
-    b = float(np.median(res)) if res else 0.0
-    return s, b
-
-def plot_min_max_curves(df, s_min, b_min, s_max, b_max, pts_age, pts_h):
-    ages = df["age"].to_numpy(dtype=float)
-    y_min = interp_curve(df, "late", ages + s_min) + b_min
-    y_max = interp_curve(df, "early", ages + s_max) + b_max
-    chart_df = pd.DataFrame({
-        "age": np.concatenate([ages, ages]),
-        "height_cm": np.concatenate([y_max, y_min]),
-        "curve": (["最大予測カーブ"]*len(ages)) + (["最小予測カーブ"]*len(ages))
-    })
-    line = alt.Chart(chart_df).mark_line().encode(
+    pts_a = np.asarray(pts_age, dtype=float)
+    if pts_a.size == 0:
+        return s, 0.0
+    res = np.asarray(pts_h, dtype=float) - interp_curve(base_col, pts_a + s)
+    return s, float(np.median(res))
+
+CURVE_LABELS = ["最大予測カーブ", "最小予測カーブ"]
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def _minmax_chart_spec(s_min: float, b_min: float, s_max: float, b_max: float, pts_age: tuple, pts_h: tuple) -> dict:
+    """最大/最小予測カーブのVega-Lite spec（同じ入力なら作り直さない）"""
+    ages, _ = _curve_arrays("late")
+    age_l = ages.tolist()
+    y_max = (_curve_shifted("early", s_max) + b_max).tolist()
+    y_min = (_curve_shifted("late", s_min) + b_min).tolist()
+    # DataFrameを経由せず、Vega-Liteに渡すレコードを直接作る（pandas→JSON変換を省く）
+    # y軸の表示範囲外の点も送る（間引くと線が途中で切れる）。はみ出す部分は mark_line(clip=True) で軸の端で切る
+    rows = [{"age": a, "height_cm": y, "curve": CURVE_LABELS[0]} for a, y in zip(age_l, y_max)]
+    rows += [{"age": a, "height_cm": y, "curve": CURVE_LABELS[1]} for a, y in zip(age_l, y_min)]
+    chart = alt.Chart(alt.Data(values=rows)).mark_line(clip=True).encode(
         x=alt.X("age:Q", title="年齢（年）"),
         y=alt.Y("height_cm:Q", title="身長（cm）", scale=alt.Scale(domain=[Y_AXIS_LO, Y_AXIS_HI])),
-        color=alt.Color("curve:N", scale=alt.Scale(domain=["最大予測カーブ","最小予測カーブ"], range=["red","blue"]))
+        color=alt.Color("curve:N", scale=alt.Scale(domain=CURVE_LABELS, range=["red","blue"]))
     ).properties(height=320)
     if pts_age and pts_h:
-        pts = alt.Chart(pd.DataFrame({"age": pts_age, "height_cm": pts_h})).mark_point(size=80).encode(x="age:Q", y="height_cm:Q")
-        st.altair_chart(line+pts, use_container_width=True)
-    else:
-        st.altair_chart(line, use_container_width=True)
+        pts_rows = [{"age": a, "height_cm": h} for a, h in zip(pts_age, pts_h)]
+        chart = chart + alt.Chart(alt.Data(values=pts_rows)).mark_point(size=80).encode(x="age:Q", y="height_cm:Q")
+    return chart.to_dict()
+
+def plot_min_max_curves(s_min, b_min, s_max, b_max, pts_age, pts_h):
+    # 入力は丸めてキャッシュキーにする（表示上の差が出ない桁）
+    spec = _minmax_chart_spec(
+        round(float(s_min), 3), round(float(b_min), 3), round(float(s_max), 3), round(float(b_max), 3),
+        tuple(round(float(a), 3) for a in pts_age), tuple(round(float(h), 3) for h in pts_h),
+    )
+    st.vega_lite_chart(spec, use_container_width=True)
 
 # =========================
 # IGF-1
 # =========================
+# IGF1_RANGES を年齢（1歳刻み 3〜20）ごとの下限・上限の連続配列にしておく
+_IGF1_AGES = np.arange(3, 21, dtype=float)
+_IGF1_LO = {sex: np.array([IGF1_RANGES[sex][a][0] for a in range(3, 21)], dtype=float) for sex in ("M", "F")}
+_IGF1_HI = {sex: np.array([IGF1_RANGES[sex][a][1] for a in range(3, 21)], dtype=float) for sex in ("M", "F")}
+
 def igf1_range_for_age(sex_code: str, age_years: float):
     if age_years < 3 or age_years > 20:
         return None
-    table = IGF1_RANGES["M" if sex_code=="M" else "F"]
-    a0 = int(np.floor(age_years)); a1 = int(np.ceil(age_years))
-    a0 = max(3, min(20, a0)); a1 = max(3, min(20, a1))
-    lo0, hi0 = table[a0]; lo1, hi1 = table[a1]
-    if a0 == a1:
-        return float(lo0), float(hi0)
-    t = (age_years - a0) / (a1 - a0)
-    return float(lo0 + (lo1-lo0)*t), float(hi0 + (hi1-hi0)*t)
+    sex = "M" if sex_code=="M" else "F"
+    return float(np.interp(age_years, _IGF1_AGES, _IGF1_LO[sex])), float(np.interp(age_years, _IGF1_AGES, _IGF1_HI[sex]))
 
 def igf1_classify(sex_code: str, age_years: float, igf1_value: float):
     rng = igf1_range_for_age(sex_code, age_years)
@@ -1534,50 +1634,216 @@ def igf1_classify(sex_code: str, age_years: float, igf1_value: float):
 # =========================
 # OpenAI helpers
 # =========================
+# 429/5xx/接続エラー時はSDKが指数バックオフ（ジッター付き、Retry-Afterも尊重）で再試行する
+OPENAI_MAX_RETRIES = 3
+
+@lru_cache(maxsize=2)
+def _openai_client_for_key(k: str):
+    """APIキーごとに1つのクライアントを使い回す（接続プール/keep-aliveを共有し、毎回のTLSハンドシェイクを避ける）"""
+    from openai import OpenAI
+    try:
+        import httpx
+        try:
+            import h2  # noqa: F401  HTTP/2は h2 が入っているときだけ（並列の写真解析を1本の接続に多重化）
+            http2 = True
+        except ImportError:
+            http2 = False
+        http_client = httpx.Client(
+            limits=httpx.Limits(max_connections=20, max_keepalive_connections=10),
+            timeout=httpx.Timeout(120.0, connect=10.0),
+            http2=http2,
+        )
+    except Exception:
+        http_client = None
+    if http_client is None:
+        return OpenAI(api_key=k, max_retries=OPENAI_MAX_RETRIES)
+    return OpenAI(api_key=k, http_client=http_client, max_retries=OPENAI_MAX_RETRIES)
+
 def openai_client():
     k = (OPENAI_API_KEY or "").strip()
     if not k or k == "sk-REPLACE_ME":
         return None, "OPENAI_API_KEY を設定してください。"
     try:
-        from openai import OpenAI
-        return OpenAI(api_key=k), None
+        return _openai_client_for_key(k), None
     except Exception as e:
         return None, str(e)
 
 
 
-def ai_text(system: str, user: str, *, model: str = "gpt-4.1-mini", temperature: float = 0.3, max_output_tokens: int = 700):
-    """テキスト生成ヘルパー。成功時 (text, None) / 失敗時 ("", err)"""
+# 同じ入力（プロンプト/画像）へのAI応答を再利用するプロセス内LRU。成功時の結果だけを入れる
+AI_RESULT_CACHE_MAX = 128
+AI_RESULT_CACHE_TTL_S = 3600.0  # 1時間で失効（古い応答を使い続けない・メモリを抱え続けない）
+_AI_RESULT_CACHE: "OrderedDict[tuple, tuple[float, object]]" = OrderedDict()
+_AI_RESULT_CACHE_LOCK = threading.Lock()
+
+def _ai_result_get(key: tuple):
+    with _AI_RESULT_CACHE_LOCK:
+        ent = _AI_RESULT_CACHE.get(key)
+        if ent is None:
+            return None
+        if time.monotonic() - ent[0] > AI_RESULT_CACHE_TTL_S:
+            del _AI_RESULT_CACHE[key]
+            return None
+        _AI_RESULT_CACHE.move_to_end(key)
+        return ent[1]
+
+def _ai_result_put(key: tuple, value):
+    with _AI_RESULT_CACHE_LOCK:
+        _AI_RESULT_CACHE[key] = (time.monotonic(), value)
+        _AI_RESULT_CACHE.move_to_end(key)
+        while len(_AI_RESULT_CACHE) > AI_RESULT_CACHE_MAX:
+            _AI_RESULT_CACHE.popitem(last=False)
+
+def ai_text(system: str, user: str, *, model: str = "gpt-4.1-mini", temperature: float = 0.3, max_output_tokens: int = 700, live: bool = False):
+    """テキスト生成ヘルパー。成功時 (text, None) / 失敗時 ("", err)
+    live=True なら生成中の文章をその場に流して表示する（返り値は同じ。表示は完了後に消える）"""
+    ck = ("text", model, temperature, max_output_tokens, system or "", user or "")
+    hit = _ai_result_get(ck)
+    if hit is not None:
+        return hit, None
     client, err = openai_client()
     if err or client is None:
         return "", err or "no client"
+    req = dict(
+        model=model,
+        input=[
+            {"role": "system", "content": [{"type": "input_text", "text": system or ""}]},
+            {"role": "user", "content": [{"type": "input_text", "text": user or ""}]},
+        ],
+        temperature=temperature,
+        max_output_tokens=max_output_tokens,
+    )
     try:
-        resp = client.responses.create(
-            model=model,
-            input=[
-                {"role": "system", "content": [{"type": "input_text", "text": system or ""}]},
-                {"role": "user", "content": [{"type": "input_text", "text": user or ""}]},
-            ],
-            temperature=temperature,
-            max_output_tokens=max_output_tokens,
-        )
-        return (resp.output_text or "").strip(), None
+        if live:
+            text = _ai_text_live(client, req)
+        else:
+            text = (client.responses.create(**req).output_text or "").strip()
+        if text:
+            _ai_result_put(ck, text)
+        return text, None
     except Exception as e:
         return "", str(e)
 
+AI_LIVE_REFRESH_S = 0.15  # ストリーミング表示の更新間隔
 
+def _ai_text_live(client, req: dict) -> str:
+    """ストリーミングで受け取り、届いた分から仮表示する（最初の数百msで読み始められる）"""
+    box = st.empty()
+    parts = []
+    shown = 0.0
+    try:
+        for ev in client.responses.create(stream=True, **req):
+            if ev.type == "response.output_text.delta":
+                parts.append(ev.delta)
+                now = time.monotonic()
+                if now - shown >= AI_LIVE_REFRESH_S:  # 1トークンごとに描き直さない
+                    box.markdown("".join(parts) + " ▌")
+                    shown = now
+            elif ev.type in ("response.failed", "error"):
+                raise RuntimeError(getattr(getattr(ev, "response", None), "error", None) or getattr(ev, "message", "stream error"))
+    finally:
+        box.empty()
+    return "".join(parts).strip()
 
 
-def analyze_meal_photo(img_bytes: bytes, meal_type: str):
-    """
-    食事写真を解析して、量感（少/普/多）と特徴、食事内容の要約を返す。
-    返却: dict {is_food, carb, protein, veg, fat, fried_or_oily, dairy, fruit, items, note, confidence}
-    """
-    client, err = openai_client()
-    if err:
-        return None, err
 
-    prompt = f"""画像が「食事の写真」かどうかをまず判定してください。
+
+MEAL_PHOTO_MODEL = "gpt-4.1-mini"
+
+MEAL_PHOTO_MAX_PX = 1024   # 長辺の上限（これ以上はAIの精度にほぼ効かず、転送とトークンが増えるだけ）
+MEAL_PHOTO_JPEG_QUALITY = 85
+
+def _shrink_meal_photo(img_bytes: bytes) -> bytes:
+    """長辺 MEAL_PHOTO_MAX_PX 以下のJPEGに再エンコードする。Pillowがない/開けない場合は元のまま"""
+    if Image is None:
+        return img_bytes
+    try:
+        with Image.open(io.BytesIO(img_bytes)) as im:
+            is_jpeg = im.format == "JPEG"
+            if is_jpeg and max(im.size) <= MEAL_PHOTO_MAX_PX:
+                return img_bytes
+            im = ImageOps.exif_transpose(im)
+            im.thumbnail((MEAL_PHOTO_MAX_PX, MEAL_PHOTO_MAX_PX), Image.LANCZOS)
+            buf = io.BytesIO()
+            im.convert("RGB").save(buf, "JPEG", quality=MEAL_PHOTO_JPEG_QUALITY, optimize=True)
+        out = buf.getvalue()
+        # HEIC/PNG等は常にJPEGへ（data URLはimage/jpegで送るため）
+        return img_bytes if (is_jpeg and len(img_bytes) <= len(out)) else out
+    except Exception:
+        return img_bytes
+
+MEAL_THUMB_PX = 240  # サムネ（表示幅120pxの2倍：高DPI端末向け）
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def meal_thumb(img_bytes: bytes) -> bytes:
+    """サムネ表示用の小さいJPEG。毎rerunで元の大きな写真（HEIC等）を送らない。Pillowがなければ元のまま"""
+    if Image is None:
+        return img_bytes
+    try:
+        with Image.open(io.BytesIO(img_bytes)) as im:
+            im = ImageOps.exif_transpose(im)
+            im.thumbnail((MEAL_THUMB_PX, MEAL_THUMB_PX))
+            buf = io.BytesIO()
+            im.convert("RGB").save(buf, "JPEG", quality=80)
+        return buf.getvalue()
+    except Exception:
+        return img_bytes
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def prepare_meal_upload(img_bytes: bytes) -> tuple:
+    """アップロード写真を1回だけデコードして (解析用JPEG, サムネJPEG) を作る。
+    HEIC等も以後はJPEGとして扱うので、解析・表示のたびに元データをデコードしない。Pillowがなければ (元, 元)"""
+    if Image is None:
+        return img_bytes, img_bytes
+    try:
+        with Image.open(io.BytesIO(img_bytes)) as src:
+            keep_orig = src.format == "JPEG" and max(src.size) <= MEAL_PHOTO_MAX_PX
+            im = ImageOps.exif_transpose(src).convert("RGB")
+        if keep_orig:
+            main = img_bytes
+        else:
+            im.thumbnail((MEAL_PHOTO_MAX_PX, MEAL_PHOTO_MAX_PX), Image.LANCZOS)
+            buf = io.BytesIO()
+            im.save(buf, "JPEG", quality=MEAL_PHOTO_JPEG_QUALITY, optimize=True)
+            main = buf.getvalue()
+        im.thumbnail((MEAL_THUMB_PX, MEAL_THUMB_PX))
+        buf = io.BytesIO()
+        im.save(buf, "JPEG", quality=80)
+        return main, buf.getvalue()
+    except Exception:
+        return img_bytes, img_bytes
+
+MEAL_UPLOAD_MAX_BYTES = 8 * 1024 * 1024         # 1枚あたりの上限（これを超える写真は読み込まない）
+MEAL_UPLOAD_TOTAL_MAX_BYTES = 48 * 1024 * 1024  # 1回の選択で読み込む合計の上限
+
+def read_meal_uploads(ups) -> list:
+    """file_uploaderの写真を読み込む。大きすぎる写真は getvalue() する前にサイズで弾き、合計も上限で打ち切る"""
+    out = []
+    total = 0
+    for f in ups or []:
+        size = int(getattr(f, "size", 0) or 0)
+        if size > MEAL_UPLOAD_MAX_BYTES:
+            st.warning(f"{f.name} は大きすぎます（{MEAL_UPLOAD_MAX_BYTES // (1024 * 1024)}MBまで）")
+            continue
+        if total + size > MEAL_UPLOAD_TOTAL_MAX_BYTES:
+            st.warning(f"写真の合計サイズが大きすぎるため、{f.name} 以降は読み込みませんでした。")
+            break
+        try:
+            b = f.getvalue()
+        except Exception:
+            b = None
+        if not b:
+            continue
+        total += len(b)
+        out.append(b)
+    return out
+
+def _b64_str(b: bytes) -> str:
+    if pybase64 is not None:
+        return pybase64.b64encode_as_string(b)
+    return base64.b64encode(b).decode("ascii")
+
+MEAL_PHOTO_PROMPT = """画像が「食事の写真」かどうかをまず判定してください。
 食事でない場合は is_food=false とし、他の推定は空 or 低信頼で返してください。
 
 食事の場合:
@@ -1592,33 +1858,171 @@ is_food(boolean), carb, protein, veg, fat("少/普/多"),
 fried_or_oily(boolean), dairy(boolean), fruit(boolean),
 items(array of string), note(string), confidence(number)
 """
-    img_b64 = base64.b64encode(img_bytes).decode("utf-8")
+
+# Structured Outputs のスキーマ（応答はこの形のJSONのみになるので、文字列からの抽出は不要）
+_MEAL_LEVEL_SCHEMA = {"type": "string", "enum": ["少", "普", "多", ""]}
+MEAL_PHOTO_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "is_food": {"type": "boolean"},
+        "carb": _MEAL_LEVEL_SCHEMA,
+        "protein": _MEAL_LEVEL_SCHEMA,
+        "veg": _MEAL_LEVEL_SCHEMA,
+        "fat": _MEAL_LEVEL_SCHEMA,
+        "fried_or_oily": {"type": "boolean"},
+        "dairy": {"type": "boolean"},
+        "fruit": {"type": "boolean"},
+        "items": {"type": "array", "items": {"type": "string"}},
+        "note": {"type": "string"},
+        "confidence": {"type": "number"},
+    },
+    "required": ["is_food", "carb", "protein", "veg", "fat", "fried_or_oily", "dairy", "fruit", "items", "note", "confidence"],
+    "additionalProperties": False,
+}
+# strictモードではトップレベルが object である必要があるので、複数枚は results 配列で包む
+MEAL_PHOTO_BATCH_SCHEMA = {
+    "type": "object",
+    "properties": {"results": {"type": "array", "items": MEAL_PHOTO_SCHEMA}},
+    "required": ["results"],
+    "additionalProperties": False,
+}
+MEAL_PHOTO_MAX_TOKENS = 300  # 1枚あたり（スキーマのJSONは通常150トークン前後）
+
+def _json_format(name: str, schema: dict) -> dict:
+    return {"format": {"type": "json_schema", "name": name, "schema": schema, "strict": True}}
+
+def _meal_photo_cache_key(img_bytes: bytes, meal_type: str) -> tuple:
+    # 同じ写真の再解析はAPIを呼ばずに返す（画像内容のハッシュで判定）
+    return ("meal_photo", MEAL_PHOTO_MODEL, meal_type, hashlib.blake2b(img_bytes, digest_size=16).digest())
+
+@lru_cache(maxsize=16)
+def _meal_image_url(img_bytes: bytes) -> str:
+    """縮小＋base64済みのdata URL。失敗後の再試行や枚数を変えた再解析で同じ写真を作り直さない"""
+    return f"data:image/jpeg;base64,{_b64_str(_shrink_meal_photo(img_bytes))}"
+
+def _meal_image_part(img_bytes: bytes) -> dict:
+    return {"type": "input_image", "image_url": _meal_image_url(img_bytes)}
+
+def _normalize_meal_data(data: dict) -> dict:
+    data.setdefault("is_food", True)
+    data.setdefault("confidence", 0.0)
+    return data
+
+def analyze_meal_photo(img_bytes: bytes, meal_type: str):
+    """
+    食事写真を解析して、量感（少/普/多）と特徴、食事内容の要約を返す。
+    返却: dict {is_food, carb, protein, veg, fat, fried_or_oily, dairy, fruit, items, note, confidence}
+    """
+    ck = _meal_photo_cache_key(img_bytes, meal_type)
+    hit = _ai_result_get(ck)
+    if hit is not None:
+        return dict(hit), None
+    client, err = openai_client()
+    if err:
+        return None, err
+
     try:
         resp = client.responses.create(
-            model="gpt-4.1-mini",
+            model=MEAL_PHOTO_MODEL,
             input=[{
                 "role": "user",
                 "content": [
-                    {"type": "input_text", "text": prompt},
-                    {"type": "input_image", "image_url": f"data:image/jpeg;base64,{img_b64}"},
+                    {"type": "input_text", "text": MEAL_PHOTO_PROMPT},
+                    _meal_image_part(img_bytes),
                 ],
             }],
             temperature=0.2,
-            max_output_tokens=600,
+            max_output_tokens=MEAL_PHOTO_MAX_TOKENS,
+            text=_json_format("meal_photo", MEAL_PHOTO_SCHEMA),
         )
-        text = (resp.output_text or "").strip()
-        # JSON抽出（余計な文字が混じる場合に備える）
-        m = re.search(r'\{.*\}', text, flags=re.S)
-        j = m.group(0) if m else text
-        data = json.loads(j)
-        # normalize
-        data.setdefault("is_food", True)
-        data.setdefault("confidence", 0.0)
+        data = _normalize_meal_data(_loads(resp.output_text or ""))
+        _ai_result_put(ck, dict(data))
         return data, None
     except Exception as e:
         return None, str(e)
 
 
+# 複数枚まとめて解析するときのプロンプト（枚数だけ差し込む）
+MEAL_PHOTO_BATCH_PROMPT = MEAL_PHOTO_PROMPT.replace("{", "{{").replace("}", "}}") + """
+画像は{n}枚あります。画像ごとに上記のJSONオブジェクトを1つずつ作り、
+画像の順番どおりに results 配列に入れて返してください（要素数は{n}）。
+"""
+
+def _analyze_meal_photos_batch(img_list: list[bytes], meal_type: str):
+    """複数枚を1リクエストで解析し、画像ごとのdictのリストを返す。形が合わなければ None"""
+    client, err = openai_client()
+    if err or client is None:
+        return None
+    n = len(img_list)
+    prompt = MEAL_PHOTO_BATCH_PROMPT.format(n=n)
+    try:
+        resp = client.responses.create(
+            model=MEAL_PHOTO_MODEL,
+            input=[{
+                "role": "user",
+                "content": [{"type": "input_text", "text": prompt}] + [_meal_image_part(b) for b in img_list],
+            }],
+            temperature=0.2,
+            max_output_tokens=MEAL_PHOTO_MAX_TOKENS * n,
+            text=_json_format("meal_photos", MEAL_PHOTO_BATCH_SCHEMA),
+        )
+        arr = _loads(resp.output_text or "").get("results")
+    except Exception:
+        return None
+    if not isinstance(arr, list) or len(arr) != n or not all(isinstance(d, dict) for d in arr):
+        return None
+    return [_normalize_meal_data(d) for d in arr]
+
+
+MEAL_AI_MAX_WORKERS = 6  # 同時に投げる写真解析リクエスト数の上限（写真は最大6枚なので全部同時）
+
+def analyze_meal_photos(img_list: list[bytes], meal_type: str) -> list[tuple]:
+    """複数枚の写真を解析する。返却: 入力と同じ順の [(data, err), ...]
+    同じ写真は1回だけ解析し、キャッシュにない写真はまとめて1リクエストで送る。
+    応答が崩れた場合だけ1枚ずつ並列に解析する。"""
+    keys = [_meal_photo_cache_key(b, meal_type) for b in img_list]
+    done: dict = {}
+    todo: dict = {}  # key -> bytes（重複写真は1つにまとめる）
+    for k, b in zip(keys, img_list):
+        if k in done or k in todo:
+            continue
+        hit = _ai_result_get(k)
+        if hit is not None:
+            done[k] = (hit, None)
+        else:
+            todo[k] = b
+
+    if len(todo) > 1:
+        batch = _analyze_meal_photos_batch(list(todo.values()), meal_type)
+        if batch is not None:
+            for k, data in zip(todo, batch):
+                _ai_result_put(k, dict(data))
+                done[k] = (data, None)
+            todo = {}
+
+    if len(todo) == 1:
+        k, b = next(iter(todo.items()))
+        done[k] = analyze_meal_photo(b, meal_type)
+    elif todo:
+        with ThreadPoolExecutor(max_workers=min(MEAL_AI_MAX_WORKERS, len(todo))) as ex:
+            for k, res in zip(todo, ex.map(lambda b: analyze_meal_photo(b, meal_type), todo.values())):
+                done[k] = res
+    # 呼び出し側で書き換えても共有されないよう、dictは1枚ごとにコピーして返す
+    return [(dict(d), e) if d is not None else (d, e) for d, e in (done[k] for k in keys)]
+
+
+MEAL_LEVELS = ("少", "普", "多")
+MEAL_LEVEL_INDEX = {v: i for i, v in enumerate(MEAL_LEVELS)}  # selectboxの初期index用（不明な値は「普」）
+
+def vote_meal_level(c: Counter, default: str = "普") -> str:
+    """少/普/多の多数決。同票は普を優先、少と多の同票は少"""
+    if not c:
+        return default
+    n_lo, n_mid, n_hi = c["少"], c["普"], c["多"]
+    if n_mid >= n_lo and n_mid >= n_hi:
+        return "普"
+    return "少" if n_lo >= n_hi else "多"
+
 def merge_meal_analyses(items: list[dict]) -> dict:
     """
     複数枚の食事写真解析結果を統合する。
@@ -1629,50 +2033,35 @@ def merge_meal_analyses(items: list[dict]) -> dict:
     if not items:
         return {"is_food": False, "confidence": 0.0}
 
-    def vote_level(key: str) -> str:
-        vals = [d.get(key) for d in items if d.get(key) in ("少", "普", "多")]
-        if not vals:
-            return "普"
-        counts = {"少": 0, "普": 0, "多": 0}
-        for v in vals:
-            counts[v] += 1
-        # 同票は普を優先
-        best = max(counts.items(), key=lambda kv: (kv[1], 1 if kv[0] == "普" else 0))[0]
-        return best
-
-    merged = {
-        "is_food": True,
-        "confidence": max(float(d.get("confidence") or 0.0) for d in items),
-        "carb": vote_level("carb"),
-        "protein": vote_level("protein"),
-        "veg": vote_level("veg"),
-        "fat": vote_level("fat"),
-        "fried_or_oily": any(bool(d.get("fried_or_oily")) for d in items),
-        "dairy": any(bool(d.get("dairy")) for d in items),
-        "fruit": any(bool(d.get("fruit")) for d in items),
-    }
-
-    # items を統合（重複除去、順序保持）
-    seen = set()
-    merged_items = []
+    # 1回の走査で票数・フラグ・items を集計
+    votes = {k: Counter() for k in ("carb", "protein", "veg", "fat")}
+    flags = {"fried_or_oily": False, "dairy": False, "fruit": False}
+    conf = 0.0
+    all_items = []
     for d in items:
+        for k, c in votes.items():
+            v = d.get(k)
+            if v in MEAL_LEVELS:
+                c[v] += 1
+        for k in flags:
+            if not flags[k] and d.get(k):
+                flags[k] = True
+        conf = max(conf, float(d.get("confidence") or 0.0))
         lst = d.get("items") or []
         if isinstance(lst, str):
-            lst = [s.strip() for s in lst.split("\n") if s.strip()]
-        for s in lst:
-            s = str(s).strip()
-            if not s or s in seen:
-                continue
-            seen.add(s)
-            merged_items.append(s)
-    merged["items"] = merged_items
+            lst = lst.split("\n")
+        all_items.extend(str(x).strip() for x in lst)
 
-    notes = []
-    for d in items:
-        n = (d.get("note") or "").strip()
-        if n and n not in notes:
-            notes.append(n)
-    merged["note"] = " / ".join(notes)[:500]
+    merged = {"is_food": True, "confidence": conf}
+    for k, c in votes.items():
+        merged[k] = vote_meal_level(c)
+    merged.update(flags)
+
+    # items を統合（重複除去、順序保持）
+    merged["items"] = [x for x in dict.fromkeys(all_items) if x]
+
+    notes = dict.fromkeys((d.get("note") or "").strip() for d in items)
+    merged["note"] = " / ".join(n for n in notes if n)[:500]
 
     return merged
 
@@ -1724,32 +2113,37 @@ def classify_type(delta: float):
         return "delayed", "遅発型"
     return "normal", "正常"
 
+def _load_draft_to_session(code_hash: str, kind: str):
+    """「記入データ読込」の on_click。ウィジェット生成前に走るので、下側のボタンからでも値を入れられる"""
+    payload = load_snapshot(code_hash, kind)
+    if payload:
+        st.session_state.update(payload)
+        st.toast("読み込みました。")
+    else:
+        st.toast("保存データがありません。")
+
+def draft_load_save_buttons(code_hash: str, kind: str, prefix: str, pos: str):
+    """下書き（AUTO_FILL_DRAFT_KEYS のキー）の読込/保存ボタン。ページの上と下で共通"""
+    st.button("記入データ読込", key=f"{prefix}_load_{pos}", on_click=_load_draft_to_session, args=(code_hash, kind))
+    if st.button("保存", key=f"{prefix}_save_{pos}"):
+        ss = st.session_state
+        save_snapshot(code_hash, kind, {k: ss.get(k) for k in AUTO_FILL_DRAFT_KEYS[kind]})
+        st.success("保存しました。")
+
 def height_page(code_hash: str):
     st.subheader("身長予測")
     # load/save buttons adjacent
-    if st.button("記入データ読込", key="h_load_top"):
-        payload = load_snapshot(code_hash, "height_draft")
-        if payload:
-            for k, v in payload.items():
-                st.session_state[k] = v
-            st.success("読み込みました。")
-            st.rerun()
-        else:
-            st.info("保存データがありません。")
-    if st.button("保存", key="h_save_top"):
-        keys = ["h_desired","h_date_y1","h_date_y2","h_date_y3","h_y1","h_y2","h_y3","h_w1","h_w2","h_w3","h_alp","h_ba","h_igf1","h_t","h_e2"]
-        save_snapshot(code_hash, "height_draft", {k: st.session_state.get(k) for k in keys})
-        st.success("保存しました。")
+    draft_load_save_buttons(code_hash, "height_draft", "h", "top")
 
     dob = st.session_state.get("dob")
-    age = float(st.session_state.get("age_years", 0.0) or 0.0)
+    age = ss_float("age_years")
     sex_code = st.session_state.get("sex_code","M")
     if not dob or age <= 0:
         st.error("基本情報（生年月日）を入力してください。")
         return
 
     # default desired 175
-    if ("h_desired" not in st.session_state) or (float(st.session_state.get("h_desired") or 0) <= 100.0):
+    if ("h_desired" not in st.session_state) or (ss_float("h_desired") <= 100.0):
         st.session_state["h_desired"] = 175.0
     desired = st.number_input("将来なりたい身長（cm）", 100.0, 230.0, step=0.1, key="h_desired")
 
@@ -1764,24 +2158,21 @@ def height_page(code_hash: str):
     if igf_rng is not None:
         st.caption(f"IGF-1（自動判定）：{igf_label} / 基準 {igf_rng[0]:.0f}〜{igf_rng[1]:.0f}")
 
-    df = load_curve()
     st.markdown("#### 直近3年（測定日・身長・体重）")
+    # 保存データ由来の文字列日付だけをdateへ（2回目以降のrerunではdateなので何もしない）
+    ss = st.session_state
+    for k in ("h_date_y1", "h_date_y2", "h_date_y3"):
+        if isinstance(ss.get(k), str):
+            v = _parse_date_maybe(ss[k])
+            if v is not None:
+                ss[k] = v
     col1, col2, col3 = st.columns(3)
-    v = _parse_date_maybe(st.session_state.get("h_date_y1"))
-    if v is not None:
-        st.session_state["h_date_y1"] = v
     d1 = col1.date_input("測定日 3年前（任意）", key="h_date_y1")
     h1 = col1.number_input("身長 3年前(cm)", 0.0, 230.0, 0.0, 0.1, key="h_y1")
     w1 = col1.number_input("体重 3年前(kg)", 0.0, 200.0, 0.0, 0.1, key="h_w1")
-    v = _parse_date_maybe(st.session_state.get("h_date_y2"))
-    if v is not None:
-        st.session_state["h_date_y2"] = v
     d2 = col2.date_input("測定日 2年前（任意）", key="h_date_y2")
     h2 = col2.number_input("身長 2年前(cm)", 0.0, 230.0, 0.0, 0.1, key="h_y2")
     w2 = col2.number_input("体重 2年前(kg)", 0.0, 200.0, 0.0, 0.1, key="h_w2")
-    v = _parse_date_maybe(st.session_state.get("h_date_y3"))
-    if v is not None:
-        st.session_state["h_date_y3"] = v
     d3 = col3.date_input("測定日 最新（任意）", key="h_date_y3")
     h3 = col3.number_input("身長 最新(cm)", 0.0, 230.0, 0.0, 0.1, key="h_y3")
     w3 = col3.number_input("体重 最新(kg)", 0.0, 200.0,
@@ -1789,15 +2180,16 @@ def height_page(code_hash: str):
                         step=0.1, key="h_w3",
                         on_change=lambda: _weight_on_change(code_hash, "h_w3", write_back_profile=False))
 
-    pts_age, pts_h = [], []
-    if nz(h1): pts_age.append(max(age-2,0)); pts_h.append(float(h1))
-    if nz(h2): pts_age.append(max(age-1,0)); pts_h.append(float(h2))
-    if nz(h3): pts_age.append(max(age,0)); pts_h.append(float(h3))
-    if not pts_h:
+    # 入力のある測定点だけを配列で取り出す（3年前・2年前・最新）
+    hs = np.array([h1 or 0.0, h2 or 0.0, h3 or 0.0], dtype=float)
+    mask = hs != 0
+    pts_age = np.maximum(age - np.array([2.0, 1.0, 0.0]), 0.0)[mask]
+    pts_h = hs[mask]
+    if pts_h.size == 0:
         st.warning("身長データを入れてください。")
         return
 
-    pred = pts_h[-1]
+    pred = float(pts_h[-1])
     type_code = "normal"
     type_jp = "正常"
     if nz(alp) is not None and float(alp) <= ALP_STOP_THRESHOLD:
@@ -1809,17 +2201,17 @@ def height_page(code_hash: str):
     else:
         delta = float(ba) - age if nz(ba) is not None else 0.0
         type_code, type_jp = classify_type(delta)
-        s_early,b_early = fit_shift_offset(df,"early",pts_age,pts_h,delta)
-        s_late,b_late = fit_shift_offset(df,"late",pts_age,pts_h,delta)
-        adult_age = float(df["age"].max())
-        pred_early = interp_curve(df,"early",np.array([adult_age+s_early]))[0] + b_early
-        pred_late  = interp_curve(df,"late", np.array([adult_age+s_late]))[0] + b_late
+        s_early,b_early = fit_shift_offset("early",pts_age,pts_h,delta)
+        s_late,b_late = fit_shift_offset("late",pts_age,pts_h,delta)
+        adult_age = curve_adult_age()
+        pred_early = curve_at("early", adult_age + s_early) + b_early
+        pred_late  = curve_at("late", adult_age + s_late) + b_late
         pred = pred_early if type_code=="precocious" else (pred_late if type_code=="delayed" else pred_early)
         st.caption(f"予測最終身長レンジ：最大 {max(pred_early,pred_late):.1f} / 最小 {min(pred_early,pred_late):.1f} cm")
         if pred_early >= pred_late:
-            plot_min_max_curves(df, s_late,b_late, s_early,b_early, pts_age,pts_h)
+            plot_min_max_curves(s_late,b_late, s_early,b_early, pts_age,pts_h)
         else:
-            plot_min_max_curves(df, s_early,b_early, s_late,b_late, pts_age,pts_h)
+            plot_min_max_curves(s_early,b_early, s_late,b_late, pts_age,pts_h)
     st.success(f"推定最終身長：{pred:.1f} cm")
     st.write(f"将来なりたい身長との差：{(desired - pred):+.1f} cm")
 
@@ -1837,19 +2229,7 @@ def height_page(code_hash: str):
 
     
     st.divider()
-    if st.button("記入データ読込", key="h_load_bottom"):
-        payload = load_snapshot(code_hash, "height_draft")
-        if payload:
-            for k, v in payload.items():
-                st.session_state[k] = v
-            st.success("読み込みました。")
-            st.rerun()
-        else:
-            st.info("保存データがありません。")
-    if st.button("保存", key="h_save_bottom"):
-        keys = ["h_desired","h_date_y1","h_date_y2","h_date_y3","h_y1","h_y2","h_y3","h_w1","h_w2","h_w3","h_alp","h_ba","h_igf1","h_t","h_e2"]
-        save_snapshot(code_hash, "height_draft", {k: st.session_state.get(k) for k in keys})
-        st.success("保存しました。")
+    draft_load_save_buttons(code_hash, "height_draft", "h", "bottom")
 
     if st.button("結果保存（身長）", key="h_result_save"):
         save_record(code_hash, "height_result", {
@@ -1919,25 +2299,25 @@ def estimate_endurance_gain(test_kind: str, baseline_value: float, hb_now: float
 
     return baseline_value * (1.0 + pct), pct
 
+
+def predict_endurance(cur: float, hb_from: float, hb_to: float):
+    """Hb変化量から持久力記録の伸びを参考推定（pred_value, pct_gain）。"""
+    if cur <= 0 or hb_from <= 0 or hb_to <= 0:
+        return None, None
+    dhb = max(0.0, hb_to - hb_from)
+    pct = min(0.15, 0.03 * dhb)  # 仮係数（後で論文係数へ差替）
+    return cur * (1.0 + pct), pct
+
+ENDURANCE_TEST_OPTS = ("シャトルラン（回数）", "Yo-Yo（距離m）")
+YES_NO_OPTS = ("いいえ", "はい")
+
 def anemia_page(code_hash: str):
     hb_v = ferr_v = fe_v = tibc_v = tsat_val = None
     st.subheader("貧血・リオナ")
-    if st.button("記入データ読込", key="a_load_top"):
-        payload = load_snapshot(code_hash, "anemia_draft")
-        if payload:
-            for k, v in payload.items():
-                st.session_state[k] = v
-            st.success("読み込みました。")
-            st.rerun()
-        else:
-            st.info("保存データがありません。")
-    if st.button("保存", key="a_save_top"):
-        keys = ["sa_hb","sa_ferr","sa_fe","sa_tibc","sa_tsat","sa_riona","end_current","end_test_type"]
-        save_snapshot(code_hash, "anemia_draft", {k: st.session_state.get(k) for k in keys})
-        st.success("保存しました。")
+    draft_load_save_buttons(code_hash, "anemia_draft", "a", "top")
 
     sex_code = st.session_state.get("sex_code","M")
-    age_default = float(st.session_state.get("age_years", 15.0) or 15.0)
+    age_default = ss_float("age_years", 15.0)
     c1,c2,c3,c4,c5 = st.columns(5)
     hb = c1.number_input("Hb", 0.0, 20.0, 0.0, 0.1, key="sa_hb")
     ferr = c2.number_input("Ferritin", 0.0, 1000.0, 0.0, 1.0, key="sa_ferr")
@@ -1946,15 +2326,15 @@ def anemia_page(code_hash: str):
     tsat_override = c5.number_input("TSAT上書き(0=自動)", 0.0, 100.0, 0.0, 0.1, key="sa_tsat")
 
     st.markdown("#### 持久力テスト（任意）")
-    end_test_type = st.selectbox("入力するテスト", ["シャトルラン（回数）", "Yo-Yo（距離m）"], index=0, key="end_test_type")
-    end_current = st.number_input("現在の記録（回数 or 距離）", min_value=0.0, max_value=99999.0, value=float(st.session_state.get("end_current", 0.0) or 0.0), step=1.0, key="end_current")
+    end_test_type = st.selectbox("入力するテスト", ENDURANCE_TEST_OPTS, index=0, key="end_test_type")
+    end_current = st.number_input("現在の記録（回数 or 距離）", min_value=0.0, max_value=99999.0, value=ss_float("end_current"), step=1.0, key="end_current")
     st.caption("※入力は任意。入力すると、Hb改善に伴う伸びを参考推定します（個人差あり）。")
     if st.button("結果保存（持久力）", key="save_endurance_baseline"):
-        save_record(code_hash, "endurance_baseline", {"test": st.session_state.get("end_test_type",""), "current": float(st.session_state.get("end_current",0.0) or 0.0), "hb": float(hb_v or 0.0), "ferritin": float(ferr_v or 0.0), "tsat": float(tsat_val or 0.0)}, {"summary":"endurance_baseline"})
+        save_record(code_hash, "endurance_baseline", {"test": st.session_state.get("end_test_type",""), "current": ss_float("end_current"), "hb": float(hb_v or 0.0), "ferritin": float(ferr_v or 0.0), "tsat": float(tsat_val or 0.0)}, {"summary":"endurance_baseline"})
         st.success("保存しました。")
     hb_v,ferr_v,fe_v,tibc_v = nz(hb),nz(ferr),nz(fe),nz(tibc)
     tsat_val = tsat_from_fe_tibc(fe_v,tibc_v) if tsat_override==0 else float(tsat_override)
-    taking = st.radio("リオナ服用中？", ["いいえ","はい"], horizontal=True, key="sa_riona") == "はい"
+    taking = st.radio("リオナ服用中？", YES_NO_OPTS, horizontal=True, key="sa_riona") == "はい"
 
     if not taking:
         hb_low = 13.0 if sex_code=="M" else 12.0
@@ -1972,19 +2352,7 @@ def anemia_page(code_hash: str):
 
     
     st.divider()
-    if st.button("記入データ読込", key="a_load_bottom"):
-        payload = load_snapshot(code_hash, "anemia_draft")
-        if payload:
-            for k, v in payload.items():
-                st.session_state[k] = v
-            st.success("読み込みました。")
-            st.rerun()
-        else:
-            st.info("保存データがありません。")
-    if st.button("保存", key="a_save_bottom"):
-        keys = ["sa_hb","sa_ferr","sa_fe","sa_tibc","sa_tsat","sa_riona","end_current","end_test_type"]
-        save_snapshot(code_hash, "anemia_draft", {k: st.session_state.get(k) for k in keys})
-        st.success("保存しました。")
+    draft_load_save_buttons(code_hash, "anemia_draft", "a", "bottom")
 
     dose = st.number_input("用量 (mg/day)", value=500, step=50, key="r_dose")
     adherence = st.slider("服薬率", 0.0, 1.0, 0.9, 0.05, key="r_adher")
@@ -1992,7 +2360,7 @@ def anemia_page(code_hash: str):
         if tsat_val is None:
             st.error("TSATの計算に必要なFeとTIBCを入力してください。")
             return
-        init_db()
+        riona_db_ready()
         labs = Labs(hb=float(hb_v or 0), fe=float(fe_v or 0), ferritin=float(ferr_v or 0), tibc=float(tibc_v or 0), tsat=None)
         ctx = Ctx(dose_mg_day=int(dose), adherence=float(adherence), bleed=0.0, inflam=0.0)
         case_id, out = register_case(labs, ctx, note="sports_anemia", external_id="")
@@ -2000,19 +2368,12 @@ def anemia_page(code_hash: str):
         render_riona_output(out)
 
         # ---- 持久力テストの伸び（参考推定）----
-        end_current = float(st.session_state.get("end_current", 0.0) or 0.0)
+        end_current = ss_float("end_current")
         end_test_type = st.session_state.get("end_test_type", "シャトルラン（回数）")
         hb0 = float(hb_v or 0.0)
         hb12 = float((out.get("12w") or {}).get("Hb", hb0) or hb0)
         hb24 = float((out.get("24w") or {}).get("Hb", hb0) or hb0)
 
-        def predict_endurance(cur, hb_from, hb_to):
-            if cur <= 0 or hb_from <= 0 or hb_to <= 0:
-                return None, None
-            dhb = max(0.0, hb_to - hb_from)
-            pct = min(0.15, 0.03 * dhb)  # 仮係数（後で論文係数へ差替）
-            return cur * (1.0 + pct), pct
-
         if end_current > 0 and hb0 > 0:
             p12, pct12 = predict_endurance(end_current, hb0, hb12)
             p24, pct24 = predict_endurance(end_current, hb0, hb24)
@@ -2067,12 +2428,24 @@ def anemia_page(code_hash: str):
                         "hb": hb_m, "fe": fe_m, "ferritin": ferr_m, "tibc": tibc_m
                     }, {"summary":"riona_followup", "out": out2, "auto": res.get("auto_calibration", {})})
 
-def meal_estimate(c_level: str, p_level: str, v_level: str, fried: bool, dairy: bool, fruit: bool):
-    mul = {"少":0.7,"普":1.0,"多":1.3}
+# 食事推定・目標計算で使う係数（呼び出しごとにdictを作らない）
+MEAL_LEVEL_MUL = {"少": 0.7, "普": 1.0, "多": 1.3}
+MEAL_VEG_KCAL = {"多": 80, "普": 50}  # それ以外（少）は20
+MEAL_SHARE = {"b": 0.25, "l": 0.35, "d": 0.40}
+SPORT_FACTOR = {"サッカー": 1.05, "ラグビー": 1.10, "野球": 1.00, "テニス": 1.00, "水泳": 1.08}
+INTENSITY_FACTOR = {"低": 0.95, "中": 1.00, "高": 1.10}
+GOAL_KCAL_FACTOR = {"増量": 1.08, "維持": 1.00, "回復": 1.03}
+GOAL_P_PERKG = {"増量": 1.8, "維持": 1.6, "回復": 2.0}
+MEAL_GOAL_OPTS = ("増量", "維持", "回復", "ダイエット")  # 食事の「目的」の選択肢
+
+@lru_cache(maxsize=256)
+def _meal_estimate_pcfk(c_level: str, p_level: str, v_level: str, fried: bool, dairy: bool, fruit: bool) -> tuple:
+    # 入力は 3*3*3*2*2*2=216 通りしかないので全件キャッシュに収まる
+    mul = MEAL_LEVEL_MUL
     c = 60.0 * mul[c_level]
     p = 30.0 * mul[p_level]
     f = 10.0 * mul[p_level]
-    veg_k = 80 if v_level=="多" else (50 if v_level=="普" else 20)
+    veg_k = MEAL_VEG_KCAL.get(v_level, 20)
     if dairy:
         p += 8; f += 5; c += 10
     if fruit:
@@ -2080,11 +2453,16 @@ def meal_estimate(c_level: str, p_level: str, v_level: str, fried: bool, dairy:
     if fried:
         f += 15; c += 5
     kcal = p*4 + c*4 + f*9 + veg_k
+    return p, c, f, kcal
+
+def meal_estimate(c_level: str, p_level: str, v_level: str, fried: bool, dairy: bool, fruit: bool):
+    # 呼び出し側でキー追加するので、dictは毎回新しく作る
+    p, c, f, kcal = _meal_estimate_pcfk(c_level, p_level, v_level, bool(fried), bool(dairy), bool(fruit))
     return {"p":p,"c":c,"f":f,"kcal":kcal}
 
 def meal_share(prefix: str):
     # Rough split for youth athletes
-    return {"b": 0.25, "l": 0.35, "d": 0.40}.get(prefix, 0.33)
+    return MEAL_SHARE.get(prefix, 0.33)
 
 def rate_meal(prefix: str, est: dict, targets: dict):
     """Return (score:int, status:str, bullets:list[str]) based on kcal/P relative to allocated share."""
@@ -2141,12 +2519,17 @@ def compute_targets_pfc(weight_kg: float, age_years: float, sport: str, intensit
     """
     if weight_kg <= 0:
         return None
+    return dict(_targets_pfc_cached(float(weight_kg), float(age_years), str(sport or ""), str(intensity or ""), str(goal or "")))
+
+@lru_cache(maxsize=256)
+def _targets_pfc_cached(weight_kg: float, age_years: float, sport: str, intensity: str, goal: str) -> dict:
+    # 別ウィジェット操作のrerunでは同じ入力が続くので、係数の引き直しと計算を省く
 
     # ベース（成長期は少し高め、成人はやや低め）
     base = 45.0 if age_years < 12 else (50.0 if age_years < 15 else 48.0)
 
-    sport_factor = {"サッカー": 1.05, "ラグビー": 1.10, "野球": 1.00, "テニス": 1.00, "水泳": 1.08}.get(sport, 1.0)
-    intensity_factor = {"低": 0.95, "中": 1.00, "高": 1.10}.get(intensity, 1.0)
+    sport_factor = SPORT_FACTOR.get(sport, 1.0)
+    intensity_factor = INTENSITY_FACTOR.get(intensity, 1.0)
 
     # まず維持カロリーの粗推定
     maint_kcal = weight_kg * base * sport_factor * intensity_factor
@@ -2164,10 +2547,10 @@ def compute_targets_pfc(weight_kg: float, age_years: float, sport: str, intensit
         p_perkg = 2.0
         f_pct = 0.25
     else:
-        goal_factor = {"増量": 1.08, "維持": 1.00, "回復": 1.03}.get(goal, 1.0)
+        goal_factor = GOAL_KCAL_FACTOR.get(goal, 1.0)
         kcal = maint_kcal * goal_factor
-        p_perkg = {"増量": 1.8, "維持": 1.6, "回復": 2.0}.get(goal, 1.6)
-        f_pct = 0.25 if goal in ["増量", "維持"] else 0.28
+        p_perkg = GOAL_P_PERKG.get(goal, 1.6)
+        f_pct = 0.25 if goal in ("増量", "維持") else 0.28
 
     p_g = p_perkg * weight_kg
     f_g = (kcal * f_pct) / 9.0
@@ -2190,6 +2573,31 @@ def eval_ratio(actual: float, target: float) -> str:
 
 
 
+def _delete_meal_photo(prefix: str):
+    """追加済み写真の削除ボタン（on_click）。選択中の1枚を消し、解析結果もリセットして再解析させる"""
+    ss = st.session_state
+    photo_hash = ss.get(f"{prefix}_del_sel")
+    if not photo_hash:
+        return
+    ss[f"{prefix}_photos_store"] = [x for x in ss.get(f"{prefix}_photos_store") or [] if x.get("hash") != photo_hash]
+    # 選択キーも消す（消した写真のhashが残るとselectboxの選択肢に無い値になる）
+    for k in (f"{prefix}_del_sel", f"{prefix}_ai", f"{prefix}_est", f"{prefix}_comment"):
+        ss.pop(k, None)
+    st.toast("削除しました。")
+
+@lru_cache(maxsize=8)
+def _meal_sel_defaults(prefix: str) -> dict:
+    """meal_block の選択状態の初期値（prefixごとにキー文字列を1回だけ作る）"""
+    return {
+        f"{prefix}_sel_carb": "普",
+        f"{prefix}_sel_protein": "普",
+        f"{prefix}_sel_veg": "普",
+        f"{prefix}_sel_fat": "普",
+        f"{prefix}_sel_fried": False,
+        f"{prefix}_sel_dairy": False,
+        f"{prefix}_sel_fruit": False,
+    }
+
 def meal_block(prefix: str, title: str, enable_photo: bool, targets: dict):
     """
     食事1回分の入力（写真 + ざっくり量選択 + AI推定）
@@ -2200,19 +2608,9 @@ def meal_block(prefix: str, title: str, enable_photo: bool, targets: dict):
     st.markdown(f"#### {title}")
 
     # --- 現在値（ユーザー選択） ---
-    def _init_sel(k: str, default):
-        if k not in st.session_state:
-            st.session_state[k] = default
-
-    _init_sel(f"{prefix}_sel_carb", "普")
-    _init_sel(f"{prefix}_sel_protein", "普")
-    _init_sel(f"{prefix}_sel_veg", "普")
-    _init_sel(f"{prefix}_sel_fat", "普")
-    _init_sel(f"{prefix}_sel_fried", False)
-    _init_sel(f"{prefix}_sel_dairy", False)
-    _init_sel(f"{prefix}_sel_fruit", False)
-
-    img_bytes = None
+    ss = st.session_state
+    for k, v in _meal_sel_defaults(prefix).items():
+        ss.setdefault(k, v)
 
     # --- 写真（任意） ---
     if enable_photo:
@@ -2226,36 +2624,24 @@ def meal_block(prefix: str, title: str, enable_photo: bool, targets: dict):
             # 複数枚サムネ（小さめ）
             cols = st.columns(min(3, len(ups)))
             img_list = []
-            for i, f in enumerate(ups):
-                try:
-                    b = f.getvalue()
-                except Exception:
-                    b = None
-                if not b:
-                    continue
-                img_list.append(b)
+            for i, b in enumerate(read_meal_uploads(ups)):
+                small, thumb = prepare_meal_upload(b)
+                img_list.append(small)
                 with cols[i % len(cols)]:
-                    st.image(b, width=120)
+                    st.image(thumb, width=120)
             # 最初の1枚を代表として拡大表示
             if img_list and st.button("拡大表示", key=f"{prefix}_photo_zoom_grid"):
                 st.image(img_list[0], use_container_width=True)
 
-
-            # 小サムネ（場所を取りすぎない）
-            st.image(img_bytes, caption=None, width=160)
-
-            # 拡大（ページ内）
-            if st.button("拡大表示", key=f"{prefix}_photo_zoom_single"):
-                st.image(img_bytes, caption=None, use_container_width=True)
-
             # AIで初期値セット（写真から、少/普/多を推測）
-            if st.button("AIで写真から初期値セット", key=f"{prefix}_ai_set_btn"):
+            if st.button("AIで写真から初期値セット", key=f"{prefix}_ai_set_btn", disabled=not img_list):
                 if not require_premium_ai(code_hash):
                     return st.session_state.get(est_key) or {"p":0.0,"c":0.0,"f":0.0,"kcal":0.0}
                 # 複数枚の結果をまとめて、少/普/多をざっくり推測
                 results = []
-                for b in img_list:
-                    out1, err1 = analyze_meal_photo(b, title)
+                with st.spinner("AIで解析中..."):
+                    analyzed = analyze_meal_photos(img_list, title)
+                for out1, err1 in analyzed:
                     if err1 or (out1 is None):
                         continue
                     results.append(out1)
@@ -2270,10 +2656,7 @@ def meal_block(prefix: str, title: str, enable_photo: bool, targets: dict):
                     else:
                         # mode（多数決）
                         def _mode(key, default="普"):
-                            vals = [r.get(key) for r in results if r.get(key) in ("少","普","多")]
-                            if not vals:
-                                return default
-                            return max(set(vals), key=vals.count)
+                            return vote_meal_level(Counter(r.get(key) for r in results if r.get(key) in MEAL_LEVELS), default)
                         st.session_state[f"{prefix}_sel_carb"] = _mode("carb", st.session_state[f"{prefix}_sel_carb"])
                         st.session_state[f"{prefix}_sel_protein"] = _mode("protein", st.session_state[f"{prefix}_sel_protein"])
                         st.session_state[f"{prefix}_sel_veg"] = _mode("veg", st.session_state[f"{prefix}_sel_veg"])
@@ -2313,18 +2696,18 @@ def meal_block(prefix: str, title: str, enable_photo: bool, targets: dict):
     st.caption("写真だけで伝わりにくい時は、下の「少/普/多」でざっくり補正してください。")
     c1, c2 = st.columns(2)
     with c1:
-        carb = st.selectbox("主食（ごはん/パン/麺）", ["少", "普", "多"],
-                            index=["少", "普", "多"].index(st.session_state[f"{prefix}_sel_carb"]),
+        carb = st.selectbox("主食（ごはん/パン/麺）", MEAL_LEVELS,
+                            index=MEAL_LEVEL_INDEX.get(st.session_state[f"{prefix}_sel_carb"], 1),
                             key=f"{prefix}_sel_carb")
-        protein = st.selectbox("主菜（肉/魚/卵/豆）", ["少", "普", "多"],
-                               index=["少", "普", "多"].index(st.session_state[f"{prefix}_sel_protein"]),
+        protein = st.selectbox("主菜（肉/魚/卵/豆）", MEAL_LEVELS,
+                               index=MEAL_LEVEL_INDEX.get(st.session_state[f"{prefix}_sel_protein"], 1),
                                key=f"{prefix}_sel_protein")
-        veg = st.selectbox("野菜", ["少", "普", "多"],
-                           index=["少", "普", "多"].index(st.session_state[f"{prefix}_sel_veg"]),
+        veg = st.selectbox("野菜", MEAL_LEVELS,
+                           index=MEAL_LEVEL_INDEX.get(st.session_state[f"{prefix}_sel_veg"], 1),
                            key=f"{prefix}_sel_veg")
     with c2:
-        fat = st.selectbox("油もの（揚げ物/マヨ/ドレ）", ["少", "普", "多"],
-                           index=["少", "普", "多"].index(st.session_state[f"{prefix}_sel_fat"]),
+        fat = st.selectbox("油もの（揚げ物/マヨ/ドレ）", MEAL_LEVELS,
+                           index=MEAL_LEVEL_INDEX.get(st.session_state[f"{prefix}_sel_fat"], 1),
                            key=f"{prefix}_sel_fat")
         fried = st.toggle("揚げ物・油多め", value=bool(st.session_state[f"{prefix}_sel_fried"]), key=f"{prefix}_sel_fried")
         dairy = st.toggle("乳製品あり", value=bool(st.session_state[f"{prefix}_sel_dairy"]), key=f"{prefix}_sel_dairy")
@@ -2377,11 +2760,14 @@ def estimate_macros_from_levels(ai_levels: dict, weight_kg: float, goal: str) ->
     """
     if not isinstance(ai_levels, dict):
         ai_levels = {}
-    carb = ai_levels.get("carb", "普") if ai_levels.get("carb") in ("少", "普", "多") else "普"
-    protein = ai_levels.get("protein", "普") if ai_levels.get("protein") in ("少", "普", "多") else "普"
-    veg = ai_levels.get("veg", "普") if ai_levels.get("veg") in ("少", "普", "多") else "普"
+    def _lv(k):
+        v = ai_levels.get(k)
+        return v if v in MEAL_LEVEL_INDEX else "普"
+    carb = _lv("carb")
+    protein = _lv("protein")
+    veg = _lv("veg")
     # fat は meal_estimate では直接の係数に使っていないが、隠しUIで調整するので保持する
-    fat_level = ai_levels.get("fat", "普") if ai_levels.get("fat") in ("少", "普", "多") else "普"
+    fat_level = _lv("fat")
     fried = bool(ai_levels.get("fried_or_oily") or ai_levels.get("fried"))
     dairy = bool(ai_levels.get("dairy"))
     fruit = bool(ai_levels.get("fruit"))
@@ -2418,8 +2804,7 @@ def _meal_ui(prefix: str, title: str, targets: dict, allow_school: bool = False)
     comment_key = f"{prefix}_comment"
     last_batch_key = f"{prefix}_last_batch_id"
 
-    if photos_key not in st.session_state:
-        st.session_state[photos_key] = []
+    st.session_state.setdefault(photos_key, [])
 
     # 昼のみ：給食チェック
     if allow_school:
@@ -2427,7 +2812,7 @@ def _meal_ui(prefix: str, title: str, targets: dict, allow_school: bool = False)
         if is_school:
             st.info("給食の日はチェックのみでOKです。必要なら後から写真を追加できます。")
             # 給食は簡易テンプレ（年齢でざっくり）
-            age_years = float(st.session_state.get("age_years") or 12.0)
+            age_years = ss_float("age_years", 12.0)
             est = kyushoku_template(age_years)
             st.session_state[est_key] = {"p": est["p"], "c": est["c"], "f": est["f"], "kcal": est["kcal"], "menu": "school", "items": ["給食"], "note": "給食（写真なし）", "levels": {}}
 
@@ -2462,13 +2847,7 @@ def _meal_ui(prefix: str, title: str, targets: dict, allow_school: bool = False)
 
         staged = []
         if ups:
-            for f in ups:
-                try:
-                    b = f.getvalue()
-                except Exception:
-                    b = None
-                if not b:
-                    continue
+            for b in read_meal_uploads(ups):
                 h = hashlib.sha1(b).hexdigest()
                 staged.append((h, b))
 
@@ -2498,7 +2877,9 @@ def _meal_ui(prefix: str, title: str, targets: dict, allow_school: bool = False)
                 for h, b in staged:
                     if h in existing_hashes:
                         continue
-                    new_items.append({"hash": h, "bytes": b})
+                    # 元の写真（数MBのHEIC等）は持たず、解析用の縮小JPEGとサムネだけをセッションに保持
+                    small, thumb = prepare_meal_upload(b)
+                    new_items.append({"hash": h, "bytes": small, "thumb": thumb})
                 if new_items:
                     st.session_state[photos_key].extend(new_items)
                     # 最新6枚まで
@@ -2513,17 +2894,17 @@ def _meal_ui(prefix: str, title: str, targets: dict, allow_school: bool = False)
         if photos:
             st.caption("追加済み写真（小サムネ）")
             cols = st.columns(min(3, len(photos)))
-            for i, p in enumerate(list(photos)):
+            for i, p in enumerate(photos):
                 with cols[i % len(cols)]:
-                    st.image(p["bytes"], width=120)
-                    if st.button("削除", key=f"{prefix}_del_{p['hash']}"):
-                        st.session_state[photos_key] = [x for x in st.session_state[photos_key] if x.get("hash") != p["hash"]]
-                        # 解析結果はリセット（再解析）
-                        st.session_state.pop(ai_key, None)
-                        st.session_state.pop(est_key, None)
-                        st.session_state.pop(comment_key, None)
-                        st.success("削除しました。")
-                        st.rerun()
+                    st.image(p.get("thumb") or meal_thumb(p["bytes"]), width=120, caption=f"{i + 1}枚目")
+            # 削除は写真ごとのボタンではなく、選択＋ボタン1つ（ウィジェット数を枚数によらず2つに）
+            photo_no = {p["hash"]: i + 1 for i, p in enumerate(photos)}
+            cD, cE = st.columns([2, 1])
+            with cD:
+                st.selectbox("削除する写真", list(photo_no), format_func=lambda h: f"{photo_no.get(h, '?')}枚目", key=f"{prefix}_del_sel")
+            with cE:
+                # on_click はrerun前に実行されるので、このrunの描画にはもう出ない（st.rerun()不要）
+                st.button("削除", key=f"{prefix}_del_btn", on_click=_delete_meal_photo, args=(prefix,))
         else:
             st.caption("写真を選んだあと「選択した写真を追加」を押すとサムネが出ます。")
 
@@ -2535,8 +2916,7 @@ def _meal_ui(prefix: str, title: str, targets: dict, allow_school: bool = False)
                 valid = []
                 last_err = None
                 with st.spinner("AIで解析中..."):
-                    for b in img_bytes_list:
-                        out1, err1 = analyze_meal_photo(b, title)
+                    for out1, err1 in analyze_meal_photos(img_bytes_list, title):
                         if err1:
                             last_err = err1
                             continue
@@ -2592,10 +2972,10 @@ def _meal_ui(prefix: str, title: str, targets: dict, allow_school: bool = False)
         # ---- 変更・追加（隠しUI） ----
         with st.expander("変更・追加（必要なときだけ）"):
             lv = (est.get("levels") or {}) if isinstance(est, dict) else {}
-            carb = st.selectbox("主食の量", ["少", "普", "多"], index=["少", "普", "多"].index(lv.get("carb", "普")), key=f"{prefix}_adj_carb")
-            protein = st.selectbox("主菜の量", ["少", "普", "多"], index=["少", "普", "多"].index(lv.get("protein", "普")), key=f"{prefix}_adj_protein")
-            veg = st.selectbox("野菜の量", ["少", "普", "多"], index=["少", "普", "多"].index(lv.get("veg", "普")), key=f"{prefix}_adj_veg")
-            fat = st.selectbox("脂質（全体）", ["少", "普", "多"], index=["少", "普", "多"].index(lv.get("fat", "普")), key=f"{prefix}_adj_fat")
+            carb = st.selectbox("主食の量", MEAL_LEVELS, index=MEAL_LEVEL_INDEX.get(lv.get("carb", "普"), 1), key=f"{prefix}_adj_carb")
+            protein = st.selectbox("主菜の量", MEAL_LEVELS, index=MEAL_LEVEL_INDEX.get(lv.get("protein", "普"), 1), key=f"{prefix}_adj_protein")
+            veg = st.selectbox("野菜の量", MEAL_LEVELS, index=MEAL_LEVEL_INDEX.get(lv.get("veg", "普"), 1), key=f"{prefix}_adj_veg")
+            fat = st.selectbox("脂質（全体）", MEAL_LEVELS, index=MEAL_LEVEL_INDEX.get(lv.get("fat", "普"), 1), key=f"{prefix}_adj_fat")
             fried = st.checkbox("揚げ物/油っぽい", value=bool(lv.get("fried", False)), key=f"{prefix}_adj_fried")
             dairy = st.checkbox("乳製品あり", value=bool(lv.get("dairy", False)), key=f"{prefix}_adj_dairy")
             fruit = st.checkbox("果物あり", value=bool(lv.get("fruit", False)), key=f"{prefix}_adj_fruit")
@@ -2613,6 +2993,20 @@ def _meal_ui(prefix: str, title: str, targets: dict, allow_school: bool = False)
     return {"p": 0.0, "c": 0.0, "f": 0.0, "kcal": 0.0}
 
 
+# 合計メトリクスの並び: (ラベル, totalのキー, targetsのキー, 旧形式targetsのキー)
+MEAL_TOTAL_METRICS = (
+    ("kcal", "kcal", "kcal", "kcal"),
+    ("タンパク質(g)", "p", "p", "p_g"),
+    ("炭水化物(g)", "c", "c", "c_g"),
+    ("脂質(g)", "f", "f", "f_g"),
+)
+
+def meal_total_metrics(total: dict, targets: dict):
+    """1日の合計と目標との差を4列のmetricで表示（今日の合計・保存済みログの復元で共通）"""
+    for col, (label, k, tk, tk_old) in zip(st.columns(4), MEAL_TOTAL_METRICS):
+        v = float(total.get(k) or 0)
+        col.metric(label, f"{v:.0f}", delta=f"{v - float(targets.get(tk, targets.get(tk_old, 0)) or 0):+.0f}")
+
 def meal_page(code_hash: str):
     st.subheader("🍽️ 食事管理（写真→AI解析）")
     st.caption("朝・昼・夕の写真をアップロードして、AIが内容を推測してフィードバックします（目安）。昼が給食の場合はチェックのみ。")
@@ -2693,7 +3087,7 @@ def meal_page(code_hash: str):
             pass
 
 
-    goal = st.selectbox("目的", ["増量", "維持", "回復", "ダイエット"], key="meal_goal", index=1)
+    goal = st.selectbox("目的", MEAL_GOAL_OPTS, key="meal_goal", index=1)
     targets = calc_daily_targets(w, goal)
 
     # ---- 今日の保存済み食事ログ（表示のみ：ログアウトしても残ります）----
@@ -2704,11 +3098,7 @@ def meal_page(code_hash: str):
             st.write("※ 写真は復元しません（容量・安定性のため）。AI推定結果とコメント、合計は復元します。")
             total_s = (snap_base.get("total") or {})
             targets_s = (snap_base.get("targets") or {})
-            c1, c2, c3, c4 = st.columns(4)
-            c1.metric("kcal", f"{float(total_s.get('kcal',0)):.0f}", delta=f"{(float(total_s.get('kcal',0))-float(targets_s.get('kcal',0))):+.0f}")
-            c2.metric("タンパク質(g)", f"{float(total_s.get('p',0)):.0f}", delta=f"{(float(total_s.get('p',0))-float(targets_s.get('p',targets_s.get('p_g',0)))):+.0f}")
-            c3.metric("炭水化物(g)", f"{float(total_s.get('c',0)):.0f}", delta=f"{(float(total_s.get('c',0))-float(targets_s.get('c',targets_s.get('c_g',0)))):+.0f}")
-            c4.metric("脂質(g)", f"{float(total_s.get('f',0)):.0f}", delta=f"{(float(total_s.get('f',0))-float(targets_s.get('f',targets_s.get('f_g',0)))):+.0f}")
+            meal_total_metrics(total_s, targets_s)
 
             # 各食事のAIコメント（保存済み）を表示
             for pref, title in [("b", "朝食"), ("l", "昼食"), ("d", "夕食")]:
@@ -2723,7 +3113,7 @@ def meal_page(code_hash: str):
                     items = ai_val.get("items") or []
                     def _lv(k):
                         v = ai_val.get(k)
-                        return v if v in ("少","普","多") else None
+                        return v if v in MEAL_LEVELS else None
                     lv_c = _lv("carb"); lv_p = _lv("protein"); lv_v = _lv("veg"); lv_f = _lv("fat")
                     parts = []
                     if any([lv_c, lv_p, lv_v, lv_f]):
@@ -2794,20 +3184,12 @@ def meal_page(code_hash: str):
     with tabs[2]:
         d = _meal_ui("d", "夕食", targets, allow_school=False)
 
-    total = {
-        "p": float(b.get("p", 0)) + float(l.get("p", 0)) + float(d.get("p", 0)),
-        "c": float(b.get("c", 0)) + float(l.get("c", 0)) + float(d.get("c", 0)),
-        "f": float(b.get("f", 0)) + float(l.get("f", 0)) + float(d.get("f", 0)),
-        "kcal": float(b.get("kcal", 0)) + float(l.get("kcal", 0)) + float(d.get("kcal", 0)),
-    }
+    meals = (b, l, d)
+    total = {k: sum(float(m.get(k) or 0) for m in meals) for k in ("p", "c", "f", "kcal")}
 
     st.divider()
     st.markdown("### 今日の合計（目安）")
-    c1, c2, c3, c4 = st.columns(4)
-    c1.metric("kcal", f"{total['kcal']:.0f}", delta=f"{(total['kcal'] - targets.get('kcal', 0)):+.0f}")
-    c2.metric("タンパク質(g)", f"{total['p']:.0f}", delta=f"{(total['p'] - targets.get('p', targets.get('p_g', 0))):+.0f}")
-    c3.metric("炭水化物(g)", f"{total['c']:.0f}", delta=f"{(total['c'] - targets.get('c', targets.get('c_g', 0))):+.0f}")
-    c4.metric("脂質(g)", f"{total['f']:.0f}", delta=f"{(total['f'] - targets.get('f', targets.get('f_g', 0))):+.0f}")
+    meal_total_metrics(total, targets)
 
     cA, cB = st.columns(2)
     with cA:
@@ -2837,9 +3219,8 @@ def meal_page(code_hash: str):
     with cB:
         if st.button("今日の食事ログを保存", key="meal_save_simple"):
             try:
-                save_record(code_hash, "meal_log", {"date": _meal_date_key(meal_date), "b": b, "l": l, "d": d, "total": total, "targets": targets}, {"summary": "meal_log"})
                 # 今日のログ（AI推定・コメント・合計）をスナップショットに保存（ログアウトしても復元可）
-                save_meal_day_snapshot(code_hash, meal_date, {
+                day_snapshot = {
                     "date": _meal_date_key(meal_date),
                     "meal_goal": goal,
                     "meal_weight": float(st.session_state.get("meal_weight") or w),
@@ -2863,10 +3244,10 @@ def meal_page(code_hash: str):
                         "comment": st.session_state.get("d_comment"),
                         "school": bool(st.session_state.get("d_school") or False),
                     },
-                })
-    
+                }
+
                 # 旧来の簡易復元（フォーム用のフラットキー）も保存
-                save_snapshot(code_hash, "meal_draft", {
+                flat_draft = {
                     "meal_goal": goal,
                     "meal_weight": float(st.session_state.get("meal_weight") or w),
                     "meal_intensity": st.session_state.get("meal_intensity"),
@@ -2879,18 +3260,82 @@ def meal_page(code_hash: str):
                     "d_c": st.session_state.get("d_c"),
                     "d_p": st.session_state.get("d_p"),
                     "d_v": st.session_state.get("d_v"),
-                })
-    
+                }
+
+                # ログ追加・スナップショット2件・下書き削除を1トランザクションで
+                save_batch(
+                    code_hash,
+                    records=[("meal_log", {"date": _meal_date_key(meal_date), "b": b, "l": l, "d": d, "total": total, "targets": targets}, {"summary": "meal_log"})],
+                    snapshots={meal_snapshot_kind(meal_date): day_snapshot, "meal_draft": flat_draft},
+                    delete_kinds=[meal_draft_kind(meal_date)],
+                )
                 update_streak_on_save(code_hash)
-                try:
-                    delete_snapshot(code_hash, meal_draft_kind(meal_date))
-                except Exception:
-                    pass
                 st.success("保存しました。")
             except Exception as e:
                 st.error(f"保存に失敗: {e}")
 
 
+# iCalendarのTEXTエスケープ（\\ ; , 改行）を1パスで行う
+_ICS_TRANSLATE = str.maketrans({"\\": "\\\\", ";": "\\;", ",": "\\,", "\n": "\\n"})
+
+def _ics_escape(s) -> str:
+    return str(s or "").translate(_ICS_TRANSLATE)
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def training_log_exports(code_hash: str, record_ids: tuple, _recs: list):
+    """トレーニング記録 → (表示用DataFrame, CSV bytes, ics bytes, 日付候補, 月候補)。
+    キャッシュキーは (code_hash, record_ids)。_recs はハッシュしない（idが同じなら中身も同じ）"""
+    recs = _recs
+    # 行ごとのdictは作らず、列ごとのリストからDataFrameを組む（記録0件でも列はそろう）
+    pls = [r.get("payload") or {} for r in recs]
+    df = pd.DataFrame({
+        "date": [str(pl.get("tr_date", "")) for pl in pls],
+        "type": [str(pl.get("tr_type", "")) for pl in pls],
+        "duration_min": [pl.get("tr_duration", "") for pl in pls],
+        "rpe": [pl.get("tr_rpe", "") for pl in pls],
+        "goal": [pl.get("tr_goal_text", pl.get("tr_focus", "")) or "" for pl in pls],
+        "notes": [str(pl.get("tr_notes", "")) for pl in pls],
+    })
+    csv_bytes = df.to_csv(index=False).encode("utf-8-sig")
+
+    # iCalendar (.ics)
+    ics_lines = ["BEGIN:VCALENDAR", "VERSION:2.0", "PRODID:-//Kiwi//TrainingLog//JA"]
+    for r, pl in zip(recs, pls):
+        d = str(pl.get("tr_date", ""))
+        if not d:
+            continue
+        try:
+            y, m, dd = [int(x) for x in d.split("-")]
+            dt = datetime(y, m, dd, 9, 0, tzinfo=JST)
+        except Exception:
+            continue
+        summary = f"TR: {pl.get('tr_type','')}"
+        desc = f"{pl.get('tr_duration','')}分 / RPE{pl.get('tr_rpe','')}\n{pl.get('tr_notes','')}"
+        uid = f"{r.get('id','')}-{code_hash}@kiwi"
+        ts = dt.strftime('%Y%m%dT%H%M%S')
+        ics_lines.extend((
+            "BEGIN:VEVENT",
+            f"UID:{_ics_escape(uid)}",
+            f"DTSTAMP:{ts}Z",
+            f"DTSTART:{ts}",
+            f"SUMMARY:{_ics_escape(summary)}",
+            f"DESCRIPTION:{_ics_escape(desc)}",
+            "END:VEVENT",
+        ))
+    ics_lines.append("END:VCALENDAR")
+    ics_bytes = "\n".join(ics_lines).encode("utf-8")
+
+    # 削除用の日付候補・カレンダーの月候補（新しい順）も一緒に作っておく
+    date_opts = sorted({d for d in df["date"] if d}, reverse=True) if len(df) else []
+    month_opts = sorted({d[:7] for d in date_opts if len(d) >= 7}, reverse=True)
+    return df, csv_bytes, ics_bytes, date_opts, month_opts
+
+
+# 主目的の選択肢（プリセット＋自由入力）と逆引きindex
+TRAINING_GOAL_OTHER = "その他（自由入力）"
+TRAINING_GOAL_OPTS = ("スプリント", "当たり負け改善", "持久力", "低酸素トレーニング", "リカバリー", "技術練習", TRAINING_GOAL_OTHER)
+TRAINING_GOAL_IDX = {v: i for i, v in enumerate(TRAINING_GOAL_OPTS)}
+
 def exercise_prescription_page(code_hash: str):
     st.subheader("🏋️ 運動処方")
     render_streak_medal(code_hash)
@@ -2944,15 +3389,10 @@ def exercise_prescription_page(code_hash: str):
         )
         st.slider("主観的きつさ（RPE 1-10）", 1, 10, int(st.session_state.get("tr_rpe", 5) or 5), key="tr_rpe")
                 # 主目的（プリセット＋自由入力）
-        goal_opts = ["スプリント", "当たり負け改善", "持久力", "低酸素トレーニング", "リカバリー", "技術練習", "その他（自由入力）"]
         cur_goal = (st.session_state.get("tr_goal_text") or "").strip()
-        default_idx = 0
-        if cur_goal in goal_opts:
-            default_idx = goal_opts.index(cur_goal)
-        elif cur_goal:
-            default_idx = goal_opts.index("その他（自由入力）")
-        goal_sel = st.selectbox("主目的", goal_opts, index=default_idx, key="tr_goal_sel")
-        if goal_sel == "その他（自由入力）":
+        default_idx = TRAINING_GOAL_IDX.get(cur_goal, TRAINING_GOAL_IDX[TRAINING_GOAL_OTHER] if cur_goal else 0)
+        goal_sel = st.selectbox("主目的", TRAINING_GOAL_OPTS, index=default_idx, key="tr_goal_sel")
+        if goal_sel == TRAINING_GOAL_OTHER:
             st.text_input("主目的（自由入力）", value=cur_goal, key="tr_goal_text")
         else:
             st.session_state["tr_goal_text"] = goal_sel
@@ -2993,8 +3433,7 @@ def exercise_prescription_page(code_hash: str):
                     st.error(f"削除に失敗: {e}")
         with cC:
             try:
-                hist = load_records(code_hash, limit=30)
-                hist = [h for h in hist if h.get("kind")=="training_log"][:5]
+                hist = load_records(code_hash, limit=5, kind="training_log")
             except Exception:
                 hist = []
             if hist:
@@ -3007,31 +3446,19 @@ def exercise_prescription_page(code_hash: str):
     # ---- 端末保存（CSV/カレンダー） ----
     with st.expander("📱 トレーニング記録を端末に保存／カレンダーで見る", expanded=False):
         try:
-            recs = load_records(code_hash, limit=400)
-            recs = [r for r in recs if r.get("kind") == "training_log"]
+            recs = load_records(code_hash, limit=400, kind="training_log")
         except Exception:
             recs = []
 
         if not recs:
             st.info("まだトレーニング記録がありません（上で「保存」を押すと蓄積されます）。")
         else:
-            rows = []
-            for r in recs:
-                pl = r.get("payload") or {}
-                rows.append({
-                    "date": str(pl.get("tr_date", "")),
-                    "type": str(pl.get("tr_type", "")),
-                    "duration_min": pl.get("tr_duration", ""),
-                    "rpe": pl.get("tr_rpe", ""),
-                    "goal": pl.get("tr_goal_text", pl.get("tr_focus", "")) or "",
-                    "notes": str(pl.get("tr_notes", "")),
-                })
-            df = pd.DataFrame(rows)
+            # 記録idの並びが同じなら、表・CSV・icsはキャッシュから返す
+            df, csv_bytes, ics_bytes, dates, ym_options = training_log_exports(code_hash, tuple(r.get("id") for r in recs), recs)
 
             st.markdown("##### 🗑️ 記録の削除")
-            dates = [d for d in df["date"].dropna().astype(str).tolist() if d]
             if dates:
-                target_date = st.selectbox("削除したい日付", sorted(list(set(dates)), reverse=True), key="tr_delete_date")
+                target_date = st.selectbox("削除したい日付", dates, key="tr_delete_date")
                 if st.button("この日付の最新記録を削除", key="tr_delete_by_date"):
                     try:
                         # newest record with that date
@@ -3050,7 +3477,6 @@ def exercise_prescription_page(code_hash: str):
                 st.caption("削除できる記録がありません。")
 
             st.markdown("##### ⬇️ 端末に保存")
-            csv_bytes = df.to_csv(index=False).encode("utf-8-sig")
             st.download_button(
                 "CSVとして保存（端末に残す）",
                 data=csv_bytes,
@@ -3059,36 +3485,6 @@ def exercise_prescription_page(code_hash: str):
                 use_container_width=True,
             )
 
-            # iCalendar (.ics)
-            def _ics_escape(s: str) -> str:
-                s = str(s or "")
-                return s.replace("\\", "\\\\").replace(";", "\\;").replace(",", "\\,").replace("\n", "\\n")
-
-            ics_lines = ["BEGIN:VCALENDAR", "VERSION:2.0", "PRODID:-//Kiwi//TrainingLog//JA"]
-            for r in recs:
-                pl = r.get("payload") or {}
-                d = str(pl.get("tr_date", ""))
-                if not d:
-                    continue
-                try:
-                    y, m, dd = [int(x) for x in d.split("-")]
-                    dt = datetime(y, m, dd, 9, 0, tzinfo=JST)
-                except Exception:
-                    continue
-                summary = f"TR: {pl.get('tr_type','')}"
-                desc = f"{pl.get('tr_duration','')}分 / RPE{pl.get('tr_rpe','')}\n{pl.get('tr_notes','')}"
-                uid = f"{r.get('id','')}-{code_hash}@kiwi"
-                ics_lines += [
-                    "BEGIN:VEVENT",
-                    f"UID:{_ics_escape(uid)}",
-                    f"DTSTAMP:{dt.strftime('%Y%m%dT%H%M%SZ')}",
-                    f"DTSTART:{dt.strftime('%Y%m%dT%H%M%S')}",
-                    f"SUMMARY:{_ics_escape(summary)}",
-                    f"DESCRIPTION:{_ics_escape(desc)}",
-                    "END:VEVENT",
-                ]
-            ics_lines.append("END:VCALENDAR")
-            ics_bytes = "\n".join(ics_lines).encode("utf-8")
             st.download_button(
                 "カレンダー用(.ics)で保存",
                 data=ics_bytes,
@@ -3100,14 +3496,12 @@ def exercise_prescription_page(code_hash: str):
             st.markdown("##### 📅 アプリ内カレンダー（一覧）")
             # very simple month filter
             today = datetime.now(JST).date()
-            ym_options = sorted(list(set([d[:7] for d in dates if len(d) >= 7])), reverse=True)
             default_ym = today.strftime("%Y-%m")
             if default_ym not in ym_options and ym_options:
                 default_ym = ym_options[0]
             ym = st.selectbox("表示する月", ym_options or [default_ym], index=0, key="tr_cal_month")
             if ym:
-                cal_df = df[df["date"].astype(str).str.startswith(ym)].copy()
-                cal_df = cal_df.sort_values("date", ascending=True)
+                cal_df = df[df["date"].str.startswith(ym)].sort_values("date", ascending=True)
                 st.dataframe(cal_df, use_container_width=True, hide_index=True)
     st.markdown("### 筋トレメニュー提案")
     st.caption("体重や筋力の情報から、上半身・下半身・体幹をバランスよく提案します。")
@@ -3119,7 +3513,7 @@ def exercise_prescription_page(code_hash: str):
     _set_global_weight(code_hash, w, write_back_profile=True)
 
     bench1rm = st.number_input("ベンチプレス最大（推定1回の重さ kg・任意）", min_value=0.0, max_value=300.0,
-                               value=float(st.session_state.get("tr_bench1rm", 0.0) or 0.0),
+                               value=ss_float("tr_bench1rm"),
                                step=0.5, key="tr_bench1rm")
 
     squat_est = round(w * 1.2, 1)
@@ -3153,7 +3547,7 @@ def exercise_prescription_page(code_hash: str):
     - 自重中心の場合は負荷の上げ方（回数/テンポ/片脚など）を提案
     - 4週間の進め方（1〜4週の変化）を短く
     出力は見出し＋箇条書きで。"""
-        text, err = ai_text(system, user)
+        text, err = ai_text(system, user, live=True)
         if err:
             st.error("AI提案に失敗: " + err)
         else:
@@ -3161,6 +3555,7 @@ def exercise_prescription_page(code_hash: str):
             plain_menu = strip_html_simple(html_menu)
             st.session_state["tr_menu_text"] = plain_menu           # 保存用（HTMLなし）
             st.session_state["tr_menu_text_html"] = html_menu       # 表示用（見出し装飾あり）
+            persist_ai_cache_from_session(code_hash, force=True)
             ai_highlight_box("🏋️ 筋トレメニュー（生成結果）", html_menu)
 
             # きつくしたい場合の再生成（40代でも迷わない）
@@ -3203,7 +3598,7 @@ def coldflu_page(code_hash: str):
     st.markdown("### 症状の入力")
     st.session_state.setdefault("cf_onset", now_jst().date())
     onset = st.date_input("いつから？", value=st.session_state.get("cf_onset"), key="cf_onset")
-    temp_max = st.number_input("最高体温（℃）", min_value=34.0, max_value=43.0, value=float(st.session_state.get("cf_temp_max") or 37.5), step=0.1, key="cf_temp_max")
+    temp_max = st.number_input("最高体温（℃）", min_value=34.0, max_value=43.0, value=ss_float("cf_temp_max", 37.5), step=0.1, key="cf_temp_max")
     fever_days = st.selectbox("発熱の経過", ["上がってきた", "下がってきた", "横ばい", "発熱なし"], index=0, key="cf_fever_trend")
 
     st.markdown("### 症状チェック")
@@ -3248,7 +3643,7 @@ def coldflu_page(code_hash: str):
   4) 相談を急いだ方がよいサイン（箇条書き）
 - “受診の目安”という言葉は使わない
 """
-        text, err = ai_text(system, user)
+        text, err = ai_text(system, user, live=True)
         if err:
             st.error("AIに失敗: " + err)
         else:
@@ -3267,6 +3662,9 @@ def coldflu_page(code_hash: str):
     ])
 
 
+INJURY_ONSET_OPTS = ("急に（ひねった・ぶつけた・着地で痛い）", "少しずつ（使いすぎ・疲れ）")
+INJURY_BEARING_OPTS = ("問題なし", "少し痛いが可能", "ほぼ無理")
+
 def injury_page(code_hash: str):
     st.subheader("🩹 怪我")
     sport = st.session_state.get("sport", SPORTS[0])
@@ -3316,7 +3714,7 @@ def injury_page(code_hash: str):
     pain = st.slider("痛み（0-10）", 0, 10, 0, key="inj_pain")
     st.caption("例：0=痛みなし / 2-3=違和感 / 4-5=動かすと痛い / 6-7=練習が難しい / 8-10=日常生活もつらい")
 
-    onset = st.selectbox("きっかけ", ["急に（ひねった・ぶつけた・着地で痛い）", "少しずつ（使いすぎ・疲れ）"], index=0, key="inj_onset")
+    onset = st.selectbox("きっかけ", INJURY_ONSET_OPTS, index=0, key="inj_onset")
     swelling = st.checkbox("腫れがある", key="inj_swelling")
     bruise = st.checkbox("内出血がある", key="inj_bruise")
     numb = st.checkbox("しびれ・感覚の違和感がある", key="inj_numb")
@@ -3326,7 +3724,7 @@ def injury_page(code_hash: str):
     lower_limb = any(x in locs for x in ["股関節/鼠径部", "太もも前", "太もも後（ハムストリング）", "膝", "すね", "ふくらはぎ", "足首", "踵/足底", "足（足背/足趾）"])
     weight_bearing = st.selectbox(
         "体重をかけられる？（足の痛みがある場合）",
-        ["問題なし", "少し痛いが可能", "ほぼ無理"],
+        INJURY_BEARING_OPTS,
         index=0,
         key="inj_bearing"
     ) if lower_limb else "（対象外）"
@@ -3395,7 +3793,7 @@ def injury_page(code_hash: str):
             if loc in ["足首"]:
                 extra[f"{loc}_twist_in"] = st.checkbox("内側にひねった（内返し）", key=f"inj_{loc}_inv")
                 extra[f"{loc}_twist_out"] = st.checkbox("外側にひねった（外返し）", key=f"inj_{loc}_ev")
-                extra[f"{loc}_bearing"] = st.selectbox("今の荷重", ["問題なし", "少し痛いが可能", "ほぼ無理"], index=0, key=f"inj_{loc}_bearing2")
+                extra[f"{loc}_bearing"] = st.selectbox("今の荷重", INJURY_BEARING_OPTS, index=0, key=f"inj_{loc}_bearing2")
 
             # 踵/足底
             if loc in ["踵/足底"]:
@@ -3433,7 +3831,7 @@ def injury_page(code_hash: str):
 しびれ: {numb}
 熱: {fever}
 荷重: {weight_bearing}
-追加情報: {json.dumps(extra, ensure_ascii=False)}
+追加情報: {_canon_json(tuple(sorted(extra.items())))}
 
 お願い:
 - 整形外科医に伝わるように、以下の形式で出力
@@ -3444,11 +3842,12 @@ def injury_page(code_hash: str):
 - “受診の目安”という言葉は使わない
 - 文章は短め、箇条書き中心
 """
-        text, err = ai_text(system, user)
+        text, err = ai_text(system, user, live=True)
         if err:
             st.error("AIコメントに失敗: " + err)
         else:
             st.session_state["inj_ai_text"] = text
+            persist_ai_cache_from_session(code_hash, force=True)
             ai_highlight_box("🩹 怪我AIコメント（保存されます）", text)
 
             if is_premium(code_hash):
@@ -3478,6 +3877,15 @@ def injury_page(code_hash: str):
     ])
 
 
+# 目覚めの選択肢とスコア（最大20点）。選択肢の並びはこのdictの順
+WAKE_SCORE = {
+    "😴 まだ眠い": 5,
+    "😐 まあまあ": 10,
+    "🙂 すっきり": 15,
+    "😄 とても良い": 20,
+}
+WAKE_OPTS = tuple(WAKE_SCORE)
+
 def sleep_page(code_hash: str):
     st.subheader("😴 睡眠")
 
@@ -3494,7 +3902,7 @@ def sleep_page(code_hash: str):
 
     wake_quality = st.selectbox(
         "今朝の目覚めはどうだった？",
-        ["😴 まだ眠い", "😐 まあまあ", "🙂 すっきり", "😄 とても良い"],
+        WAKE_OPTS,
         help="起きたときの回復感を直感で選んでください"
     )
 
@@ -3504,13 +3912,6 @@ def sleep_page(code_hash: str):
     )
 
     # --- スコア計算 ---
-    WAKE_SCORE = {
-        "😴 まだ眠い": 5,
-        "😐 まあまあ": 10,
-        "🙂 すっきり": 15,
-        "😄 とても良い": 20,
-    }
-
     score = 0
 
     # 睡眠時間（最大40点）
@@ -3564,11 +3965,12 @@ def sleep_page(code_hash: str):
 文章はやさしく、子どもにも分かる表現で。
 """
 
-        text, err = ai_text(system, user)
+        text, err = ai_text(system, user, live=True)
         if err:
             st.error("AIに失敗しました")
         else:
             st.session_state["sl_ai_text"] = text
+            persist_ai_cache_from_session(code_hash, force=True)
 
     if st.session_state.get("sl_ai_text"):
         ai_highlight_box("😴 睡眠AIアドバイス（保存されます）", st.session_state["sl_ai_text"])
@@ -3603,6 +4005,19 @@ def sleep_page(code_hash: str):
     ])
 
 
+def parse_search_queries(text: str) -> list:
+    """AIの検索クエリ出力（JSON配列）を読む。配列でなければ1行1クエリとして読む"""
+    t = text or ""
+    i, j = t.find("["), t.rfind("]")  # ```json で囲まれていても配列部分だけ読む
+    if 0 <= i < j:
+        try:
+            arr = _loads(t[i:j + 1])
+            if isinstance(arr, list):
+                return [q for q in (str(x).strip() for x in arr) if q]
+        except ValueError:
+            pass
+    return [q.strip("-• 	") for q in (text or "").splitlines() if q.strip()]
+
 def soccer_video_page(code_hash: str):
     st.subheader("🎥 サッカー動画")
     sport = st.session_state.get("sport", SPORTS[0])
@@ -3613,18 +4028,17 @@ def soccer_video_page(code_hash: str):
         st.caption("例：裏抜け / 1対1突破 / ハーフスペースの受け方 / ビルドアップ / 守備の間合い / カウンターの判断 など")
         style = st.text_area("やりたいプレー・課題（できるだけ具体的に）", height=120, key="soccer_style")
         if st.button("おすすめ動画リンクを作る", type="primary", key="soccer_make_links"):
-            system = "You are a soccer coach. Produce 5 Japanese YouTube search queries. Output one per line, no extra text."
-            user = f"テーマ: {style}"
+            system = "You are a soccer coach. Return exactly 5 Japanese YouTube search queries as a JSON array of strings, no prose."
+            user = f"テーマ: {' '.join((style or '').split())}"  # 空白の違いだけなら同じプロンプト（AI結果キャッシュに当たる）
             text, err = ai_text(system, user)
             if err:
                 st.error("AIに失敗: " + err)
             else:
-                queries = [q.strip("-• 	") for q in (text or "").splitlines() if q.strip()]
                 st.markdown("#### YouTube検索リンク")
-                import urllib.parse
-                for q in queries[:5]:
-                    url = "https://www.youtube.com/results?search_query=" + urllib.parse.quote(q)
-                    st.markdown(f"- [{q}]({url})")
+                st.markdown("\n".join(
+                    f"- [{q}](https://www.youtube.com/results?search_query={urllib.parse.quote(q)})"
+                    for q in parse_search_queries(text)[:5]
+                ))
     jams_logo_footer()
 
 
@@ -3695,10 +4109,7 @@ def require_premium_ai(code_hash: str) -> bool:
 
 
 def _load_profile(code_hash: str) -> dict:
-    d = load_snapshot(code_hash, "profile") or {}
-    if isinstance(d, dict):
-        return d
-    return {}
+    return _get_profile_snapshot(code_hash)
 
 def _save_profile(code_hash: str, payload: dict):
     save_snapshot(code_hash, "profile", payload)
@@ -3753,28 +4164,32 @@ def _sync_profile_to_session(code_hash: str, prof: dict | None = None):
         h = 0.0
         # seed tab weights (only if not manually edited)
         for k in WEIGHT_KEYS:
-            if k not in st.session_state or float(st.session_state.get(k) or 0.0) <= 0.0:
+            if k not in st.session_state or ss_float(k) <= 0.0:
                 st.session_state[k] = float(st.session_state["profile_weight_kg"])
 
     try:
         h = float(prof.get("height_cm") or 0.0)
     except Exception:
         h = 0.0
-    if ("latest_height_cm" not in st.session_state) or float(st.session_state.get("latest_height_cm") or 0.0) <= 0.0:
+    if ("latest_height_cm" not in st.session_state) or ss_float("latest_height_cm") <= 0.0:
         if h > 0:
             st.session_state["latest_height_cm"] = h
 
 
+# 基礎情報ページのセッションキー（リセット時に消す。pf_ キーを増やしたらここにも追加）
+PROFILE_STATE_KEYS = ("pf_name", "pf_sex", "pf_birth", "pf_dob", "pf_height", "pf_weight", "pf_weight__manual", "pf_plan")
+
 def profile_top_page(code_hash: str):
     st.markdown('<div class="km-wrap">', unsafe_allow_html=True)
     st.markdown("## 基礎情報（最初に1回）")
     prof = _load_profile(code_hash)
 
-    with st.container():
+    # フォームにまとめ、入力のたびのrerun・DB書き込みを「保存して次へ」の1回にする
+    with st.form("pf_form", clear_on_submit=False):
         st.markdown('<div class="km-card">', unsafe_allow_html=True)
         # 最小限：スマホで入力しやすい項目だけ
         name = st.text_input("名前（ニックネーム可）", value=prof.get("name",""), key="pf_name")
-        sex = st.selectbox("性別", ["未選択","男","女"], index=["未選択","男","女"].index(prof.get("sex","未選択") if prof.get("sex","未選択") in ["未選択","男","女"] else "未選択"), key="pf_sex")
+        sex = st.selectbox("性別", SEX_OPTS, index=SEX_INDEX.get(prof.get("sex"), 0), key="pf_sex")
         import datetime as _dt
         _b = (prof.get("birth","") or "").strip()
         try:
@@ -3796,14 +4211,13 @@ def profile_top_page(code_hash: str):
         tier = get_plan(code_hash)
         tier_label = "プレミアム" if tier=="premium" else "ベーシック"
         sel = st.radio("プラン", ["ベーシック", "プレミアム"], index=1 if tier=="premium" else 0, horizontal=True, key="pf_plan")
-        if sel == "プレミアム":
-            set_plan(code_hash, "premium")
-        else:
-            set_plan(code_hash, "basic")
 
-        st.markdown('<div class="km-muted">※入力後は自動保存され、リセットしない限りこの情報で進みます。</div>', unsafe_allow_html=True)
+        st.markdown('<div class="km-muted">※「保存して次へ」で保存され、リセットしない限りこの情報で進みます。</div>', unsafe_allow_html=True)
 
-        # 自動保存（毎回）
+        submitted = st.form_submit_button("保存して次へ（機能を選ぶ）", type="primary", use_container_width=True)
+        st.markdown('</div>', unsafe_allow_html=True)
+
+    if submitted:
         payload = {
             "name": (name or "").strip(),
             "sex": sex,
@@ -3811,24 +4225,22 @@ def profile_top_page(code_hash: str):
             "height_cm": float(height_cm or 0.0),
             "weight_kg": float(weight_kg or 0.0),
         }
-        _save_profile(code_hash, payload)
+        # 変更がなければDBには書かない（読み込んだprofile/planと同じなら保存済み）
+        if payload != prof:
+            _save_profile(code_hash, payload)
         _sync_profile_to_session(code_hash, payload)
+        new_tier = "premium" if sel == "プレミアム" else "basic"
+        if new_tier != tier:
+            set_plan(code_hash, new_tier)
+        _route_set("menu")
+        st.rerun()
 
-        colA, colB = st.columns([1,1])
-        with colA:
-            if st.button("次へ（機能を選ぶ）", type="primary", use_container_width=True, key="pf_next"):
-                _route_set("menu")
-                st.rerun()
-        with colB:
-            if st.button("基礎情報をリセット", use_container_width=True, key="pf_reset"):
-                delete_snapshot(code_hash, "profile")
-                for k in list(st.session_state.keys()):
-                    if k.startswith("pf_"):
-                        del st.session_state[k]
-                st.success("基礎情報をリセットしました。")
-                st.rerun()
-
-        st.markdown('</div>', unsafe_allow_html=True)
+    if st.button("基礎情報をリセット", use_container_width=True, key="pf_reset"):
+        delete_snapshot(code_hash, "profile")
+        for k in PROFILE_STATE_KEYS:
+            st.session_state.pop(k, None)
+        st.success("基礎情報をリセットしました。")
+        st.rerun()
 
 def menu_select_page(code_hash: str):
     # 40代の親が迷わず押せる：大きい2列ボタン（スマホ最適）
@@ -3894,11 +4306,21 @@ def main():
     except Exception:
         pass
 
+    # 保存済みのAIコメントを復元（別端末・翌日でも表示。セッションにあるキーは上書きしない）
+    try:
+        restore_ai_cache_to_session(code_hash)
+    except Exception:
+        pass
+
     # 基礎情報が保存済みなら、dob/体重などをセッションへ同期（他ページの初期値に使う）
+    # profileが前回の同期から変わっていなければ（日付も同じなら）同期は省く
     try:
         prof = _load_profile(code_hash)
         if prof:
-            _sync_profile_to_session(code_hash, prof)
+            sig = (code_hash, now_jst().date().isoformat(), _dumps(prof))
+            if st.session_state.get("_prof_sig") != sig:
+                _sync_profile_to_session(code_hash, prof)
+                st.session_state["_prof_sig"] = sig
     except Exception:
         pass
 
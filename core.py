@@ -1,4 +1,4 @@
-import sqlite3, json, uuid, time
+import sqlite3, json, uuid, time, threading, os
 from dataclasses import dataclass
 from typing import Optional, Dict, Any, Tuple, List
 
@@ -17,7 +17,8 @@ def now_ts() -> int:
     return int(time.time())
 
 def clamp(x, lo, hi):
-    return max(lo, min(hi, x))
+    # Comparisons instead of max(lo, min(hi, x)): no builtin calls on the hot path (NaN still maps to hi)
+    return lo if x < lo else (x if x < hi else hi)
 
 def calc_tsat(fe: float, tibc: float) -> Optional[float]:
     if tibc is None or tibc <= 0:
@@ -65,33 +66,64 @@ class Ctx:
 # ---------------------------
 # Rule-based prediction (adult-equivalent)
 # ---------------------------
-def rule_predict(labs: Labs, ctx: Ctx, horizon_weeks: int) -> Dict[str, Any]:
-    tsat0 = labs.tsat if labs.tsat is not None else calc_tsat(labs.fe, labs.tibc)
-    if tsat0 is None:
-        raise ValueError("TSATまたはFe/TIBCが必要です")
-
+def _rule_core(hb0: float, ferritin0: float, tibc0: float, tsat0: float,
+               dose_mg_day: float, adherence: float, bleed: float, inflam: float,
+               horizon_weeks: int) -> Tuple[float, float, float, float]:
+    """Numeric part of rule_predict: returns unrounded (hb1, fe1, ferritin1, tsat1)."""
     scale = horizon_weeks / 12.0
 
-    dose_scale = clamp(ctx.dose_mg_day / 500.0, 0.5, 2.0)
-    eff = clamp(ctx.adherence * dose_scale, 0.2, 2.0)
+    dose_scale = clamp(dose_mg_day / 500.0, 0.5, 2.0)
+    eff = clamp(adherence * dose_scale, 0.2, 2.0)
 
     # TSAT (cap 40)
     tsat1 = clamp(tsat0 + (10.0 * eff * scale), 5.0, 40.0)
 
     # Hb (cap 17.5)
-    low_hb_boost = clamp(1.0 + (10.5 - labs.hb) * 0.15, 0.8, 1.4)
+    low_hb_boost = clamp(1.0 + (10.5 - hb0) * 0.15, 0.8, 1.4)
     iron_boost = clamp((tsat1 - tsat0) / 10.0, 0.0, 1.5)
-    loss_penalty = 1.0 - clamp(ctx.bleed * 0.7, 0.0, 0.7)
+    loss_penalty = 1.0 - clamp(bleed * 0.7, 0.0, 0.7)
     delta_hb = (0.5 * eff * scale) * low_hb_boost * (0.6 + 0.4 * iron_boost) * loss_penalty
-    hb1 = clamp(labs.hb + delta_hb, 5.0, 17.5)
+    hb1 = clamp(hb0 + delta_hb, 5.0, 17.5)
 
     # Ferritin (cap 250)
     ferritin_gain = (30.0 * eff * scale) * clamp((tsat1 - tsat0) / 10.0, 0.0, 2.0)
-    ferritin_inflation = ctx.inflam * (30.0 * scale)
-    ferritin1 = clamp(labs.ferritin + ferritin_gain + ferritin_inflation, 1.0, 250.0)
+    ferritin_inflation = inflam * (30.0 * scale)
+    ferritin1 = clamp(ferritin0 + ferritin_gain + ferritin_inflation, 1.0, 250.0)
 
     # Fe reconstructed for consistency
-    fe1 = clamp(tsat1 * labs.tibc / 100.0, 1.0, 400.0)
+    fe1 = clamp(tsat1 * tibc0 / 100.0, 1.0, 400.0)
+    return hb1, fe1, ferritin1, tsat1
+
+def _rule_core_vec(hb0: np.ndarray, ferritin0: np.ndarray, tibc0: np.ndarray, tsat0: np.ndarray,
+                   dose_mg_day: np.ndarray, adherence: np.ndarray, bleed: np.ndarray, inflam: np.ndarray,
+                   horizon_weeks: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """_rule_core over 1-D arrays (same clamp chain with np.clip), for batch scoring in training."""
+    scale = horizon_weeks / 12.0
+    eff = np.clip(adherence * np.clip(dose_mg_day / 500.0, 0.5, 2.0), 0.2, 2.0)
+
+    tsat1 = np.clip(tsat0 + (10.0 * eff * scale), 5.0, 40.0)
+    dtsat = (tsat1 - tsat0) / 10.0
+
+    low_hb_boost = np.clip(1.0 + (10.5 - hb0) * 0.15, 0.8, 1.4)
+    loss_penalty = 1.0 - np.clip(bleed * 0.7, 0.0, 0.7)
+    delta_hb = (0.5 * eff * scale) * low_hb_boost * (0.6 + 0.4 * np.clip(dtsat, 0.0, 1.5)) * loss_penalty
+    hb1 = np.clip(hb0 + delta_hb, 5.0, 17.5)
+
+    ferritin_gain = (30.0 * eff * scale) * np.clip(dtsat, 0.0, 2.0)
+    ferritin1 = np.clip(ferritin0 + ferritin_gain + inflam * (30.0 * scale), 1.0, 250.0)
+
+    fe1 = np.clip(tsat1 * tibc0 / 100.0, 1.0, 400.0)
+    return hb1, fe1, ferritin1, tsat1
+
+def rule_predict(labs: Labs, ctx: Ctx, horizon_weeks: int) -> Dict[str, Any]:
+    tsat0 = labs.tsat if labs.tsat is not None else calc_tsat(labs.fe, labs.tibc)
+    if tsat0 is None:
+        raise ValueError("TSATまたはFe/TIBCが必要です")
+
+    hb1, fe1, ferritin1, tsat1 = _rule_core(
+        labs.hb, labs.ferritin, labs.tibc, tsat0,
+        ctx.dose_mg_day, ctx.adherence, ctx.bleed, ctx.inflam, horizon_weeks,
+    )
 
     alerts = []
     if tsat1 >= 40.0:
@@ -112,48 +144,76 @@ def rule_predict(labs: Labs, ctx: Ctx, horizon_weeks: int) -> Dict[str, Any]:
 # ---------------------------
 # Model persistence
 # ---------------------------
+# Parsed model.json, keyed on (mtime_ns, size) so an external rewrite is picked up
+_MODELS_CACHE: Dict[str, Any] = {"sig": None, "data": None}
+
+def _model_file_sig() -> Optional[Tuple[int, int]]:
+    try:
+        st = os.stat(MODEL_PATH)
+    except FileNotFoundError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
 def load_models() -> Dict[str, Any]:
+    """Parsed model.json (shared between callers; treat as read-only)."""
+    sig = _model_file_sig()
+    if sig is None:
+        return {"models": {}}
+    if _MODELS_CACHE["sig"] == sig:
+        return _MODELS_CACHE["data"]
     try:
         with open(MODEL_PATH, "r", encoding="utf-8") as f:
-            return json.load(f)
+            data = json.load(f)
     except FileNotFoundError:
         return {"models": {}}
+    _MODELS_CACHE["sig"], _MODELS_CACHE["data"] = sig, data
+    return data
 
 def save_models(models: Dict[str, Any]) -> None:
-    with open(MODEL_PATH, "w", encoding="utf-8") as f:
-        json.dump(models, f, ensure_ascii=False, indent=2)
+    # Write to a temp file and swap it in, so readers never see a half-written model.json
+    tmp = MODEL_PATH + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(models, f, ensure_ascii=False, separators=(",", ":"))  # machine-read; no pretty-printing
+    os.replace(tmp, MODEL_PATH)
+    _MODELS_CACHE["sig"], _MODELS_CACHE["data"] = _model_file_sig(), models
 
 def get_model_for_horizon(horizon_weeks: int) -> Optional[Dict[str, Any]]:
     return load_models().get("models", {}).get(str(horizon_weeks))
 
+# id(model) -> (model, {name: (weights in FEATURE_KEYS order, bias)}); holding the model keeps its id from being reused
+_ADJ_CACHE: Dict[int, Tuple[Dict[str, Any], Dict[str, Tuple[np.ndarray, float]]]] = {}
+
+def _adjustment_vectors(model: Dict[str, Any]) -> Dict[str, Tuple[np.ndarray, float]]:
+    """model["adjustments"] as fixed-order weight vectors + bias, built once per loaded model."""
+    hit = _ADJ_CACHE.get(id(model))
+    if hit is not None and hit[0] is model:
+        return hit[1]
+    vecs = {}
+    for name, adj in model["adjustments"].items():
+        w = adj.get("weights", {})
+        vecs[name] = (np.array([float(w.get(k, 0.0)) for k in FEATURE_KEYS], dtype=float), float(adj.get("bias", 0.0)))
+    if len(_ADJ_CACHE) >= 8:  # one entry per horizon in practice; drop stale models after a retrain
+        _ADJ_CACHE.clear()
+    _ADJ_CACHE[id(model)] = (model, vecs)
+    return vecs
+
 def calibrated_predict(labs: Labs, ctx: Ctx, horizon_weeks: int, model: Dict[str, Any]) -> Dict[str, Any]:
     base = rule_predict(labs, ctx, horizon_weeks=horizon_weeks)
     tsat0 = labs.tsat if labs.tsat is not None else calc_tsat(labs.fe, labs.tibc)
     if tsat0 is None:
         raise ValueError("TSATまたはFe/TIBCが必要です")
 
-    x = {
-        "hb0": labs.hb,
-        "tsat0": tsat0,
-        "ferritin0": labs.ferritin,
-        "tibc0": labs.tibc,
-        "dose": float(ctx.dose_mg_day),
-        "adherence": ctx.adherence,
-        "bleed": ctx.bleed,
-        "inflam": ctx.inflam,
-    }
+    # Same order as FEATURE_KEYS
+    x = np.array([labs.hb, tsat0, labs.ferritin, labs.tibc, float(ctx.dose_mg_day), ctx.adherence, ctx.bleed, ctx.inflam], dtype=float)
+    adj = _adjustment_vectors(model)
 
-    def lin(adj):
-        b = float(adj.get("bias", 0.0))
-        w = adj.get("weights", {})
-        s = b
-        for k, v in w.items():
-            s += float(v) * float(x.get(k, 0.0))
-        return s
+    def lin(name):
+        w, b = adj[name]
+        return float(x @ w) + b
 
-    adj_hb = lin(model["adjustments"]["hb"])
-    adj_tsat = lin(model["adjustments"]["tsat"])
-    adj_ferr = lin(model["adjustments"]["ferritin"])
+    adj_hb = lin("hb")
+    adj_tsat = lin("tsat")
+    adj_ferr = lin("ferritin")
 
     hb1 = clamp(base["Hb"] + adj_hb, 5.0, 17.5)
     tsat1 = clamp(base["TSAT"] + adj_tsat, 5.0, 40.0)
@@ -170,110 +230,136 @@ def calibrated_predict(labs: Labs, ctx: Ctx, horizon_weeks: int, model: Dict[str
     out["alerts"] = list(set(out.get("alerts", []) + ["校正モデル適用"]))
     return out
 
+# ---------------------------
+# DB connection
+# ---------------------------
+_CONN: Optional[sqlite3.Connection] = None
+_CONN_LOCK = threading.RLock()
+
+def _conn() -> sqlite3.Connection:
+    """Process-wide connection to DB_PATH (reused across calls; use under _CONN_LOCK)."""
+    global _CONN
+    if _CONN is None:
+        with _CONN_LOCK:
+            if _CONN is None:
+                con = sqlite3.connect(DB_PATH, check_same_thread=False, timeout=30)
+                con.row_factory = sqlite3.Row
+                # Local single-writer DB: WAL + synchronous=NORMAL avoids an fsync per commit
+                # (a crash can lose the last commits, never corrupt the file)
+                con.execute("PRAGMA journal_mode=WAL;")
+                con.execute("PRAGMA synchronous=NORMAL;")
+                con.execute("PRAGMA busy_timeout=5000;")
+                con.execute("PRAGMA temp_store=MEMORY;")
+                con.execute("PRAGMA mmap_size=268435456;")  # 256MB
+                con.execute("PRAGMA cache_size=-20000;")    # ~20MB page cache
+                _CONN = con
+    return _CONN
+
 # ---------------------------
 # DB schema
 # ---------------------------
 def init_db():
-    con = sqlite3.connect(DB_PATH)
-    cur = con.cursor()
-
-    # Base tables
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS cases(
-      case_id TEXT PRIMARY KEY,
-      created_at INTEGER,
-      note TEXT,
-      external_id TEXT,              -- ★人が扱いやすいID（JAMS連動用）
-      hb0 REAL, fe0 REAL, ferritin0 REAL, tibc0 REAL, tsat0 REAL,
-      dose_mg_day INTEGER, adherence REAL, bleed REAL, inflam REAL,
-      pred_hb_w12 REAL, pred_fe_w12 REAL, pred_ferr_w12 REAL, pred_tsat_w12 REAL, model_w12 TEXT,
-      pred_hb_w24 REAL, pred_fe_w24 REAL, pred_ferr_w24 REAL, pred_tsat_w24 REAL, model_w24 TEXT
-    )""")
-
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS followups(
-      case_id TEXT,
-      horizon_weeks INTEGER,
-      followup_at INTEGER,
-      hb REAL, fe REAL, ferritin REAL, tibc REAL, tsat REAL,
-      PRIMARY KEY(case_id, horizon_weeks),
-      FOREIGN KEY(case_id) REFERENCES cases(case_id)
-    )""")
-
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS model_versions(
-      horizon_weeks INTEGER,
-      version TEXT,
-      trained_at INTEGER,
-      n_train INTEGER,
-      metrics_json TEXT,
-      model_json TEXT,
-      PRIMARY KEY(horizon_weeks, version)
-    )""")
-
-    # ---- schema migration for older DBs (add external_id if missing) ----
-    cur.execute("PRAGMA table_info(cases)")
-    cols = [r[1] for r in cur.fetchall()]
-    if "external_id" not in cols:
-        cur.execute("ALTER TABLE cases ADD COLUMN external_id TEXT")
-
-    # Index for faster lookup
-    cur.execute("CREATE INDEX IF NOT EXISTS idx_cases_external_id ON cases(external_id)")
-
-    con.commit()
-    con.close()
+    with _CONN_LOCK, _conn() as con:
+        cur = con.cursor()
+
+        # Base tables
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS cases(
+          case_id TEXT PRIMARY KEY,
+          created_at INTEGER,
+          note TEXT,
+          external_id TEXT,              -- ★人が扱いやすいID（JAMS連動用）
+          hb0 REAL, fe0 REAL, ferritin0 REAL, tibc0 REAL, tsat0 REAL,
+          dose_mg_day INTEGER, adherence REAL, bleed REAL, inflam REAL,
+          pred_hb_w12 REAL, pred_fe_w12 REAL, pred_ferr_w12 REAL, pred_tsat_w12 REAL, model_w12 TEXT,
+          pred_hb_w24 REAL, pred_fe_w24 REAL, pred_ferr_w24 REAL, pred_tsat_w24 REAL, model_w24 TEXT
+        )""")
+
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS followups(
+          case_id TEXT,
+          horizon_weeks INTEGER,
+          followup_at INTEGER,
+          hb REAL, fe REAL, ferritin REAL, tibc REAL, tsat REAL,
+          PRIMARY KEY(case_id, horizon_weeks),
+          FOREIGN KEY(case_id) REFERENCES cases(case_id)
+        )""")
+
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS model_versions(
+          horizon_weeks INTEGER,
+          version TEXT,
+          trained_at INTEGER,
+          n_train INTEGER,
+          metrics_json TEXT,
+          model_json TEXT,
+          PRIMARY KEY(horizon_weeks, version)
+        )""")
+
+        # ---- schema migration for older DBs (add external_id if missing) ----
+        cur.execute("PRAGMA table_info(cases)")
+        cols = [r[1] for r in cur.fetchall()]
+        if "external_id" not in cols:
+            cur.execute("ALTER TABLE cases ADD COLUMN external_id TEXT")
+
+        # Index for faster lookup
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_cases_external_id ON cases(external_id)")
+        # Training join filters followups by horizon (the PK starts with case_id, so it can't serve that)
+        cur.execute("SELECT 1 FROM sqlite_master WHERE type='index' AND name='idx_followups_horizon_case'")
+        if cur.fetchone() is None:
+            cur.execute("CREATE INDEX idx_followups_horizon_case ON followups(horizon_weeks, case_id)")
+            cur.execute("ANALYZE")
+
 def get_counts() -> Dict[str, int]:
-    con = sqlite3.connect(DB_PATH)
-    cur = con.cursor()
-    cur.execute("SELECT COUNT(*) FROM cases")
-    n_cases = int(cur.fetchone()[0])
-    cur.execute("SELECT COUNT(*) FROM followups WHERE horizon_weeks=12")
-    n_f12 = int(cur.fetchone()[0])
-    cur.execute("SELECT COUNT(*) FROM followups WHERE horizon_weeks=24")
-    n_f24 = int(cur.fetchone()[0])
-    con.close()
-    return {"cases": n_cases, "followups12": n_f12, "followups24": n_f24}
+    # One statement; the followup counts are range counts on idx_followups_horizon_case
+    with _CONN_LOCK:
+        n_cases, n_f12, n_f24 = _conn().execute(
+            """SELECT
+                (SELECT COUNT(*) FROM cases),
+                (SELECT COUNT(*) FROM followups WHERE horizon_weeks=12),
+                (SELECT COUNT(*) FROM followups WHERE horizon_weeks=24)"""
+        ).fetchone()
+    return {"cases": int(n_cases), "followups12": int(n_f12), "followups24": int(n_f24)}
 
 def list_cases(limit: int = 200) -> List[Dict[str, Any]]:
-    con = sqlite3.connect(DB_PATH)
-    con.row_factory = sqlite3.Row
-    cur = con.cursor()
-    cur.execute("SELECT * FROM cases ORDER BY created_at DESC LIMIT ?", (limit,))
-    rows = [dict(r) for r in cur.fetchall()]
-    con.close()
+    with _CONN_LOCK:
+        cur = _conn().execute("SELECT * FROM cases ORDER BY created_at DESC LIMIT ?", (limit,))
+        rows = [dict(r) for r in cur.fetchall()]
     return rows
 
 
 def get_case(case_id: str) -> Optional[Dict[str, Any]]:
-    con = sqlite3.connect(DB_PATH)
-    con.row_factory = sqlite3.Row
-    cur = con.cursor()
-    cur.execute("SELECT * FROM cases WHERE case_id = ?", (case_id,))
-    r = cur.fetchone()
-    con.close()
+    with _CONN_LOCK:
+        r = _conn().execute("SELECT * FROM cases WHERE case_id = ?", (case_id,)).fetchone()
     return dict(r) if r else None
 
-def update_case_context_and_predictions(case_id: str, ctx: Ctx, note: Optional[str] = None, external_id: Optional[str] = None) -> Dict[str, Any]:
-    """Update dose/adherence/bleed/inflam (and optional note/external_id), then recompute and store predictions for 12/24w.
-    This is a *persistent* update (saved)."""
-    row = get_case(case_id)
-    if not row:
-        raise ValueError("case not found")
+SQL_SELECT_CASE_LABS = "SELECT hb0, fe0, ferritin0, tibc0, tsat0 FROM cases WHERE case_id = ?"
 
-    labs0 = Labs(
+def _labs_from_row(row) -> Labs:
+    """Baseline Labs from a cases row (dict or sqlite3.Row with hb0/fe0/ferritin0/tibc0/tsat0)."""
+    return Labs(
         hb=safe_float(row["hb0"]),
         fe=safe_float(row["fe0"]),
         ferritin=safe_float(row["ferritin0"]),
         tibc=safe_float(row["tibc0"]),
-        tsat=safe_float(row["tsat0"]) if row.get("tsat0") is not None else None
+        tsat=safe_float(row["tsat0"]) if row["tsat0"] is not None else None
     )
 
+def update_case_context_and_predictions(case_id: str, ctx: Ctx, note: Optional[str] = None, external_id: Optional[str] = None,
+                                        row: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Update dose/adherence/bleed/inflam (and optional note/external_id), then recompute and store predictions for 12/24w.
+    This is a *persistent* update (saved). Pass `row` (the case dict) when the caller already has it."""
+    if row is None:
+        with _CONN_LOCK:
+            row = _conn().execute(SQL_SELECT_CASE_LABS, (case_id,)).fetchone()
+    if not row:
+        raise ValueError("case not found")
+
+    # Predict outside the lock: predict_for_horizon may load model.json from disk
+    labs0 = _labs_from_row(row)
     p12, tag12 = predict_for_horizon(labs0, ctx, 12)
     p24, tag24 = predict_for_horizon(labs0, ctx, 24)
 
-    con = sqlite3.connect(DB_PATH)
-    cur = con.cursor()
-
     fields = {
         "dose_mg_day": int(ctx.dose_mg_day),
         "adherence": float(ctx.adherence),
@@ -289,35 +375,26 @@ def update_case_context_and_predictions(case_id: str, ctx: Ctx, note: Optional[s
 
     sets = ", ".join([f"{k}=?" for k in fields.keys()])
     vals = list(fields.values()) + [case_id]
-    cur.execute(f"UPDATE cases SET {sets} WHERE case_id=?", vals)
-    con.commit()
-    con.close()
+    with _CONN_LOCK, _conn() as con:
+        if con.execute(f"UPDATE cases SET {sets} WHERE case_id=?", vals).rowcount == 0:
+            raise ValueError("case not found")
 
     return {"case_id": case_id, "12w": p12, "24w": p24, "model_w12": tag12, "model_w24": tag24}
 
 def simulate_predictions_for_case(case_id: str, ctx: Ctx) -> Dict[str, Any]:
     """Compute predictions with a modified ctx WITHOUT saving."""
-    row = get_case(case_id)
+    with _CONN_LOCK:
+        row = _conn().execute(SQL_SELECT_CASE_LABS, (case_id,)).fetchone()
     if not row:
         raise ValueError("case not found")
-    labs0 = Labs(
-        hb=safe_float(row["hb0"]),
-        fe=safe_float(row["fe0"]),
-        ferritin=safe_float(row["ferritin0"]),
-        tibc=safe_float(row["tibc0"]),
-        tsat=safe_float(row["tsat0"]) if row.get("tsat0") is not None else None
-    )
+    labs0 = _labs_from_row(row)
     p12, tag12 = predict_for_horizon(labs0, ctx, 12)
     p24, tag24 = predict_for_horizon(labs0, ctx, 24)
     return {"case_id": case_id, "12w": p12, "24w": p24, "model_w12": tag12, "model_w24": tag24}
 
 def get_followup(case_id: str, horizon_weeks: int) -> Optional[Dict[str, Any]]:
-    con = sqlite3.connect(DB_PATH)
-    con.row_factory = sqlite3.Row
-    cur = con.cursor()
-    cur.execute("SELECT * FROM followups WHERE case_id=? AND horizon_weeks=?", (case_id, horizon_weeks))
-    r = cur.fetchone()
-    con.close()
+    with _CONN_LOCK:
+        r = _conn().execute("SELECT * FROM followups WHERE case_id=? AND horizon_weeks=?", (case_id, horizon_weeks)).fetchone()
     return dict(r) if r else None
 
 # ---------------------------
@@ -328,51 +405,59 @@ def resolve_case_id(identifier: str) -> Optional[str]:
     if not identifier:
         return None
     ident = identifier.strip()
-    con = sqlite3.connect(DB_PATH)
-    cur = con.cursor()
-    # First try exact match on case_id
-    cur.execute("SELECT case_id FROM cases WHERE case_id = ?", (ident,))
-    row = cur.fetchone()
-    if row:
-        con.close()
-        return row[0]
-    # Then try external_id
-    cur.execute("SELECT case_id FROM cases WHERE external_id = ?", (ident,))
-    row = cur.fetchone()
-    con.close()
+    with _CONN_LOCK:
+        cur = _conn().cursor()
+        # First try exact match on case_id
+        cur.execute("SELECT case_id FROM cases WHERE case_id = ?", (ident,))
+        row = cur.fetchone()
+        if row:
+            return row[0]
+        # Then try external_id
+        cur.execute("SELECT case_id FROM cases WHERE external_id = ?", (ident,))
+        row = cur.fetchone()
     return row[0] if row else None
 
 def set_external_id(case_id: str, external_id: str) -> None:
     external_id = (external_id or "").strip()
-    con = sqlite3.connect(DB_PATH)
-    cur = con.cursor()
-    cur.execute("UPDATE cases SET external_id=? WHERE case_id=?", (external_id, case_id))
-    con.commit()
-    con.close()
+    with _CONN_LOCK, _conn() as con:
+        con.execute("UPDATE cases SET external_id=? WHERE case_id=?", (external_id, case_id))
 
 def delete_case(case_id: str) -> Dict[str, Any]:
     """Delete a case and all followups (hard delete)."""
-    con = sqlite3.connect(DB_PATH)
-    cur = con.cursor()
-    cur.execute("DELETE FROM followups WHERE case_id = ?", (case_id,))
-    cur.execute("DELETE FROM cases WHERE case_id = ?", (case_id,))
-    con.commit()
-    con.close()
+    with _CONN_LOCK, _conn() as con:
+        con.execute("DELETE FROM followups WHERE case_id = ?", (case_id,))
+        con.execute("DELETE FROM cases WHERE case_id = ?", (case_id,))
     return {"deleted": True, "case_id": case_id}
 
 
 # ---------------------------
 # Register baseline
 # ---------------------------
+# (labs, ctx, horizon, model identity) -> (prediction, tag); reruns with unchanged inputs skip the model
+_PRED_CACHE: Dict[tuple, Tuple[Dict[str, Any], str]] = {}
+PRED_CACHE_MAX = 1024
+
 def predict_for_horizon(labs: Labs, ctx: Ctx, horizon_weeks: int) -> Tuple[Dict[str, Any], str]:
     model = get_model_for_horizon(horizon_weeks)
-    if model:
-        p = calibrated_predict(labs, ctx, horizon_weeks, model)
-        tag = f"calibrated:{model.get('version','unknown')}"
-    else:
-        p = rule_predict(labs, ctx, horizon_weeks)
-        tag = "rule_v1"
-    return p, tag
+    key = (
+        labs.hb, labs.fe, labs.ferritin, labs.tibc, labs.tsat,
+        ctx.dose_mg_day, ctx.adherence, ctx.bleed, ctx.inflam, horizon_weeks,
+        (model.get("version"), model.get("trained_at"), model.get("n_train")) if model else None,
+    )
+    hit = _PRED_CACHE.get(key)
+    if hit is None:
+        if model:
+            p = calibrated_predict(labs, ctx, horizon_weeks, model)
+            tag = f"calibrated:{model.get('version','unknown')}"
+        else:
+            p = rule_predict(labs, ctx, horizon_weeks)
+            tag = "rule_v1"
+        if len(_PRED_CACHE) >= PRED_CACHE_MAX:
+            _PRED_CACHE.clear()
+        hit = _PRED_CACHE[key] = (p, tag)
+    p, tag = hit
+    # Callers get their own dict/alerts list
+    return {**p, "alerts": list(p.get("alerts", []))}, tag
 
 def register_case(labs: Labs, ctx: Ctx, note: str = "", external_id: str = "") -> Tuple[str, Dict[str, Any]]:
     tsat0 = labs.tsat if labs.tsat is not None else calc_tsat(labs.fe, labs.tibc)
@@ -383,26 +468,23 @@ def register_case(labs: Labs, ctx: Ctx, note: str = "", external_id: str = "") -
     p24, tag24 = predict_for_horizon(labs, ctx, 24)
 
     case_id = str(uuid.uuid4())
-    con = sqlite3.connect(DB_PATH)
-    cur = con.cursor()
-    cur.execute(
-        """INSERT INTO cases(
-            case_id, created_at, note, external_id,
-            hb0, fe0, ferritin0, tibc0, tsat0,
-            dose_mg_day, adherence, bleed, inflam,
-            pred_hb_w12, pred_fe_w12, pred_ferr_w12, pred_tsat_w12, model_w12,
-            pred_hb_w24, pred_fe_w24, pred_ferr_w24, pred_tsat_w24, model_w24
-        ) VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)""",
-        (
-            case_id, now_ts(), note, external_id,
-            labs.hb, labs.fe, labs.ferritin, labs.tibc, tsat0,
-            ctx.dose_mg_day, ctx.adherence, ctx.bleed, ctx.inflam,
-            p12["Hb"], p12["Fe"], p12["Ferritin"], p12["TSAT"], tag12,
-            p24["Hb"], p24["Fe"], p24["Ferritin"], p24["TSAT"], tag24
+    with _CONN_LOCK, _conn() as con:
+        con.execute(
+            """INSERT INTO cases(
+                case_id, created_at, note, external_id,
+                hb0, fe0, ferritin0, tibc0, tsat0,
+                dose_mg_day, adherence, bleed, inflam,
+                pred_hb_w12, pred_fe_w12, pred_ferr_w12, pred_tsat_w12, model_w12,
+                pred_hb_w24, pred_fe_w24, pred_ferr_w24, pred_tsat_w24, model_w24
+            ) VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)""",
+            (
+                case_id, now_ts(), note, external_id,
+                labs.hb, labs.fe, labs.ferritin, labs.tibc, tsat0,
+                ctx.dose_mg_day, ctx.adherence, ctx.bleed, ctx.inflam,
+                p12["Hb"], p12["Fe"], p12["Ferritin"], p12["TSAT"], tag12,
+                p24["Hb"], p24["Fe"], p24["Ferritin"], p24["TSAT"], tag24
+            )
         )
-    )
-    con.commit()
-    con.close()
     return case_id, {"12w": p12, "24w": p24, "model_w12": tag12, "model_w24": tag24}
 
 # ---------------------------
@@ -410,9 +492,12 @@ def register_case(labs: Labs, ctx: Ctx, note: str = "", external_id: str = "") -
 # ---------------------------
 FEATURE_KEYS = ["hb0", "tsat0", "ferritin0", "tibc0", "dose", "adherence", "bleed", "inflam"]
 
-def _ridge_fit(X: np.ndarray, y: np.ndarray, alpha: float = 10.0) -> Tuple[np.ndarray, float]:
+def _ridge_fit_multi(X: np.ndarray, Y: np.ndarray, alpha: float = 10.0) -> Tuple[np.ndarray, np.ndarray]:
+    """Ridge for several targets sharing X: Y (n, k) -> W (d, k), b (k,). One solve for all columns."""
     X = np.asarray(X, dtype=float)
-    y = np.asarray(y, dtype=float).reshape(-1)
+    Y = np.asarray(Y, dtype=float)
+    if Y.ndim == 1:
+        Y = Y.reshape(-1, 1)
 
     if X.size == 0:
         raise ValueError("X is empty (no training data)")
@@ -420,42 +505,65 @@ def _ridge_fit(X: np.ndarray, y: np.ndarray, alpha: float = 10.0) -> Tuple[np.nd
         raise ValueError(f"X must be 2D, got {X.shape}")
 
     X_mean = X.mean(axis=0)
-    y_mean = y.mean()
+    Y_mean = Y.mean(axis=0)
     Xc = X - X_mean
-    yc = y - y_mean
+    Yc = Y - Y_mean
 
     n_feat = X.shape[1]
     A = Xc.T @ Xc + alpha * np.eye(n_feat)
-    w = np.linalg.solve(A, Xc.T @ yc)
-    b = float(y_mean - X_mean @ w)
-    return w, b
-
-def _mae(y_true, y_pred) -> float:
-    y_true = np.asarray(y_true, dtype=float).reshape(-1)
-    y_pred = np.asarray(y_pred, dtype=float).reshape(-1)
-    return float(np.mean(np.abs(y_true - y_pred)))
-
-def _fetch_training_rows(horizon_weeks: int) -> List[Dict[str, Any]]:
-    con = sqlite3.connect(DB_PATH)
-    con.row_factory = sqlite3.Row
-    cur = con.cursor()
-    cur.execute(
-        """SELECT
-            c.case_id,
-            c.hb0, c.fe0, c.ferritin0, c.tibc0, c.tsat0,
-            c.dose_mg_day, c.adherence, c.bleed, c.inflam,
-            f.hb as hb_w, f.fe as fe_w, f.ferritin as ferr_w, f.tibc as tibc_w, f.tsat as tsat_w
-        FROM cases c
-        JOIN followups f ON c.case_id = f.case_id
-        WHERE f.horizon_weeks = ?""", (horizon_weeks,)
-    )
-    rows = [dict(r) for r in cur.fetchall()]
-    con.close()
-    return rows
+    W = np.linalg.solve(A, Xc.T @ Yc)
+    b = Y_mean - X_mean @ W
+    return W, b
+
+# Training set as plain numbers: columns 0-7 are the FEATURE_KEYS inputs (NULL -> 0),
+# then the rule_predict inputs (TSAT from Fe/TIBC when missing, Ctx defaults) and the measured values
+def _sql_num(col: str) -> str:
+    # REAL/INTEGER affinity already converted numeric text on insert, so anything still stored
+    # as text ('' or garbage) is treated as missing, like safe_float's default
+    return f"(CASE WHEN typeof({col}) IN ('integer', 'real') THEN {col} END)"
+
+SQL_TRAINING_MATRIX = f"""SELECT
+    COALESCE({_sql_num("c.hb0")}, 0.0), COALESCE({_sql_num("c.tsat0")}, 0.0),
+    COALESCE({_sql_num("c.ferritin0")}, 0.0), COALESCE({_sql_num("c.tibc0")}, 0.0),
+    COALESCE({_sql_num("c.dose_mg_day")}, 0.0), COALESCE({_sql_num("c.adherence")}, 0.0),
+    COALESCE({_sql_num("c.bleed")}, 0.0), COALESCE({_sql_num("c.inflam")}, 0.0),
+    COALESCE({_sql_num("c.tsat0")},
+             CASE WHEN {_sql_num("c.tibc0")} > 0
+                  THEN 100.0 * COALESCE({_sql_num("c.fe0")}, 0.0) / {_sql_num("c.tibc0")} END),
+    COALESCE(CAST({_sql_num("c.dose_mg_day")} AS INTEGER), 500),
+    COALESCE({_sql_num("c.adherence")}, 1.0),
+    COALESCE({_sql_num("f.hb")}, 0.0), COALESCE({_sql_num("f.tsat")}, 0.0), COALESCE({_sql_num("f.ferritin")}, 0.0)
+FROM cases c
+JOIN followups f ON c.case_id = f.case_id
+WHERE f.horizon_weeks = ?"""
+_TM_RULE_TSAT, _TM_RULE_DOSE, _TM_RULE_ADH, _TM_HB_W, _TM_TSAT_W, _TM_FERR_W = range(8, 14)
+
+def _count_training_rows(horizon_weeks: int) -> int:
+    with _CONN_LOCK:
+        row = _conn().execute(
+            "SELECT COUNT(*) FROM followups f JOIN cases c ON c.case_id = f.case_id WHERE f.horizon_weeks = ?",
+            (horizon_weeks,),
+        ).fetchone()
+    return int(row[0])
+
+def _fetch_training_matrix(horizon_weeks: int) -> np.ndarray:
+    """Rows for training as one (n, 14) float array (see SQL_TRAINING_MATRIX); TSAT that cannot be derived is NaN."""
+    with _CONN_LOCK:
+        cur = _conn().cursor()
+        cur.row_factory = None  # plain tuples straight into numpy
+        rows = cur.execute(SQL_TRAINING_MATRIX, (horizon_weeks,)).fetchall()
+    return np.array(rows, dtype=float).reshape(-1, 14)
+
+_TRAIN_LOCK = threading.Lock()
 
 def train_calibration(horizon_weeks: int, force: bool = False, alpha: float = 10.0) -> Dict[str, Any]:
-    rows = _fetch_training_rows(horizon_weeks)
-    n = len(rows)
+    # One training at a time across Streamlit sessions: model.json / model_versions stay consistent
+    with _TRAIN_LOCK:
+        return _train_calibration(horizon_weeks, force=force, alpha=alpha)
+
+def _train_calibration(horizon_weeks: int, force: bool = False, alpha: float = 10.0) -> Dict[str, Any]:
+    # Decide the skip cases from a count first; the full training set is fetched only when fitting
+    n = _count_training_rows(horizon_weeks)
 
     if n == 0:
         return {"status": "skipped", "reason": "no followup data for training", "n_train": 0}
@@ -468,60 +576,38 @@ def train_calibration(horizon_weeks: int, force: bool = False, alpha: float = 10
     if (not force) and current and int(current.get("n_train", 0)) == n:
         return {"status": "skipped", "reason": "no new data since last training", "n_train": n}
 
-    X_list = []
-    y_hb = []
-    y_tsat = []
-    y_ferr = []
-
-    for r in rows:
-        labs0 = Labs(
-            hb=safe_float(r["hb0"]),
-            fe=safe_float(r["fe0"]),
-            ferritin=safe_float(r["ferritin0"]),
-            tibc=safe_float(r["tibc0"]),
-            tsat=safe_float(r["tsat0"]) if r["tsat0"] is not None else None,
-        )
-        ctx = Ctx(
-            dose_mg_day=safe_int(r["dose_mg_day"], 500),
-            adherence=safe_float(r["adherence"], 1.0),
-            bleed=safe_float(r["bleed"], 0.0),
-            inflam=safe_float(r["inflam"], 0.0),
-        )
-
-        rule = rule_predict(labs0, ctx, horizon_weeks=horizon_weeks)
-
-        y_hb.append(safe_float(r["hb_w"]) - safe_float(rule["Hb"]))
-        y_tsat.append(safe_float(r["tsat_w"]) - safe_float(rule["TSAT"]))
-        y_ferr.append(safe_float(r["ferr_w"]) - safe_float(rule["Ferritin"]))
+    M = _fetch_training_matrix(horizon_weeks)
+    n = int(M.shape[0])
+    if n == 0:
+        return {"status": "skipped", "reason": "no followup data for training", "n_train": 0}
+    X = M[:, :len(FEATURE_KEYS)]
 
-        X_list.append([
-            safe_float(r["hb0"]),
-            safe_float(r["tsat0"]),
-            safe_float(r["ferritin0"]),
-            safe_float(r["tibc0"]),
-            safe_float(r["dose_mg_day"]),
-            safe_float(r["adherence"]),
-            safe_float(r["bleed"]),
-            safe_float(r["inflam"]),
-        ])
+    # Rule baseline for all rows at once
+    if np.isnan(M[:, _TM_RULE_TSAT]).any():
+        raise ValueError("TSATまたはFe/TIBCが必要です")
+    hb1, _fe1, ferr1, tsat1 = _rule_core_vec(
+        X[:, 0], X[:, 2], X[:, 3], M[:, _TM_RULE_TSAT],
+        M[:, _TM_RULE_DOSE], M[:, _TM_RULE_ADH], X[:, 6], X[:, 7], horizon_weeks,
+    )
 
-    X = np.asarray(X_list, dtype=float)
-    y_hb = np.asarray(y_hb, dtype=float)
-    y_tsat = np.asarray(y_tsat, dtype=float)
-    y_ferr = np.asarray(y_ferr, dtype=float)
+    # Residual targets (rule values rounded as rule_predict returns them)
+    y_hb = M[:, _TM_HB_W] - np.round(hb1, 2)
+    y_tsat = M[:, _TM_TSAT_W] - np.round(tsat1, 1)
+    y_ferr = M[:, _TM_FERR_W] - np.round(ferr1, 1)
 
-    w_hb, b_hb = _ridge_fit(X, y_hb, alpha=alpha)
-    w_tsat, b_tsat = _ridge_fit(X, y_tsat, alpha=alpha)
-    w_ferr, b_ferr = _ridge_fit(X, y_ferr, alpha=alpha)
+    # The three targets share X: factor (XᵀX + αI) once and solve all columns together
+    Y = np.column_stack([y_hb, y_tsat, y_ferr])
+    W, B = _ridge_fit_multi(X, Y, alpha=alpha)
+    w_hb, w_tsat, w_ferr = W.T
+    b_hb, b_tsat, b_ferr = (float(v) for v in B)
 
-    pred_hb = X @ w_hb + b_hb
-    pred_tsat = X @ w_tsat + b_tsat
-    pred_ferr = X @ w_ferr + b_ferr
+    # In-sample residual MAE for all three targets from one X @ W
+    mae_hb, mae_tsat, mae_ferr = np.mean(np.abs(Y - (X @ W + B)), axis=0).tolist()
 
     metrics = {
-        "mae_hb_residual": _mae(y_hb, pred_hb),
-        "mae_tsat_residual": _mae(y_tsat, pred_tsat),
-        "mae_ferritin_residual": _mae(y_ferr, pred_ferr),
+        "mae_hb_residual": mae_hb,
+        "mae_tsat_residual": mae_tsat,
+        "mae_ferritin_residual": mae_ferr,
         "alpha": alpha,
     }
 
@@ -543,18 +629,15 @@ def train_calibration(horizon_weeks: int, force: bool = False, alpha: float = 10
         "metrics": metrics,
     }
 
-    models_all.setdefault("models", {})
-    models_all["models"][str(horizon_weeks)] = model
+    # load_models() is shared, so build a new dict instead of updating it in place
+    models_all = {**models_all, "models": {**models_all.get("models", {}), str(horizon_weeks): model}}
     save_models(models_all)
 
-    con = sqlite3.connect(DB_PATH)
-    cur = con.cursor()
-    cur.execute(
-        "INSERT INTO model_versions(horizon_weeks, version, trained_at, n_train, metrics_json, model_json) VALUES(?,?,?,?,?,?)",
-        (horizon_weeks, version, model["trained_at"], n, json.dumps(metrics, ensure_ascii=False), json.dumps(model, ensure_ascii=False)),
-    )
-    con.commit()
-    con.close()
+    with _CONN_LOCK, _conn() as con:
+        con.execute(
+            "INSERT INTO model_versions(horizon_weeks, version, trained_at, n_train, metrics_json, model_json) VALUES(?,?,?,?,?,?)",
+            (horizon_weeks, version, model["trained_at"], n, json.dumps(metrics, ensure_ascii=False), json.dumps(model, ensure_ascii=False)),
+        )
 
     return {"status": "trained", "version": version, "n_train": n, "metrics": metrics}
 
@@ -565,14 +648,11 @@ def add_followup(case_id: str, horizon_weeks: int, hb: float, fe: float, ferriti
     if tsat is None:
         tsat = calc_tsat(fe, tibc)
 
-    con = sqlite3.connect(DB_PATH)
-    cur = con.cursor()
-    cur.execute(
-        "INSERT OR REPLACE INTO followups(case_id, horizon_weeks, followup_at, hb, fe, ferritin, tibc, tsat) VALUES(?,?,?,?,?,?,?,?)",
-        (case_id, horizon_weeks, now_ts(), hb, fe, ferritin, tibc, tsat),
-    )
-    con.commit()
-    con.close()
+    with _CONN_LOCK, _conn() as con:
+        con.execute(
+            "INSERT OR REPLACE INTO followups(case_id, horizon_weeks, followup_at, hb, fe, ferritin, tibc, tsat) VALUES(?,?,?,?,?,?,?,?)",
+            (case_id, horizon_weeks, now_ts(), hb, fe, ferritin, tibc, tsat),
+        )
 
     result = train_calibration(horizon_weeks, force=False)
     return {"saved": True, "auto_calibration": result}